@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+#############################################################################
+######   This script is a python reader for AMBER prmtop topologies and
+######   AMBER NetCDF trajectories (memory-mapped, no cpptraj required)
+######   It is part of the DROIDS v6.0 ChimeraX plug-in suite for
+######   machine-learning assisted comparative protein dynamics
+######   produced by Dr. Gregory A. Babbitt and students at the
+######   Rochester Instituteof Technology in 2022.   License under GPL v3.0
+#############################################################################
+
+import re
+import numpy as np
+from scipy.io import netcdf_file
+
+# backbone atoms and solvent residues matching cpptraj mask '@CA,C,O,N&!(:WAT)'
+BACKBONE_ATOMS = ("CA", "C", "O", "N")
+SOLVENT_RESIDUES = ("WAT",)
+
+################################################################################
+# prmtop topology
+################################################################################
+
+def read_prmtop(top_file):
+    """read the %FLAG sections of an AMBER prmtop file
+    Arguments:
+        top_file {str} -- [path to .prmtop file]
+    Returns:
+        [dict] -- [flag name -> list of values (str, int or float)]
+    """
+    sections = {}
+    flag = None
+    width = 0
+    kind = "a"
+    with open(top_file, "r") as f:
+        for line in f:
+            if line.startswith("%FLAG"):
+                flag = line.split()[1]
+                sections[flag] = []
+                continue
+            if line.startswith("%FORMAT"):
+                fmt = re.search(r"\((\d+)([aIEF])(\d+)", line)
+                kind = fmt.group(2)
+                width = int(fmt.group(3))
+                continue
+            if flag is None or line.startswith("%"):
+                continue
+            line = line.rstrip("\n")
+            for x in range(0, len(line), width):
+                field = line[x:x+width]
+                if field.strip() == "":
+                    continue
+                if kind == "a":
+                    sections[flag].append(field.strip())
+                elif kind == "I":
+                    sections[flag].append(int(field))
+                else:
+                    sections[flag].append(float(field))
+    return sections
+
+def backbone_selection(top_file, atom_names=BACKBONE_ATOMS, exclude_residues=SOLVENT_RESIDUES):
+    """select atoms as cpptraj '@CA,C,O,N&!(:WAT) byres' does
+    Arguments:
+        top_file {str} -- [path to .prmtop file]
+    Returns:
+        [dict] -- [atoms: 0-based atom indices, residue_of_atom: 0-based position of
+                   each atom's residue in res_ids, res_ids: 1-based residue numbers,
+                   res_names: residue labels, masses: atom masses]
+    """
+    top = read_prmtop(top_file)
+    names = top["ATOM_NAME"]
+    labels = top["RESIDUE_LABEL"]
+    pointers = [p-1 for p in top["RESIDUE_POINTER"]] + [len(names)]
+    masses = np.array(top["MASS"], dtype=np.float64)
+    atoms = []
+    residue_of_atom = []
+    res_ids = []
+    res_names = []
+    for r in range(len(labels)):
+        if labels[r] in exclude_residues:
+            continue
+        picked = [a for a in range(pointers[r], pointers[r+1]) if names[a] in atom_names]
+        if (len(picked) == 0):
+            continue
+        for a in picked:
+            atoms.append(a)
+            residue_of_atom.append(len(res_ids))
+        res_ids.append(r+1)
+        res_names.append(labels[r])
+    atoms = np.array(atoms, dtype=np.int64)
+    return {"atoms": atoms,
+            "residue_of_atom": np.array(residue_of_atom, dtype=np.int64),
+            "res_ids": res_ids,
+            "res_names": res_names,
+            "masses": masses[atoms]}
+
+################################################################################
+# NetCDF trajectory
+################################################################################
+
+class AmberTrajectory:
+    """memory-mapped AMBER NetCDF (classic/64-bit offset) trajectory
+
+    coordinates is a read-only (n_frames, n_atoms, 3) view straight onto the
+    file; nothing is read from disk until a frame range is actually touched.
+    """
+    def __init__(self, traj_file):
+        try:
+            self._nc = netcdf_file(traj_file, "r", mmap=True, maskandscale=False)
+        except TypeError:
+            raise ValueError("%s is not a NetCDF3 (classic or 64-bit offset) file; NetCDF4/HDF5 trajectories need the cpptraj backend" % traj_file)
+        if "coordinates" not in self._nc.variables:
+            raise ValueError("%s has no coordinates variable (not an AMBER trajectory?)" % traj_file)
+        self.traj_file = traj_file
+        self.coordinates = self._nc.variables["coordinates"].data
+        self.n_frames = self.coordinates.shape[0]
+        self.n_atoms = self.coordinates.shape[1]
+
+    def window(self, start=1, stop=None, stride=1):
+        """zero-copy view of frames start..stop (1-based, inclusive, as in cpptraj trajin)
+        Arguments:
+            start {int} -- [first frame] (default: {1})
+            stop {int} -- [last frame] (default: {last frame of trajectory})
+            stride {int} -- [frame offset] (default: {1})
+        Returns:
+            [ndarray] -- [(n_window_frames, n_atoms, 3) view]
+        """
+        if stop is None or stop > self.n_frames:
+            stop = self.n_frames
+        return self.coordinates[start-1:stop:stride]
+
+    def close(self):
+        self.coordinates = None
+        self._nc.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+#############################################################################
+######   This script converts cpptraj atomiccorr pair lists into the
+######   L x L site matrices read by the DROIDS analyzers, in bulk
+######   (pandas/numpy) and in parallel across a process pool
+######   It is part of the DROIDS v6.0 ChimeraX plug-in suite for
+######   machine-learning assisted comparative protein dynamics
+######   produced by Dr. Gregory A. Babbitt and students at the
+######   Rochester Instituteof Technology in 2022.   License under GPL v3.0
+#############################################################################
+
+import os
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+def read_corr_values(in_file):
+    # third column of the pair list, kept as the exact strings cpptraj wrote
+    try:
+        df = pd.read_csv(in_file, sep="\s+", header=None, skiprows=1, usecols=[2], dtype=str)
+    except pd.errors.EmptyDataError:
+        return np.array([], dtype=str)  # header only
+    return df[2].to_numpy()
+
+def corr_pairs_to_matrix(in_file, out_file, length_prot, binary=False, dtype="float64"):
+    """write the matrix file matrix_maker_old would write for one atomiccorr pair list
+    Arguments:
+        in_file {str} -- [cpptraj atomiccorr output, one 'res1 res2 value' row per pair]
+        out_file {str} -- [matrix file: 'site<TAB>v1<TAB>...vL<TAB>' rows, no final newline]
+        length_prot {int} -- [protein length L]
+        binary {bool} -- [also save the values as an L x L float array next to out_file (.npy),
+                          complete matrices only] (default: {False})
+        dtype {str} -- [type of the .npy values, float64 or float32] (default: {"float64"})
+    """
+    values = read_corr_values(in_file)
+    n_used = min(len(values), length_prot*length_prot)
+    rows = []
+    if (n_used > 0):
+        # matrix_maker_old opens the next row as soon as one is complete (up to L rows)
+        n_rows = min(length_prot, n_used//length_prot + 1)
+        for r in range(n_rows):
+            row = values[r*length_prot:min((r+1)*length_prot, n_used)]
+            if (len(row) > 0):
+                rows.append("%s\t%s\t" % (r+1, "\t".join(row)))
+            else:
+                rows.append("%s\t" % (r+1))
+    with open(out_file, "w") as f:
+        f.write("\n".join(rows))
+    if (binary and n_used == length_prot*length_prot):
+        np.save("%s.npy" % os.path.splitext(out_file)[0], values[:n_used].astype(dtype).reshape(length_prot, length_prot))
+
+def _convert(args):
+    corr_pairs_to_matrix(*args)
+    return args[1]
+
+def convert_corr_files(pairs, length_prot, binary=False, max_jobs=1, dtype="float64"):
+    """convert many pair lists, spread over a process pool
+    Arguments:
+        pairs {list} -- [(in_file, out_file) tuples]
+        length_prot {int} -- [protein length L]
+        binary {bool} -- [also save .npy matrices] (default: {False})
+        max_jobs {int} -- [worker processes; 1 converts in this process] (default: {1})
+        dtype {str} -- [type of the .npy values] (default: {"float64"})
+    """
+    jobs = [(in_file, out_file, length_prot, binary, dtype) for (in_file, out_file) in pairs]
+    if (max_jobs <= 1 or len(jobs) <= 1):
+        for job in jobs:
+            _convert(job)
+        return
+    with ProcessPoolExecutor(max_workers=max_jobs) as pool:
+        for out_file in pool.map(_convert, jobs, chunksize=max(1, len(jobs)//(4*max_jobs))):
+            pass
@@ -24,6 +24,10 @@ import re
 # for ggplot
 import pandas as pd
 import numpy as np
+import feature_store
+import corr_reduction
+import flux_features
+import cpptraj_scheduler as scheduler
 import scipy as sp
 from pandas.api.types import CategoricalDtype
 from plotnine import *
@@ -33,6 +37,14 @@ from plotnine import *
 
 ################################################################################
 # READ CONTROL FORM
+# optional settings (defaults used when DROIDS.ctl has no such line)
+feature_text = "no"  # yes = also write every feature matrix as text (DataFrame.to_string layout)
+precision = "float64"  # float32 = store and reduce every feature matrix in single precision
+precision_tol = 1e-3  # float32: largest accepted deviation from a float64 recomputation
+corr_threshold = 0.005  # residue correlations weaker than this are dropped (sparse storage) before the SVD
+flux_window = 5  # sites per fluctuation feature vector (odd; the site and its sequence neighbors)
+max_jobs = 0  # processes for the batched SVD of the subsample correlation matrices; 0 = one per core
+extend = "no"  # yes = build features only for subsamples added since the last run
 # read ChimeraX visualization ctl file
 infile = open("DROIDS.ctl", "r")
 infile_lines = infile.readlines()
@@ -101,6 +113,28 @@ for x in range(len(infile_lines)):
     if(header == "coordination"):
         coord_anal = value
         print("run coordinated dynamics is",coord_anal)
+    if(header == "feature_text"):
+        feature_text = value.strip()
+        print("my feature text export is",feature_text)
+    if(header == "precision"):
+        precision = value.strip()
+        feature_store.set_precision(precision)
+        print("my precision is",precision)
+    if(header == "precision_tol"):
+        precision_tol = float(value)
+        print("my precision tolerance is",precision_tol)
+    if(header == "corr_threshold"):
+        corr_threshold = float(value)
+        print("my correlation threshold is",corr_threshold)
+    if(header == "flux_window"):
+        flux_window = int(value)
+        print("my fluctuation window is",flux_window)
+    if(header == "max_jobs"):
+        max_jobs = int(value)
+        print("my max concurrent jobs is",max_jobs)
+    if(header == "extend"):
+        extend = value.strip()
+        print("my subsample extension is",extend)
     #if(header == "variants"):
     #    var_anal = value
     #    print("run variant dynamics is",var_anal)
@@ -188,6 +222,30 @@ def feature_vector_corr():
     if not os.path.exists('features/feature_sub_refCTL_reduced'):
         os.makedirs('features/feature_sub_refCTL_reduced')    
     
+    ##############################################################
+    ###### subsample correlation features of every state    ######
+    ##############################################################
+    # with extend,yes only the subsamples whose reduced features are missing or older than their matrix
+    # (all of them when the features were built with another corr_threshold, precision or setSize)
+    corr_settings = {"corr_threshold": corr_threshold, "precision": precision}
+    reduced_files = {"ref": "./features/feature_sub_ref_reduced/feature_%s_sub_ref_%%s.txt" % PDB_id_reference,
+                     "query": "./features/feature_sub_query_reduced/feature_%s_sub_query_%%s.txt" % PDB_id_query,
+                     "refCTL": "./features/feature_sub_refCTL_reduced/feature_%s_sub_refCTL_%%s.txt" % PDB_id_reference}
+    new_sub = {"ref": list(range(subsamples)), "query": list(range(subsamples)), "refCTL": list(range(subsamples))}
+    if(extend == "yes"):
+        new_sub["ref"] = feature_store.stale_indices(reduced_files["ref"], "./subsamples/atomcorr_ref_matrix/corr_%s_sub_reference_matrix_%%s.txt" % PDB_id_reference, subsamples, corr_settings)
+        new_sub["query"] = feature_store.stale_indices(reduced_files["query"], "./subsamples/atomcorr_query_matrix/corr_%s_sub_query_matrix_%%s.txt" % PDB_id_query, subsamples, corr_settings)
+        new_sub["refCTL"] = feature_store.stale_indices(reduced_files["refCTL"], "./subsamples/atomcorr_refCTL_matrix/corr_%s_sub_referenceCTL_matrix_%%s.txt" % PDB_id_reference, subsamples, corr_settings)
+        for label in new_sub:
+            print("%s: building features of %s new subsamples (%s kept)" % (label, len(new_sub[label]), subsamples-len(new_sub[label])))
+    # one process pool over all states and subsamples (chunks of subsamples per worker)
+    corr_jobs = {}
+    corr_jobs["ref"] = [("./subsamples/atomcorr_ref_matrix/corr_%s_sub_reference_matrix_%s.txt" % (PDB_id_reference, i), "./features/feature_sub_ref/feature_%s_sub_ref_%s.txt" % (PDB_id_reference, i), corr_threshold, feature_text == "yes", precision) for i in new_sub["ref"]]
+    corr_jobs["query"] = [("./subsamples/atomcorr_query_matrix/corr_%s_sub_query_matrix_%s.txt" % (PDB_id_query, i), "./features/feature_sub_query/feature_%s_sub_query_%s.txt" % (PDB_id_query, i), corr_threshold, feature_text == "yes", precision) for i in new_sub["query"]]
+    corr_jobs["refCTL"] = [("./subsamples/atomcorr_refCTL_matrix/corr_%s_sub_referenceCTL_matrix_%s.txt" % (PDB_id_reference, i), "./features/feature_sub_refCTL/feature_%s_sub_refCTL_%s.txt" % (PDB_id_reference, i), corr_threshold, feature_text == "yes", precision) for i in new_sub["refCTL"]]
+    print("building subsample correlation features (%s processes)" % scheduler.default_jobs(max_jobs))
+    corr_densities = corr_reduction.build_corr_features(corr_jobs, scheduler.default_jobs(max_jobs))
+    
     #######################################################
     ###### feature vector for whole reference MD run ######
     #######################################################
@@ -223,9 +281,7 @@ def feature_vector_corr():
     
     df1 = feature_all_ref
     writePath = "./features/feature_all_ref/feature_%s_all_ref.txt" % PDB_id_reference
-    with open(writePath, 'w') as f1:
-        dfAsString = df1.to_string(header=False, index=True)
-        f1.write(dfAsString)
+    feature_store.save_features(writePath, df1, feature_text == "yes")
     # create reduced atom correlation matrix (from sparse matrix)
     M = pd.DataFrame(dfcorr_all_ref)
     print("Original Matrix:")
@@ -233,7 +289,7 @@ def feature_vector_corr():
     #del M[M[0]]
     #print(M)
     # create sparse matrix
-    M[np.abs(M) < 0.005] = 0 # plug in zero values if below threshold
+    M[np.abs(M) < corr_threshold] = 0 # plug in zero values if below threshold
     print("Sparse Matrix:")
     print(M)
     svd =  TruncatedSVD(n_components = setSize)
@@ -255,9 +311,7 @@ def feature_vector_corr():
     
     df2 = feature_all_ref_reduced
     writePath = "./features/feature_all_ref_reduced/feature_%s_all_ref.txt" % PDB_id_reference
-    with open(writePath, 'w') as f2:
-        dfAsString = df2.to_string(header=False, index=True)
-        f2.write(dfAsString)
+    feature_store.save_features(writePath, df2, feature_text == "yes")
     print("feature vector(whole reference MD run) = reduced atom corr features:")
     print(feature_all_ref_reduced)  
     
@@ -265,87 +319,34 @@ def feature_vector_corr():
     ###### feature vectors for subsampled reference MD runs ######
     ##############################################################
     
-    for i in range(subsamples):
-        print("creating reduced feature vector for subsample %s MD reference run" % i)
-        influx_sub_ref = "./subsamples/atomflux_ref/fluct_%s_sub_reference.txt" % PDB_id_reference 
-        incorr_sub_ref = "./subsamples/atomcorr_ref_matrix/corr_%s_sub_reference_matrix_%s.txt" % (PDB_id_reference, i)    
-        dfflux_sub_ref = pd.read_csv(influx_sub_ref, sep="\s+")
-        dfcorr_sub_ref = pd.read_csv(incorr_sub_ref, sep="\s+", header=None)
-        del dfflux_sub_ref[dfflux_sub_ref.columns[0]] # remove first column
-        #del dfflux_sub_ref[dfflux_sub_ref.columns[0]] # remove next column
-        # iterate over atom flux columns 
-        column = dfflux_sub_ref.columns[i]
-        #print(column)
-        # normalize atom fluctuations (minmax method)
-        dfflux_sub_ref[column] = (dfflux_sub_ref[column] - dfflux_sub_ref[column].min()) / (dfflux_sub_ref[column].max() - dfflux_sub_ref[column].min())
-        #dfflux_sub_ref[column] = dfflux_sub_ref[column] # option skip normalization
-        myColumn = dfflux_sub_ref[column]
-        myColumn = pd.DataFrame(myColumn)
-        #print(myColumn)
-        #dfflux_sub_ref = dfflux_sub_ref[column]
-        # trim uneccessary columns
-        del dfcorr_sub_ref[dfcorr_sub_ref.columns[0]] # remove first column
-        del dfcorr_sub_ref[dfcorr_sub_ref.columns[-1]] # remove last column = NaN
-        #print(dfflux_sub_ref)
-        #print(dfcorr_sub_ref)
-                
-        ### option to combine flux and corr ###
-        #frames_sub_ref = [myColumn, dfcorr_sub_ref]
-        #feature_sub_ref = pd.concat(frames_sub_ref, axis = 1, join="inner")
-        
-        ### option to include only corr ###
-        feature_sub_ref = dfcorr_sub_ref
-        
-        #print(dfflux_sub_ref)
-        #print(dfcorr_sub_ref)
-        #print(feature_sub_ref)
-        df1 = feature_sub_ref
-        writePath = "./features/feature_sub_ref/feature_%s_sub_ref_%s.txt" % (PDB_id_reference, i)
-        with open(writePath, 'w') as f1:
-            dfAsString = df1.to_string(header=False, index=True)
-            f1.write(dfAsString)
-        # create reduced atom correlation matrix (from sparse matrix)
-        M = dfcorr_sub_ref
-        #print("Original Matrix:")
-        #print(M)
-        # create sparse matrix
-        M[np.abs(M) < 0.005] = 0 # plug in zero values if below threshold
-        #print("Sparse Matrix:")
-        #print(M)
-        ##################################################################################################
-        #### tune size of truncation of SVD to capture 80% of variance explained by site correlations ####
-        ##################################################################################################
-        if (i == 0):
-            ratio = 0.9
-            setSize = int(ratio*length_prot)
-            #print(setSize)
-            svd =  TruncatedSVD(n_components = setSize)
-            M_transf = svd.fit_transform(M)
-            tve = svd.explained_variance_ratio_.sum()
-            while (tve >= 0.8 and setSize >= 5):
-                setSize = int(ratio*length_prot)
-                #print(setSize)
-                svd =  TruncatedSVD(n_components = setSize)
-                M_transf = svd.fit_transform(M)
-                #print(svd.explained_variance_ratio_.sum())
-                tve = svd.explained_variance_ratio_.sum()
-                #print(tve)
-                ratio = ratio-0.02
-            print("determine reduced feature vector size")
-            print(setSize)
-        ##################################################################################################
-        
-        svd =  TruncatedSVD(n_components = setSize)
-        M_transf = svd.fit_transform(M)
+    densities = corr_densities["ref"]  # fraction of correlations kept, per subsample
+    ##################################################################################################
+    #### tune size of truncation of SVD to capture 80% of variance explained by site correlations ####
+    ##################################################################################################
+    # one SVD spectrum on subsample 0; the choice is cached with the state's features
+    setSize, tve = corr_reduction.tuned_components("./features/feature_sub_ref/feature_%s_sub_ref_%s.txt" % (PDB_id_reference, 0), length_prot, corr_threshold)
+    if(extend == "yes"):
+        for label in new_sub:
+            if(len(new_sub[label]) < subsamples and feature_store.settings_changed(reduced_files[label], {"setSize": setSize})):
+                print("%s: kept features were reduced to another size, reducing all %s subsamples to %s" % (label, subsamples, setSize))
+                new_sub[label] = list(range(subsamples))
+    print("determine reduced feature vector size")
+    print(setSize)
+    ##################################################################################################
+    
+    corr_reduction.density_report("ref", densities, corr_threshold)
+    # all subsample matrices of the state in batched randomized SVD passes
+    sub_files = ["./features/feature_sub_ref/feature_%s_sub_ref_%s.txt" % (PDB_id_reference, i) for i in new_sub["ref"]]
+    for (i, M_transf, singular_values, variance_ratio) in corr_reduction.reduce_feature_files(sub_files, setSize, scheduler.default_jobs(max_jobs), corr_threshold, check_tol=precision_tol, indices=new_sub["ref"]):
         if (i == 0):
             print("singular values")
-            print(svd.singular_values_)
+            print(singular_values)
             print("explained variance ratio")
-            print(svd.explained_variance_ratio_)
+            print(variance_ratio)
             print("total variance explained")
-            print(svd.explained_variance_ratio_.sum())
+            print(variance_ratio.sum())
         #print("Singular values:")
-        #print(svd.singular_values_)
+        #print(singular_values)
         #print("Transformed Matrix after reducing to 5 features:")
         #print(M_transf)
         M_transf = pd.DataFrame(M_transf)
@@ -361,9 +362,7 @@ def feature_vector_corr():
         
         df2 = feature_sub_ref_reduced
         writePath = "./features/feature_sub_ref_reduced/feature_%s_sub_ref_%s.txt" % (PDB_id_reference, i)
-        with open(writePath, 'w') as f2:
-            dfAsString = df2.to_string(header=False, index=True)
-            f2.write(dfAsString)
+        feature_store.save_features(writePath, df2, feature_text == "yes")
         #print("feature vector(subsampled reference MD run %s) = atom fluct + 5 reduced atom corr features:" % i)
         #print(feature_sub_ref_reduced) 
     
@@ -401,15 +400,13 @@ def feature_vector_corr():
     #print(feature_all_query)
     df1 = feature_all_query
     writePath = "./features/feature_all_query/feature_%s_all_query.txt" % PDB_id_query
-    with open(writePath, 'w') as f1:
-        dfAsString = df1.to_string(header=False, index=True)
-        f1.write(dfAsString)
+    feature_store.save_features(writePath, df1, feature_text == "yes")
     # create reduced atom correlation matrix (from sparse matrix)
     M = dfcorr_all_query
     #print("Original Matrix:")
     #print(M)
     # create sparse matrix
-    M[np.abs(M) < 0.005] = 0 # plug in zero values if below threshold
+    M[np.abs(M) < corr_threshold] = 0 # plug in zero values if below threshold
     #print("Sparse Matrix:")
     #print(M)
     svd =  TruncatedSVD(n_components = setSize)
@@ -431,9 +428,7 @@ def feature_vector_corr():
     
     df2 = feature_all_query_reduced
     writePath = "./features/feature_all_query_reduced/feature_%s_all_query.txt" % PDB_id_query
-    with open(writePath, 'w') as f2:
-        dfAsString = df2.to_string(header=False, index=True)
-        f2.write(dfAsString)
+    feature_store.save_features(writePath, df2, feature_text == "yes")
     print("feature vector (whole query MD run) = reduced atom corr features:")
     print(feature_all_query_reduced)
         
@@ -441,87 +436,21 @@ def feature_vector_corr():
     ###### feature vectors for subsampled query MD runs     ######
     ##############################################################
     
-    for i in range(subsamples):
-        print("creating reduced feature vector for subsample %s MD query run" % i)
-        influx_sub_query = "./subsamples/atomflux_query/fluct_%s_sub_query.txt" % PDB_id_query 
-        incorr_sub_query = "./subsamples/atomcorr_query_matrix/corr_%s_sub_query_matrix_%s.txt" % (PDB_id_query, i)    
-        dfflux_sub_query = pd.read_csv(influx_sub_query, sep="\s+")
-        dfcorr_sub_query = pd.read_csv(incorr_sub_query, sep="\s+", header=None)
-        del dfflux_sub_query[dfflux_sub_query.columns[0]] # remove first column
-        #del dfflux_sub_query[dfflux_sub_query.columns[0]] # remove next column
-        # iterate over atom flux columns 
-        column = dfflux_sub_query.columns[i]
-        #print(column)
-        # normalize atom fluctuations (minmax method)
-        dfflux_sub_query[column] = (dfflux_sub_query[column] - dfflux_sub_query[column].min()) / (dfflux_sub_query[column].max() - dfflux_sub_query[column].min())
-        #dfflux_sub_query[column] = dfflux_sub_query[column] # option skip normalization
-        myColumn = dfflux_sub_query[column]
-        myColumn = pd.DataFrame(myColumn)
-        #print(myColumn)
-        #dfflux_sub_query = dfflux_sub_query[column]
-        # trim uneccessary columns
-        del dfcorr_sub_query[dfcorr_sub_query.columns[0]] # remove first column
-        del dfcorr_sub_query[dfcorr_sub_query.columns[-1]] # remove last column = NaN
-        #print(dfflux_sub_query)
-        #print(dfcorr_sub_query)
-        
-        ### option to combine flux and corr ###
-        #frames_sub_query = [myColumn, dfcorr_sub_query]
-        #feature_sub_query = pd.concat(frames_sub_query, axis = 1, join="inner")
-        
-        ### option to include only corr ###
-        feature_sub_query = dfcorr_sub_query
-        
-        #print(dfflux_sub_query)
-        #print(dfcorr_sub_query)
-        #print(feature_sub_query)
-        df1 = feature_sub_query
-        writePath = "./features/feature_sub_query/feature_%s_sub_query_%s.txt" % (PDB_id_query, i)
-        with open(writePath, 'w') as f1:
-            dfAsString = df1.to_string(header=False, index=True)
-            f1.write(dfAsString)
-        # create reduced atom correlation matrix (from sparse matrix)
-        M = dfcorr_sub_query
-        #print("Original Matrix:")
-        #print(M)
-        # create sparse matrix
-        M[np.abs(M) < 0.005] = 0 # plug in zero values if below threshold
-        #print("Sparse Matrix:")
-        #print(M)
-        ##################################################################################################
-        #### tune size of truncation of SVD to capture 80% of variance explained by site correlations ####
-        ##################################################################################################
-        #if (i == 0):
-        #   ratio = 0.9
-        #    setSize = int(ratio*length_prot)
-        #    #print(setSize)
-        #    svd =  TruncatedSVD(n_components = setSize)
-        #    M_transf = svd.fit_transform(M)
-        #    tve = svd.explained_variance_ratio_.sum()
-        #    while (tve >= 0.8 and setSize >= 5):
-        #       setSize = int(ratio*length_prot)
-        #        #print(setSize)
-        #        svd =  TruncatedSVD(n_components = setSize)
-        #        M_transf = svd.fit_transform(M)
-        #        #print(svd.explained_variance_ratio_.sum())
-        #        tve = svd.explained_variance_ratio_.sum()
-        #        #print(tve)
-        #        ratio = ratio-0.02
-        #    print("determine reduced feature vector size")
-        #    print(setSize)
-        ##################################################################################################
-        
-        svd =  TruncatedSVD(n_components = setSize)
-        M_transf = svd.fit_transform(M)
+    densities = corr_densities["query"]  # fraction of correlations kept, per subsample
+    
+    corr_reduction.density_report("query", densities, corr_threshold)
+    # all subsample matrices of the state in batched randomized SVD passes
+    sub_files = ["./features/feature_sub_query/feature_%s_sub_query_%s.txt" % (PDB_id_query, i) for i in new_sub["query"]]
+    for (i, M_transf, singular_values, variance_ratio) in corr_reduction.reduce_feature_files(sub_files, setSize, scheduler.default_jobs(max_jobs), corr_threshold, check_tol=precision_tol, indices=new_sub["query"]):
         if (i == 0):
             print("singular values")
-            print(svd.singular_values_)
+            print(singular_values)
             print("explained variance ratio")
-            print(svd.explained_variance_ratio_)
+            print(variance_ratio)
             print("total variance explained")
-            print(svd.explained_variance_ratio_.sum())
+            print(variance_ratio.sum())
         #print("Singular values:")
-        #print(svd.singular_values_)
+        #print(singular_values)
         #print("Transformed Matrix after reducing to 5 features:")
         #print(M_transf)
         M_transf = pd.DataFrame(M_transf)
@@ -537,9 +466,7 @@ def feature_vector_corr():
         
         df2 = feature_sub_query_reduced
         writePath = "./features/feature_sub_query_reduced/feature_%s_sub_query_%s.txt" % (PDB_id_query, i)
-        with open(writePath, 'w') as f2:
-            dfAsString = df2.to_string(header=False, index=True)
-            f2.write(dfAsString)
+        feature_store.save_features(writePath, df2, feature_text == "yes")
         #print("feature vector(subsampled reference MD run %s) = atom fluct + 5 reduced atom corr features:" % i)
         #print(feature_sub_ref_reduced) 
     
@@ -579,9 +506,7 @@ def feature_vector_corr():
     #print(feature_all_ref)
     df1 = feature_all_ref
     writePath = "./features/feature_all_refCTL/feature_%s_all_refCTL.txt" % PDB_id_reference
-    with open(writePath, 'w') as f1:
-        dfAsString = df1.to_string(header=False, index=True)
-        f1.write(dfAsString)
+    feature_store.save_features(writePath, df1, feature_text == "yes")
     # create reduced atom correlation matrix (from sparse matrix)
     M = pd.DataFrame(dfcorr_all_ref)
     print("Original Matrix:")
@@ -589,7 +514,7 @@ def feature_vector_corr():
     #del M[M[0]]
     #print(M)
     # create sparse matrix
-    M[np.abs(M) < 0.005] = 0 # plug in zero values if below threshold
+    M[np.abs(M) < corr_threshold] = 0 # plug in zero values if below threshold
     print("Sparse Matrix:")
     print(M)
     svd =  TruncatedSVD(n_components = setSize)
@@ -611,9 +536,7 @@ def feature_vector_corr():
     
     df2 = feature_all_ref_reduced
     writePath = "./features/feature_all_refCTL_reduced/feature_%s_all_refCTL.txt" % PDB_id_reference
-    with open(writePath, 'w') as f2:
-        dfAsString = df2.to_string(header=False, index=True)
-        f2.write(dfAsString)
+    feature_store.save_features(writePath, df2, feature_text == "yes")
     print("feature vector(whole reference MD run) = reduced atom corr features:")
     print(feature_all_ref_reduced)  
     
@@ -621,88 +544,22 @@ def feature_vector_corr():
     ###### feature vectors for subsampled reference MD runs ######
     ##############################################################
     
-    for i in range(subsamples):
-        print("creating reduced feature vector for subsample %s MD reference control run" % i)
-        influx_sub_ref = "./subsamples/atomflux_refCTL/fluct_%s_sub_referenceCTL.txt" % PDB_id_reference 
-        incorr_sub_ref = "./subsamples/atomcorr_refCTL_matrix/corr_%s_sub_referenceCTL_matrix_%s.txt" % (PDB_id_reference, i)    
-        dfflux_sub_ref = pd.read_csv(influx_sub_ref, sep="\s+")
-        dfcorr_sub_ref = pd.read_csv(incorr_sub_ref, sep="\s+", header=None)
-        del dfflux_sub_ref[dfflux_sub_ref.columns[0]] # remove first column
-        #del dfflux_sub_ref[dfflux_sub_ref.columns[0]] # remove next column
-        # iterate over atom flux columns 
-        column = dfflux_sub_ref.columns[i]
-        #print(column)
-        # normalize atom fluctuations (minmax method)
-        dfflux_sub_ref[column] = (dfflux_sub_ref[column] - dfflux_sub_ref[column].min()) / (dfflux_sub_ref[column].max() - dfflux_sub_ref[column].min())
-        #dfflux_sub_ref[column] = dfflux_sub_ref[column] # option skip normalization
-        myColumn = dfflux_sub_ref[column]
-        myColumn = pd.DataFrame(myColumn)
-        #print(myColumn)
-        #dfflux_sub_ref = dfflux_sub_ref[column]
-        # trim uneccessary columns
-        del dfcorr_sub_ref[dfcorr_sub_ref.columns[0]] # remove first column
-        del dfcorr_sub_ref[dfcorr_sub_ref.columns[-1]] # remove last column = NaN
-        #print(dfflux_sub_ref)
-        #print(dfcorr_sub_ref)
-        
-        ### option to combine flux and corr ###
-        #frames_sub_ref = [myColumn, dfcorr_sub_ref]
-        #feature_sub_ref = pd.concat(frames_sub_ref, axis = 1, join="inner")
-        
-        ### option to include only corr ###
-        feature_sub_ref = dfcorr_sub_ref
-                
-        #print(dfflux_sub_ref)
-        #print(dfcorr_sub_ref)
-        #print(feature_sub_ref)
-        df1 = feature_sub_ref
-        writePath = "./features/feature_sub_refCTL/feature_%s_sub_refCTL_%s.txt" % (PDB_id_reference, i)
-        with open(writePath, 'w') as f1:
-            dfAsString = df1.to_string(header=False, index=True)
-            f1.write(dfAsString)
-        # create reduced atom correlation matrix (from sparse matrix)
-        M = dfcorr_sub_ref
-        #print("Original Matrix:")
-        #print(M)
-        # create sparse matrix
-        M[np.abs(M) < 0.005] = 0 # plug in zero values if below threshold
-        #print("Sparse Matrix:")
-        #print(M)
-        ##################################################################################################
-        #### tune size of truncation of SVD to capture 80% of variance explained by site correlations ####
-        ##################################################################################################
-        #if (i == 0):
-        #    ratio = 0.9
-        #    setSize = int(ratio*length_prot)
-        #    #print(setSize)
-        #    svd =  TruncatedSVD(n_components = setSize)
-        #    M_transf = svd.fit_transform(M)
-        #    tve = svd.explained_variance_ratio_.sum()
-        #    while (tve >= 0.8 and setSize >= 5):
-        #        setSize = int(ratio*length_prot)
-        #        #print(setSize)
-        #        svd =  TruncatedSVD(n_components = setSize)
-        #        M_transf = svd.fit_transform(M)
-        #        #print(svd.explained_variance_ratio_.sum())
-        #        tve = svd.explained_variance_ratio_.sum()
-        #        #print(tve)
-        #        ratio = ratio-0.02
-        #    print("determine reduced feature vector size")
-        #    print(setSize)
-        ##################################################################################################
-        
-        svd =  TruncatedSVD(n_components = setSize)
-        M_transf = svd.fit_transform(M)
+    densities = corr_densities["refCTL"]  # fraction of correlations kept, per subsample
+    
+    corr_reduction.density_report("refCTL", densities, corr_threshold)
+    # all subsample matrices of the state in batched randomized SVD passes
+    sub_files = ["./features/feature_sub_refCTL/feature_%s_sub_refCTL_%s.txt" % (PDB_id_reference, i) for i in new_sub["refCTL"]]
+    for (i, M_transf, singular_values, variance_ratio) in corr_reduction.reduce_feature_files(sub_files, setSize, scheduler.default_jobs(max_jobs), corr_threshold, check_tol=precision_tol, indices=new_sub["refCTL"]):
         if (i == 0):
             print("singular values")
-            print(svd.singular_values_)
+            print(singular_values)
             print("explained variance ratio")
-            print(svd.explained_variance_ratio_)
+            print(variance_ratio)
             print("total variance explained")
-            print(svd.explained_variance_ratio_.sum())
+            print(variance_ratio.sum())
         #print(svd.explained_variance_ratio_.sum())
         #print("Singular values:")
-        #print(svd.singular_values_)
+        #print(singular_values)
         #print("Transformed Matrix after reducing to 5 features:")
         #print(M_transf)
         M_transf = pd.DataFrame(M_transf)
@@ -718,11 +575,12 @@ def feature_vector_corr():
         
         df2 = feature_sub_ref_reduced
         writePath = "./features/feature_sub_refCTL_reduced/feature_%s_sub_refCTL_%s.txt" % (PDB_id_reference, i)
-        with open(writePath, 'w') as f2:
-            dfAsString = df2.to_string(header=False, index=True)
-            f2.write(dfAsString)
+        feature_store.save_features(writePath, df2, feature_text == "yes")
         #print("feature vector(subsampled reference MD run %s) = atom fluct + 5 reduced atom corr features:" % i)
         #print(feature_sub_ref_reduced) 
+    # settings of the reduced features, checked by the next extended run
+    for label in reduced_files:
+        feature_store.record_settings(reduced_files[label], dict(corr_settings, setSize=setSize))
  
 def feature_vector_flux():
     print("creating/adding feature vector files for machine learning on atom fluctuations")
@@ -742,201 +600,60 @@ def feature_vector_flux():
         os.makedirs('features/featureCOMBINE_sub_refCTL')
     
     
+    # neighbor windows and combined vectors of all subsamples of a state at once
+    influx_sub_ref = "./subsamples/atomflux_ref/fluct_%s_sub_reference.txt" % PDB_id_reference
+    featureFLUX_sub_ref, featureCOMBINE_sub_ref = flux_features.state_features(influx_sub_ref, "./features/feature_sub_ref_reduced/feature_%s_sub_ref_%%s.txt" % PDB_id_reference, subsamples, length_prot, flux_window)
+    influx_sub_query = "./subsamples/atomflux_query/fluct_%s_sub_query.txt" % PDB_id_query
+    featureFLUX_sub_query, featureCOMBINE_sub_query = flux_features.state_features(influx_sub_query, "./features/feature_sub_query_reduced/feature_%s_sub_query_%%s.txt" % PDB_id_query, subsamples, length_prot, flux_window)
+    influx_sub_refCTL = "./subsamples/atomflux_refCTL/fluct_%s_sub_referenceCTL.txt" % PDB_id_reference
+    featureFLUX_sub_refCTL, featureCOMBINE_sub_refCTL = flux_features.state_features(influx_sub_refCTL, "./features/feature_sub_refCTL_reduced/feature_%s_sub_refCTL_%%s.txt" % PDB_id_reference, subsamples, length_prot, flux_window)
+    # with extend,yes only the subsamples whose combined features are older than their (new) reduced correlations
+    # (all of them when they were built with another flux_window, corr_threshold or precision)
+    flux_settings = {"flux_window": flux_window, "corr_threshold": corr_threshold, "precision": precision}
+    combine_files = {"ref": "./features/featureCOMBINE_sub_ref/feature_%s_sub_ref_%%s.txt" % PDB_id_reference,
+                     "query": "./features/featureCOMBINE_sub_query/feature_%s_sub_query_%%s.txt" % PDB_id_query,
+                     "refCTL": "./features/featureCOMBINE_sub_refCTL/feature_%s_sub_refCTL_%%s.txt" % PDB_id_reference}
+    new_sub = {"ref": list(range(subsamples)), "query": list(range(subsamples)), "refCTL": list(range(subsamples))}
+    if(extend == "yes"):
+        new_sub["ref"] = feature_store.stale_indices(combine_files["ref"], "./features/feature_sub_ref_reduced/feature_%s_sub_ref_%%s.txt" % PDB_id_reference, subsamples, flux_settings)
+        new_sub["query"] = feature_store.stale_indices(combine_files["query"], "./features/feature_sub_query_reduced/feature_%s_sub_query_%%s.txt" % PDB_id_query, subsamples, flux_settings)
+        new_sub["refCTL"] = feature_store.stale_indices(combine_files["refCTL"], "./features/feature_sub_refCTL_reduced/feature_%s_sub_refCTL_%%s.txt" % PDB_id_reference, subsamples, flux_settings)
     for i in range(subsamples):
         ############ reference protein  ##########################
-        print("creating fluctuation feature vector for subsample %s MD reference run" % i)
-        influx_sub_ref = "./subsamples/atomflux_ref/fluct_%s_sub_reference.txt" % PDB_id_reference 
-        dfflux_sub_ref = pd.read_csv(influx_sub_ref, sep="\s+")
-        del dfflux_sub_ref[dfflux_sub_ref.columns[0]] # remove first column
-        #del dfflux_sub_ref[dfflux_sub_ref.columns[0]] # remove next column
-        # iterate over atom flux columns 
-        column = dfflux_sub_ref.columns[i]
-        #print(column)
-        # normalize atom fluctuations (minmax method)
-        dfflux_sub_ref[column] = (dfflux_sub_ref[column] - dfflux_sub_ref[column].min()) / (dfflux_sub_ref[column].max() - dfflux_sub_ref[column].min())
-        #dfflux_sub_ref[column] = dfflux_sub_ref[column] # option skip normalization
-        dfflux_sub_ref = dfflux_sub_ref[column]
-        #print(dfflux_sub_ref)
-        # collect adjacent flux values from nearby residues
-        featureMatrix = []
-        for j in range(length_prot):
-            if(j-2 in range(0, length_prot)):
-                my_minus2 = dfflux_sub_ref[j-2]
-            else:
-                my_minus2 = dfflux_sub_ref[j]
-            #print(my_minus2)
-            if(j-1 in range(0, length_prot)):
-                my_minus1 = dfflux_sub_ref[j-1]
-            else:
-                my_minus1 = dfflux_sub_ref[j]
-            #print(my_minus1)
-            if(j in range(0, length_prot)):
-                my_plus0 = dfflux_sub_ref[j]
-            else:
-                my_plus0 = 0
-            #print(my_plus0)
-            if(j+1 in range(0, length_prot)):
-                my_plus1 = dfflux_sub_ref[j+1]
-            else:
-                my_plus1 = dfflux_sub_ref[j]
-            #print(my_plus1)
-            if(j+2 in range(0, length_prot)):
-                my_plus2 = dfflux_sub_ref[j+2]
-            else:
-                my_plus2 = dfflux_sub_ref[j]
-            featureRow = (my_minus2, my_minus1, my_plus0, my_plus1, my_plus2)
-            featureMatrix.append(featureRow)
-        
-        featureMatrix = pd.DataFrame(featureMatrix)
-        #print(featureMatrix)
-        # print to file
-        featureFLUX_sub_ref = featureMatrix
-        df1 = featureFLUX_sub_ref
-        writePath = "./features/featureFLUX_sub_ref/feature_%s_sub_ref_%s.txt" % (PDB_id_reference, i)
-        with open(writePath, 'w') as f1:
-            dfAsString = df1.to_string(header=False, index=True)
-            f1.write(dfAsString)
-        #read in reduced correlations and create combined flux+corr feature vector
-        read_corr = "./features/feature_sub_ref_reduced/feature_%s_sub_ref_%s.txt" % (PDB_id_reference, i)    
-        df3 = pd.read_csv(read_corr, sep="\s+", header=None)
-        del df3[df3.columns[0]] # remove first column
-        df3 = df3.iloc[:,:5]  # option take first 5 columns of correlations
-        frames = [df1, df3]
-        df_combined = pd.concat(frames, axis=1, join='inner')
-        writePath = "./features/featureCOMBINE_sub_ref/feature_%s_sub_ref_%s.txt" % (PDB_id_reference, i)
-        with open(writePath, 'w') as f3:
-            dfAsString = df_combined.to_string(header=False, index=True)
-            f3.write(dfAsString)
+        if(i in new_sub["ref"]):
+            print("creating fluctuation feature vector for subsample %s MD reference run" % i)
+            df1 = featureFLUX_sub_ref[i]
+            writePath = "./features/featureFLUX_sub_ref/feature_%s_sub_ref_%s.txt" % (PDB_id_reference, i)
+            feature_store.save_features(writePath, df1, feature_text == "yes")
+            #combined flux+corr feature vector
+            df_combined = featureCOMBINE_sub_ref[i]
+            writePath = "./features/featureCOMBINE_sub_ref/feature_%s_sub_ref_%s.txt" % (PDB_id_reference, i)
+            feature_store.save_features(writePath, df_combined, feature_text == "yes")
         
         ############ query protein  ##########################
-        print("creating fluctuation feature vector for subsample %s MD query run" % i)
-        influx_sub_query = "./subsamples/atomflux_query/fluct_%s_sub_query.txt" % PDB_id_query 
-        dfflux_sub_query = pd.read_csv(influx_sub_query, sep="\s+")
-        del dfflux_sub_query[dfflux_sub_query.columns[0]] # remove first column
-        #del dfflux_sub_query[dfflux_sub_query.columns[0]] # remove next column
-        # iterate over atom flux columns 
-        column = dfflux_sub_query.columns[i]
-        #print(column)
-        # normalize atom fluctuations (minmax method)
-        dfflux_sub_query[column] = (dfflux_sub_query[column] - dfflux_sub_query[column].min()) / (dfflux_sub_query[column].max() - dfflux_sub_query[column].min())
-        #dfflux_sub_query[column] = dfflux_sub_query[column] # option skip normalization
-        dfflux_sub_query = dfflux_sub_query[column]
-        #print(dfflux_sub_query)
-        # collect adjacent flux values from nearby residues
-        featureMatrix = []
-        for j in range(length_prot):
-            if(j-2 in range(0, length_prot)):
-                my_minus2 = dfflux_sub_query[j-2]
-            else:
-                my_minus2 = dfflux_sub_query[j]
-            #print(my_minus2)
-            if(j-1 in range(0, length_prot)):
-                my_minus1 = dfflux_sub_query[j-1]
-            else:
-                my_minus1 = dfflux_sub_query[j]
-            #print(my_minus1)
-            if(j in range(0, length_prot)):
-                my_plus0 = dfflux_sub_query[j]
-            else:
-                my_plus0 = 0
-            #print(my_plus0)
-            if(j+1 in range(0, length_prot)):
-                my_plus1 = dfflux_sub_query[j+1]
-            else:
-                my_plus1 = dfflux_sub_query[j]
-            #print(my_plus1)
-            if(j+2 in range(0, length_prot)):
-                my_plus2 = dfflux_sub_query[j+2]
-            else:
-                my_plus2 = dfflux_sub_query[j]
-            featureRow = (my_minus2, my_minus1, my_plus0, my_plus1, my_plus2)
-            featureMatrix.append(featureRow)
-        
-        featureMatrix = pd.DataFrame(featureMatrix)
-        #print(featureMatrix)
-        # print to file
-        featureFLUX_sub_query = featureMatrix
-        df1 = featureFLUX_sub_query
-        writePath = "./features/featureFLUX_sub_query/feature_%s_sub_query_%s.txt" % (PDB_id_query, i)
-        with open(writePath, 'w') as f1:
-            dfAsString = df1.to_string(header=False, index=True)
-            f1.write(dfAsString)
-        #read in reduced correlations and create combined flux+corr feature vector
-        read_corr = "./features/feature_sub_query_reduced/feature_%s_sub_query_%s.txt" % (PDB_id_query, i)    
-        df3 = pd.read_csv(read_corr, sep="\s+", header=None)
-        del df3[df3.columns[0]] # remove first column
-        df3 = df3.iloc[:,:5]  # option take first 5 columns of correlations
-        frames = [df1, df3]
-        df_combined = pd.concat(frames, axis=1, join='inner')
-        writePath = "./features/featureCOMBINE_sub_query/feature_%s_sub_query_%s.txt" % (PDB_id_query, i)
-        with open(writePath, 'w') as f3:
-            dfAsString = df_combined.to_string(header=False, index=True)
-            f3.write(dfAsString)
+        if(i in new_sub["query"]):
+            print("creating fluctuation feature vector for subsample %s MD query run" % i)
+            df1 = featureFLUX_sub_query[i]
+            writePath = "./features/featureFLUX_sub_query/feature_%s_sub_query_%s.txt" % (PDB_id_query, i)
+            feature_store.save_features(writePath, df1, feature_text == "yes")
+            #combined flux+corr feature vector
+            df_combined = featureCOMBINE_sub_query[i]
+            writePath = "./features/featureCOMBINE_sub_query/feature_%s_sub_query_%s.txt" % (PDB_id_query, i)
+            feature_store.save_features(writePath, df_combined, feature_text == "yes")
         
         ############ reference protein  ##########################
-        print("creating fluctuation feature vector for subsample %s MD reference control run" % i)
-        influx_sub_ref = "./subsamples/atomflux_refCTL/fluct_%s_sub_referenceCTL.txt" % PDB_id_reference 
-        dfflux_sub_ref = pd.read_csv(influx_sub_ref, sep="\s+")
-        del dfflux_sub_ref[dfflux_sub_ref.columns[0]] # remove first column
-        #del dfflux_sub_ref[dfflux_sub_ref.columns[0]] # remove next column
-        # iterate over atom flux columns 
-        column = dfflux_sub_ref.columns[i]
-        #print(column)
-        # normalize atom fluctuations (minmax method)
-        dfflux_sub_ref[column] = (dfflux_sub_ref[column] - dfflux_sub_ref[column].min()) / (dfflux_sub_ref[column].max() - dfflux_sub_ref[column].min())
-        #dfflux_sub_ref[column] = dfflux_sub_ref[column] # option skip normalization
-        dfflux_sub_ref = dfflux_sub_ref[column]
-        #print(dfflux_sub_ref)
-        # collect adjacent flux values from nearby residues
-        featureMatrix = []
-        for j in range(length_prot):
-            if(j-2 in range(0, length_prot)):
-                my_minus2 = dfflux_sub_ref[j-2]
-            else:
-                my_minus2 = dfflux_sub_ref[j]
-            #print(my_minus2)
-            if(j-1 in range(0, length_prot)):
-                my_minus1 = dfflux_sub_ref[j-1]
-            else:
-                my_minus1 = dfflux_sub_ref[j]
-            #print(my_minus1)
-            if(j in range(0, length_prot)):
-                my_plus0 = dfflux_sub_ref[j]
-            else:
-                my_plus0 = 0
-            #print(my_plus0)
-            if(j+1 in range(0, length_prot)):
-                my_plus1 = dfflux_sub_ref[j+1]
-            else:
-                my_plus1 = dfflux_sub_ref[j]
-            #print(my_plus1)
-            if(j+2 in range(0, length_prot)):
-                my_plus2 = dfflux_sub_ref[j+2]
-            else:
-                my_plus2 = dfflux_sub_ref[j]
-            featureRow = (my_minus2, my_minus1, my_plus0, my_plus1, my_plus2)
-            featureMatrix.append(featureRow)
-        
-        featureMatrix = pd.DataFrame(featureMatrix)
-        #print(featureMatrix)
-        # print to file
-        featureFLUX_sub_ref = featureMatrix
-        df1 = featureFLUX_sub_ref
-        writePath = "./features/featureFLUX_sub_refCTL/feature_%s_sub_refCTL_%s.txt" % (PDB_id_reference, i)
-        with open(writePath, 'w') as f1:
-            dfAsString = df1.to_string(header=False, index=True)
-            f1.write(dfAsString)
-        #read in reduced correlations and create combined flux+corr feature vector
-        read_corr = "./features/feature_sub_refCTL_reduced/feature_%s_sub_refCTL_%s.txt" % (PDB_id_reference, i)    
-        df3 = pd.read_csv(read_corr, sep="\s+", header=None)
-        del df3[df3.columns[0]] # remove first column
-        df3 = df3.iloc[:,:5]  # option take first 5 columns of correlations
-        frames = [df1, df3]
-        df_combined = pd.concat(frames, axis=1, join='inner')
-        writePath = "./features/featureCOMBINE_sub_refCTL/feature_%s_sub_refCTL_%s.txt" % (PDB_id_reference, i)
-        with open(writePath, 'w') as f3:
-            dfAsString = df_combined.to_string(header=False, index=True)
-            f3.write(dfAsString)
+        if(i in new_sub["refCTL"]):
+            print("creating fluctuation feature vector for subsample %s MD reference control run" % i)
+            df1 = featureFLUX_sub_refCTL[i]
+            writePath = "./features/featureFLUX_sub_refCTL/feature_%s_sub_refCTL_%s.txt" % (PDB_id_reference, i)
+            feature_store.save_features(writePath, df1, feature_text == "yes")
+            #combined flux+corr feature vector
+            df_combined = featureCOMBINE_sub_refCTL[i]
+            writePath = "./features/featureCOMBINE_sub_refCTL/feature_%s_sub_refCTL_%s.txt" % (PDB_id_reference, i)
+            feature_store.save_features(writePath, df_combined, feature_text == "yes")
+    # settings of the fluctuation and combined features (same subsamples), checked by the next extended run
+    for label in combine_files:
+        feature_store.record_settings(combine_files[label], flux_settings)
         
         
         
@@ -26,6 +26,10 @@ import re
 # for ggplot
 import pandas as pd
 import numpy as np
+import feature_store
+import corr_reduction
+import flux_features
+import cpptraj_scheduler as scheduler
 import scipy as sp
 from pandas.api.types import CategoricalDtype
 from plotnine import *
@@ -35,6 +39,13 @@ from plotnine import *
 
 ################################################################################
 # READ CONTROL FORM
+# optional settings (defaults used when DROIDS.ctl has no such line)
+feature_text = "no"  # yes = also write every feature matrix as text (DataFrame.to_string layout)
+precision = "float64"  # float32 = store and reduce every feature matrix in single precision
+precision_tol = 1e-3  # float32: largest accepted deviation from a float64 recomputation
+corr_threshold = 0.005  # residue correlations weaker than this are dropped (sparse storage) before the SVD
+flux_window = 5  # sites per fluctuation feature vector (odd; the site and its sequence neighbors)
+max_jobs = 0  # processes for the batched SVD of the subsample correlation matrices; 0 = one per core
 # read ChimeraX visualization ctl file
 infileALT = open("maxDemon.ctl", "r")
 infileALT_lines = infileALT.readlines()
@@ -126,6 +137,25 @@ for x in range(len(infile_lines)):
     if(header == "coordination"):
         coord_anal = value
         print("run coordinated dynamics is",coord_anal)
+    if(header == "feature_text"):
+        feature_text = value.strip()
+        print("my feature text export is",feature_text)
+    if(header == "precision"):
+        precision = value.strip()
+        feature_store.set_precision(precision)
+        print("my precision is",precision)
+    if(header == "precision_tol"):
+        precision_tol = float(value)
+        print("my precision tolerance is",precision_tol)
+    if(header == "corr_threshold"):
+        corr_threshold = float(value)
+        print("my correlation threshold is",corr_threshold)
+    if(header == "flux_window"):
+        flux_window = int(value)
+        print("my fluctuation window is",flux_window)
+    if(header == "max_jobs"):
+        max_jobs = int(value)
+        print("my max concurrent jobs is",max_jobs)
     #if(header == "variants"):
     #    var_anal = value
     #    print("run variant dynamics is",var_anal)
@@ -180,6 +210,15 @@ def feature_vector_ortho():
     if not os.path.exists('features/feature_sub_ortho_reduced'):
         os.makedirs('features/feature_sub_ortho_reduced')  
         
+    ##############################################################
+    ###### subsample correlation features                  ######
+    ##############################################################
+    # one process pool over the subsamples (chunks of subsamples per worker)
+    corr_jobs = {}
+    corr_jobs["ortho"] = [("./subsamples/atomcorr_ortho_matrix/corr_%s_sub_ortho_matrix_%s.txt" % (PDB_id_ortho, i), "./features/feature_sub_ortho/feature_%s_sub_ortho_%s.txt" % (PDB_id_ortho, i), corr_threshold, feature_text == "yes", precision) for i in range(subsamples)]
+    print("building subsample correlation features (%s processes)" % scheduler.default_jobs(max_jobs))
+    corr_densities = corr_reduction.build_corr_features(corr_jobs, scheduler.default_jobs(max_jobs))
+    
     #######################################################
     ###### feature vector for whole ortholog MD run #######
     #######################################################
@@ -214,15 +253,13 @@ def feature_vector_ortho():
     #print(feature_all_query)
     df1 = feature_all_query
     writePath = "./features/feature_all_ortho/feature_%s_all_ortho.txt" % PDB_id_ortho
-    with open(writePath, 'w') as f1:
-        dfAsString = df1.to_string(header=False, index=True)
-        f1.write(dfAsString)
+    feature_store.save_features(writePath, df1, feature_text == "yes")
     # create reduced atom correlation matrix (from sparse matrix)
     M = dfcorr_all_query
     #print("Original Matrix:")
     #print(M)
     # create sparse matrix
-    M[np.abs(M) < 0.005] = 0 # plug in zero values if below threshold
+    M[np.abs(M) < corr_threshold] = 0 # plug in zero values if below threshold
     #print("Sparse Matrix:")
     #print(M)
     svd =  TruncatedSVD(n_components = setSize)
@@ -244,9 +281,7 @@ def feature_vector_ortho():
     
     df2 = feature_all_query_reduced
     writePath = "./features/feature_all_query_reduced/feature_%s_all_query.txt" % PDB_id_query
-    with open(writePath, 'w') as f2:
-        dfAsString = df2.to_string(header=False, index=True)
-        f2.write(dfAsString)
+    feature_store.save_features(writePath, df2, feature_text == "yes")
     print("feature vector (whole ortholog MD run) = reduced atom corr features:")
     print(feature_all_query_reduced)
         
@@ -254,87 +289,29 @@ def feature_vector_ortho():
     ###### feature vectors for subsampled query MD runs     ######
     ##############################################################
     
-    for i in range(subsamples):
-        print("creating reduced feature vector for subsample %s MD ortholog run" % i)
-        influx_sub_query = "./subsamples/atomflux_ortho/fluct_%s_sub_ortho.txt" % PDB_id_ortho 
-        incorr_sub_query = "./subsamples/atomcorr_ortho_matrix/corr_%s_sub_ortho_matrix_%s.txt" % (PDB_id_ortho, i)    
-        dfflux_sub_query = pd.read_csv(influx_sub_query, sep="\s+")
-        dfcorr_sub_query = pd.read_csv(incorr_sub_query, sep="\s+", header=None)
-        del dfflux_sub_query[dfflux_sub_query.columns[0]] # remove first column
-        #del dfflux_sub_query[dfflux_sub_query.columns[0]] # remove next column
-        # iterate over atom flux columns 
-        column = dfflux_sub_query.columns[i]
-        #print(column)
-        # normalize atom fluctuations (minmax method)
-        dfflux_sub_query[column] = (dfflux_sub_query[column] - dfflux_sub_query[column].min()) / (dfflux_sub_query[column].max() - dfflux_sub_query[column].min())
-        #dfflux_sub_query[column] = dfflux_sub_query[column] # option skip normalization
-        myColumn = dfflux_sub_query[column]
-        myColumn = pd.DataFrame(myColumn)
-        #print(myColumn)
-        #dfflux_sub_query = dfflux_sub_query[column]
-        # trim uneccessary columns
-        del dfcorr_sub_query[dfcorr_sub_query.columns[0]] # remove first column
-        del dfcorr_sub_query[dfcorr_sub_query.columns[-1]] # remove last column = NaN
-        #print(dfflux_sub_query)
-        #print(dfcorr_sub_query)
-        
-        ### option to combine flux and corr ###
-        #frames_sub_query = [myColumn, dfcorr_sub_query]
-        #feature_sub_query = pd.concat(frames_sub_query, axis = 1, join="inner")
-        
-        ### option to include only corr ###
-        feature_sub_query = dfcorr_sub_query
-        
-        #print(dfflux_sub_query)
-        #print(dfcorr_sub_query)
-        #print(feature_sub_query)
-        df1 = feature_sub_query
-        writePath = "./features/feature_sub_ortho/feature_%s_sub_ortho_%s.txt" % (PDB_id_ortho, i)
-        with open(writePath, 'w') as f1:
-            dfAsString = df1.to_string(header=False, index=True)
-            f1.write(dfAsString)
-        # create reduced atom correlation matrix (from sparse matrix)
-        M = dfcorr_sub_query
-        #print("Original Matrix:")
-        #print(M)
-        # create sparse matrix
-        M[np.abs(M) < 0.005] = 0 # plug in zero values if below threshold
-        #print("Sparse Matrix:")
-        #print(M)
-        ##################################################################################################
-        #### tune size of truncation of SVD to capture 80% of variance explained by site correlations ####
-        ##################################################################################################
-        if (i == 0):
-            ratio = 0.9
-            setSize = int(ratio*length_prot)
-            #print(setSize)
-            svd =  TruncatedSVD(n_components = setSize)
-            M_transf = svd.fit_transform(M)
-            tve = svd.explained_variance_ratio_.sum()
-            while (tve >= 0.8 and setSize >= 5):
-                setSize = int(ratio*length_prot)
-                #print(setSize)
-                svd =  TruncatedSVD(n_components = setSize)
-                M_transf = svd.fit_transform(M)
-                #print(svd.explained_variance_ratio_.sum())
-                tve = svd.explained_variance_ratio_.sum()
-                #print(tve)
-                ratio = ratio-0.02
-            print("determine reduced feature vector size")
-            print(setSize)
-        ##################################################################################################
-        
-        svd =  TruncatedSVD(n_components = setSize)
-        M_transf = svd.fit_transform(M)
+    densities = corr_densities["ortho"]  # fraction of correlations kept, per subsample
+    ##################################################################################################
+    #### tune size of truncation of SVD to capture 80% of variance explained by site correlations ####
+    ##################################################################################################
+    # one SVD spectrum on subsample 0; the choice is cached with the state's features
+    setSize, tve = corr_reduction.tuned_components("./features/feature_sub_ortho/feature_%s_sub_ortho_%s.txt" % (PDB_id_ortho, 0), length_prot, corr_threshold)
+    print("determine reduced feature vector size")
+    print(setSize)
+    ##################################################################################################
+    
+    corr_reduction.density_report("ortho", densities, corr_threshold)
+    # all subsample matrices of the state in batched randomized SVD passes
+    sub_files = ["./features/feature_sub_ortho/feature_%s_sub_ortho_%s.txt" % (PDB_id_ortho, i) for i in range(subsamples)]
+    for (i, M_transf, singular_values, variance_ratio) in corr_reduction.reduce_feature_files(sub_files, setSize, scheduler.default_jobs(max_jobs), corr_threshold, check_tol=precision_tol):
         if (i == 0):
             print("singular values")
-            print(svd.singular_values_)
+            print(singular_values)
             print("explained variance ratio")
-            print(svd.explained_variance_ratio_)
+            print(variance_ratio)
             print("total variance explained")
-            print(svd.explained_variance_ratio_.sum())
+            print(variance_ratio.sum())
         #print("Singular values:")
-        #print(svd.singular_values_)
+        #print(singular_values)
         #print("Transformed Matrix after reducing to 5 features:")
         #print(M_transf)
         M_transf = pd.DataFrame(M_transf)
@@ -351,9 +328,7 @@ def feature_vector_ortho():
         df2 = feature_sub_query_reduced
         
         writePath = "./features/feature_sub_ortho_reduced/feature_%s_sub_ortho_%s.txt" % (PDB_id_ortho, i)
-        with open(writePath, 'w') as f2:
-            dfAsString = df2.to_string(header=False, index=True)
-            f2.write(dfAsString)
+        feature_store.save_features(writePath, df2, feature_text == "yes")
         #print("feature vector(subsampled reference MD run %s) = atom fluct + 5 reduced atom corr features:" % i)
         #print(feature_sub_ref_reduced) 
 
@@ -365,72 +340,19 @@ def feature_vector_ortho():
     if not os.path.exists('features/featureCOMBINE_sub_ortho'):
         os.makedirs('features/featureCOMBINE_sub_ortho')     
             
+    # neighbor windows and combined vectors of all subsamples of a state at once
+    influx_sub_ortho = "./subsamples/atomflux_ortho/fluct_%s_sub_ortho.txt" % PDB_id_ortho
+    featureFLUX_sub_ortho, featureCOMBINE_sub_ortho = flux_features.state_features(influx_sub_ortho, "./features/feature_sub_ortho_reduced/feature_%s_sub_ortho_%%s.txt" % PDB_id_ortho, subsamples, length_prot, flux_window)
     for i in range(subsamples):
         ############ ortholog protein  ##########################
         print("creating fluctuation feature vector for subsample %s MD ortholog run" % i)
-        influx_sub_ortho = "./subsamples/atomflux_ortho/fluct_%s_sub_ortho.txt" % PDB_id_ortho 
-        dfflux_sub_ortho = pd.read_csv(influx_sub_ortho, sep="\s+")
-        del dfflux_sub_ortho[dfflux_sub_ortho.columns[0]] # remove first column
-        #del dfflux_sub_ortho[dfflux_sub_ortho.columns[0]] # remove next column
-        # iterate over atom flux columns 
-        column = dfflux_sub_ortho.columns[i]
-        #print(column)
-        # normalize atom fluctuations (minmax method)
-        dfflux_sub_ortho[column] = (dfflux_sub_ortho[column] - dfflux_sub_ortho[column].min()) / (dfflux_sub_ortho[column].max() - dfflux_sub_ortho[column].min())
-        #dfflux_sub_ortho[column] = dfflux_sub_ortho[column] # option skip normalization
-        dfflux_sub_ortho = dfflux_sub_ortho[column]
-        #print(dfflux_sub_ortho)
-        # collect adjacent flux values from nearby residues
-        featureMatrix = []
-        for j in range(length_prot):
-            if(j-2 in range(0, length_prot-1)):
-                my_minus2 = dfflux_sub_ortho[j-2]
-            else:
-                my_minus2 = dfflux_sub_ortho[j]
-            #print(my_minus2)
-            if(j-1 in range(0, length_prot)):
-                my_minus1 = dfflux_sub_ortho[j-1]
-            else:
-                my_minus1 = dfflux_sub_ortho[j]
-            #print(my_minus1)
-            if(j in range(0, length_prot)):
-                my_plus0 = dfflux_sub_ortho[j]
-            else:
-                my_plus0 = 0
-            #print(my_plus0)
-            if(j+1 in range(0, length_prot)):
-                my_plus1 = dfflux_sub_ortho[j+1]
-            else:
-                my_plus1 = dfflux_sub_ortho[j]
-            #print(my_plus1)
-            if(j+2 in range(0, length_prot)):
-                my_plus2 = dfflux_sub_ortho[j+2]
-            else:
-                my_plus2 = dfflux_sub_ortho[j]
-            featureRow = (my_minus2, my_minus1, my_plus0, my_plus1, my_plus2)
-            featureMatrix.append(featureRow)
-        
-        featureMatrix = pd.DataFrame(featureMatrix)
-        #print(featureMatrix)
-        # print fluctuations to file
-        featureFLUX_sub_ortho = featureMatrix
-        df1 = featureFLUX_sub_ortho
+        df1 = featureFLUX_sub_ortho[i]
         writePath = "./features/featureFLUX_sub_ortho/feature_%s_sub_ortho_%s.txt" % (PDB_id_ortho, i)
-        with open(writePath, 'w') as f1:
-            dfAsString = df1.to_string(header=False, index=True)
-            f1.write(dfAsString)
-                
-        #read in reduced correlations and create combined flux+corr feature vector
-        read_corr = "./features/feature_sub_ortho_reduced/feature_%s_sub_ortho_%s.txt" % (PDB_id_ortho, i)    
-        df3 = pd.read_csv(read_corr, sep="\s+", header=None)
-        del df3[df3.columns[0]] # remove first column
-        df3 = df3.iloc[:,:5]  # option take first 5 columns of correlations
-        frames = [df1, df3]
-        df_combined = pd.concat(frames, axis=1, join='inner')
+        feature_store.save_features(writePath, df1, feature_text == "yes")
+        #combined flux+corr feature vector
+        df_combined = featureCOMBINE_sub_ortho[i]
         writePath = "./features/featureCOMBINE_sub_ortho/feature_%s_sub_ortho_%s.txt" % (PDB_id_ortho, i)
-        with open(writePath, 'w') as f3:
-            dfAsString = df_combined.to_string(header=False, index=True)
-            f3.write(dfAsString)
+        feature_store.save_features(writePath, df_combined, feature_text == "yes")
 
 
 def conserved_dynamics_analysis():
@@ -447,67 +369,18 @@ def conserved_dynamics_analysisOLD():
     learn_profile_neutral = []
     learn_profile_matrix = []
     
+    # site-major (sites x subsamples x features) feature tensors: one slice per site
+    site_reference = feature_store.site_tensor("./features/featureFLUX_sub_ref/feature_%s_sub_ref_%%s.txt" % PDB_id_reference, subsamples)
+    site_referenceCTL = feature_store.site_tensor("./features/featureFLUX_sub_refCTL/feature_%s_sub_refCTL_%%s.txt" % PDB_id_reference, subsamples)
+    site_query = feature_store.site_tensor("./features/featureFLUX_sub_query/feature_%s_sub_query_%%s.txt" % PDB_id_query, subsamples)
+    site_ortho = feature_store.site_tensor("./features/featureFLUX_sub_ortho/feature_%s_sub_ortho_%%s.txt" % PDB_id_ortho, subsamples)
     for i in range(length_prot-1): # loop over sites
         # initiatize arrays
-        feature_reference = []
-        feature_referenceCTL = []
-        feature_query = []
-        feature_ortho = []
-                
-        for j in range(subsamples): # loop over subsamples
-            samp = j+1
-            print("collecting subsample %s" % samp)
-            ######## reference protein ###########
-            #infeature_reference = "./feature_sub_ref_reduced/feature_%s_sub_ref_%s.txt" % (PDB_id_reference, j)
-            infeature_reference = "./featureFLUX_sub_ref/feature_%s_sub_ref_%s.txt" % (PDB_id_reference, j)
-            #infeature_reference = "./featureCOMBINE_sub_ref/feature_%s_sub_ref_%s.txt" % (PDB_id_reference, j)
-            df_feature_reference = pd.read_csv(infeature_reference, sep="\s+")
-            #print(df_feature_reference)
-            del df_feature_reference[df_feature_reference.columns[0]] # remove first column
-            #print(df_feature_reference)
-            sample_feature_reference = df_feature_reference.iloc[i]
-            sample_feature_reference = np.array(sample_feature_reference)
-            #print(sample_feature_reference)
-            feature_reference.append(sample_feature_reference)
-            ######## reference control protein #####
-            #infeature_referenceCTL = "./feature_sub_refCTL_reduced/feature_%s_sub_refCTL_%s.txt" % (PDB_id_reference, j)
-            infeature_referenceCTL = "./featureFLUX_sub_refCTL/feature_%s_sub_refCTL_%s.txt" % (PDB_id_reference, j)
-            #infeature_referenceCTL = "./featureCOMBINE_sub_refCTL/feature_%s_sub_refCTL_%s.txt" % (PDB_id_reference, j)
-            df_feature_referenceCTL = pd.read_csv(infeature_referenceCTL, sep="\s+")
-            #print(df_feature_referenceCTL)
-            del df_feature_referenceCTL[df_feature_referenceCTL.columns[0]] # remove first column
-            #print(df_feature_referenceCTL)
-            sample_feature_referenceCTL = df_feature_referenceCTL.iloc[i]
-            sample_feature_referenceCTL = np.array(sample_feature_referenceCTL)
-            #print(sample_feature_referenceCTL)
-            feature_referenceCTL.append(sample_feature_referenceCTL)
-            ######### query protein #########
-            #infeature_query = "./feature_sub_query_reduced/feature_%s_sub_query_%s.txt" % (PDB_id_query, j)
-            infeature_query = "./featureFLUX_sub_query/feature_%s_sub_query_%s.txt" % (PDB_id_query, j)
-            #infeature_query = "./featureCOMBINE_sub_query/feature_%s_sub_query_%s.txt" % (PDB_id_query, j)
-            df_feature_query = pd.read_csv(infeature_query, sep="\s+")
-            #print(df_feature_query)
-            del df_feature_query[df_feature_query.columns[0]] # remove first column
-            #print(df_feature_query)
-            sample_feature_query = df_feature_query.iloc[i]
-            sample_feature_query= np.array(sample_feature_query)
-            #print(sample_feature_query)
-            feature_query.append(sample_feature_query)
-            
-            ######## ortholog protein ###########
-            #infeature_ortho = "./feature_sub_ortho_reduced/feature_%s_sub_ortho_%s.txt" % (PDB_id_ortho, j)
-            infeature_ortho = "./featureFLUX_sub_ortho/feature_%s_sub_ortho_%s.txt" % (PDB_id_ortho, j)
-            #infeature_ortho = "./featureCOMBINE_sub_ortho/feature_%s_sub_ortho_%s.txt" % (PDB_id_ortho, j)
-            df_feature_ortho = pd.read_csv(infeature_ortho, sep="\s+")
-            #print(df_feature_ortho)
-            del df_feature_ortho[df_feature_ortho.columns[0]] # remove first column
-            #print(df_feature_ortho)
-            sample_feature_ortho = df_feature_ortho.iloc[i]
-            sample_feature_ortho = np.array(sample_feature_ortho)
-            #print(sample_feature_ortho)
-            feature_ortho.append(sample_feature_ortho)
-            
-    
+        feature_reference = list(np.array(site_reference[i]))
+        feature_referenceCTL = list(np.array(site_referenceCTL[i]))
+        feature_query = list(np.array(site_query[i]))
+        feature_ortho = list(np.array(site_ortho[i]))
+
         print("calculating and bootstrapping conserved dynamics identification for site %s" % i)     
         #print(feature_reference)
         #print(feature_query)
@@ -523,13 +396,13 @@ def conserved_dynamics_analysisOLD():
         
         
         # create conbined matrix query and ref
-        frames = [df_feature_reference, df_feature_query]
+        frames = [df_feature_ref, df_feature_query]
         df_feature_train = pd.concat(frames, axis=1, join="inner", ignore_index=True, sort=False)
         df_feature_train = df_feature_train.transpose()
         #print(df_feature_train)
         
         # create conbined matrix ref and ref control
-        frames = [df_feature_reference, df_feature_refCTL]
+        frames = [df_feature_ref, df_feature_refCTL]
         df_feature_train_neutral = pd.concat(frames, axis=1, join="inner", ignore_index=True, sort=False)
         df_feature_train_neutral = df_feature_train_neutral.transpose()
         #print(df_feature_train_neutral)
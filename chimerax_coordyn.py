@@ -28,15 +28,36 @@ import re
 # for ggplot
 import pandas as pd
 import numpy as np
+import feature_store
+import corr_reduction
+import rff_features
+import flux_features
 import scipy as sp
 from pandas.api.types import CategoricalDtype
 from plotnine import *
+from cpptraj_windows import plan_windows
+import cpptraj_scheduler as scheduler
+from atomcorr_matrix import convert_corr_files
+from progress_monitor import ProgressMonitor
 #from plotnine.data import mpg
 
 
 
 ################################################################################
 # READ CONTROL FORM
+# optional settings (defaults used when DROIDS.ctl has no such line)
+plan_seed = None  # seed of the subsample window plan; None = keep saved plan or draw a new seed
+average_cache = "no"  # yes = load the cached MyAvg_*.rst7 average structure instead of rebuilding it
+matrix_binary = "no"  # yes = also save every correlation matrix as a .npy array
+max_jobs = 0  # processes for the matrix conversion and batched SVD; 0 = one per core
+feature_text = "no"  # yes = also write every feature matrix as text (DataFrame.to_string layout)
+precision = "float64"  # float32 = store and reduce every feature matrix in single precision
+precision_tol = 1e-3  # float32: largest accepted deviation from a float64 recomputation
+corr_threshold = 0.005  # residue correlations weaker than this are dropped (sparse storage) before the SVD
+flux_window = 5  # sites per fluctuation feature vector (odd; the site and its sequence neighbors)
+rff_classifier = "no"  # yes = linear classifier on random Fourier features in place of the rbf kernel classifier
+rff_components = 500  # rff_classifier: dimension of the random Fourier feature embedding
+rff_seed = 0  # rff_classifier: seed of the random frequencies
 # read ChimeraX visualization ctl file
 infile = open("DROIDS.ctl", "r")
 infile_lines = infile.readlines()
@@ -105,9 +126,46 @@ for x in range(len(infile_lines)):
     if(header == "coordination"):
         coord_anal = value
         print("run coordinated dynamics is",coord_anal)
+    if(header == "feature_text"):
+        feature_text = value.strip()
+        print("my feature text export is",feature_text)
+    if(header == "precision"):
+        precision = value.strip()
+        feature_store.set_precision(precision)
+        print("my precision is",precision)
+    if(header == "precision_tol"):
+        precision_tol = float(value)
+        print("my precision tolerance is",precision_tol)
+    if(header == "corr_threshold"):
+        corr_threshold = float(value)
+        print("my correlation threshold is",corr_threshold)
+    if(header == "flux_window"):
+        flux_window = int(value)
+        print("my fluctuation window is",flux_window)
+    if(header == "rff_classifier"):
+        rff_classifier = value.strip()
+        print("my random Fourier feature classifier is",rff_classifier)
+    if(header == "rff_components"):
+        rff_components = int(value)
+        print("my random Fourier features are",rff_components)
+    if(header == "rff_seed"):
+        rff_seed = int(value)
+        print("my random Fourier feature seed is",rff_seed)
     #if(header == "variants"):
     #    var_anal = value
     #    print("run variant dynamics is",var_anal)
+    if(header == "seed"):
+        plan_seed = value.strip()
+        print("my window plan seed is",plan_seed)
+    if(header == "average_cache"):
+        average_cache = value.strip()
+        print("my cached average structure is",average_cache)
+    if(header == "matrix_binary"):
+        matrix_binary = value.strip()
+        print("my binary correlation matrices is",matrix_binary)
+    if(header == "max_jobs"):
+        max_jobs = int(value)
+        print("my max concurrent jobs is",max_jobs)
 ###### variable assignments ######
 PDB_id_query = ""+query_id+""
 PDB_id_reference = ""+ref_id+""
@@ -135,11 +193,9 @@ coord_anal = ""+coord_anal+""
 ###############################################################################
 # set number of features for tuning gamma in RBF kernel
 infeature_ref = "./features/featureFLUX_sub_ref/feature_%s_sub_ref_0.txt" % PDB_id_reference
-df_feature_ref = pd.read_csv(infeature_ref, sep="\s+")
-n_features_flux = df_feature_ref.shape[1] - 1
+n_features_flux = feature_store.feature_shape(infeature_ref)[1]
 infeature_ref = "./features/feature_sub_ref_reduced/feature_%s_sub_ref_0.txt" % PDB_id_reference
-df_feature_ref = pd.read_csv(infeature_ref, sep="\s+")
-n_features_corr = df_feature_ref.shape[1] - 1      
+n_features_corr = feature_store.feature_shape(infeature_ref)[1]      
 
 n_bootstrap = subsamples*5
 if(n_bootstrap > 500):
@@ -147,7 +203,12 @@ if(n_bootstrap > 500):
 if(n_bootstrap < 50):
     n_bootstrap = 50
 
-setSize = int(0.2*length_prot)  # initiate set size of reduced feature vector
+# reduce queryLG correlations to as many components as the analyzer chose for the reference
+setSize = corr_reduction.cached_components("./features/feature_sub_ref/feature_%s_sub_ref_0.txt" % PDB_id_reference)
+if(setSize is None):
+    setSize = int(0.2*length_prot)  # initiate set size of reduced feature vector
+print('n features (reduced correlations of queryLG)')
+print(setSize)
 
 print('n features (fluctuations)')
 print(n_features_flux)
@@ -159,6 +220,12 @@ print(n_features_comb)
 print('n bootstrap')
 print(n_bootstrap)
 
+def cached_average(traj_file):
+    # None makes the ctl rebuild MyAvg itself
+    if(average_cache == "yes"):
+        return scheduler.average_file(traj_file)
+    return None
+
 def deployment_sampling_ctl():
     print("sampling protein query state for deployment of Gaussian kernel classifier (GPC)")
     ################# query protein ############################
@@ -183,9 +250,7 @@ def deployment_sampling_ctl():
     f = open("./atomflux_%s_all_queryLG.ctl" % PDB_id_query, "w")
     f.write("parm %s\n" % top_file_query)
     f.write("trajin %s\n" % traj_file_query)
-    f.write("rms first\n")
-    f.write("average crdset MyAvg\n")
-    f.write("run\n")
+    scheduler.write_average_setup(f, cached_average(traj_file_query))
     f.write("rms ref MyAvg\n")
     f.write("atomicfluct out fluct_%s_all_queryLG.txt @CA,C,O,N&!(:WAT) byres\n" % PDB_id_query)
     f.write("run\n")
@@ -194,9 +259,7 @@ def deployment_sampling_ctl():
     f = open("./atomcorr_%s_all_queryLG.ctl" % PDB_id_query, "w") 
     f.write("parm %s\n" % top_file_query)
     f.write("trajin %s\n" % traj_file_query)
-    f.write("rms first\n")
-    f.write("average crdset MyAvg\n")
-    f.write("run\n")
+    scheduler.write_average_setup(f, cached_average(traj_file_query))
     f.write("rms ref MyAvg\n")
     f.write("atomiccorr out corr_%s_all_queryLG.txt @CA,C,O,N&!(:WAT) byres\n" % PDB_id_query)
     f.write("run\n")
@@ -207,25 +270,30 @@ def deployment_sampling_ctl():
     f2 = open("./atomcorr_%s_sub_queryLG.ctl" % PDB_id_query, "w")
     f1.write("parm %s\n" % top_file_query)
     f1.write("trajin %s\n"% traj_file_query)
-    f1.write("rms first\n")
-    f1.write("average crdset MyAvg\n")
-    f1.write("run\n")
+    scheduler.write_average_setup(f1, cached_average(traj_file_query))
     f2.write("parm %s\n" % top_file_query)
     f2.write("trajin %s\n"% traj_file_query)
+    windows = plan_windows("queryLG", n_bootstrap, n_frames, frame_size, traj_file_query, plan_seed)
     for x in range(n_bootstrap):
-        upper_limit = n_frames-frame_size
-        start = rnd.randint(1, upper_limit)
-        stop = start+frame_size
+        (start, stop) = windows[x]
         f1.write("rms ref MyAvg\n")
         f1.write("atomicfluct out fluct_%s_sub_queryLG.txt @CA,C,O,N&!(:WAT) byres start %s stop %s\n" % (PDB_id_query, start, stop))
         f1.write("run\n")
+        f2.write("clear trajin\n")  # each window on its own, not added to the earlier ones
         f2.write("trajin %s %s %s\n"% (traj_file_query, start, stop))
         f2.write("atomiccorr out ./subsamples/atomcorr_queryLG/corr_%s_sub_queryLG_%s.txt @CA,C,O,N&!(:WAT) byres\n" % (PDB_id_query, x))
         f2.write("run\n")
     f1.close()
     f2.close()
+    # the sampler normally left the cached average of the query trajectory behind
+    if(average_cache == "yes" and not os.path.exists(scheduler.average_file(traj_file_query))):
+        if not scheduler.run_job(scheduler.average_job(top_file_query, traj_file_query)):
+            print("ERROR: averaging %s failed" % traj_file_query)
+            sys.exit(1)
 #####################################################
 
+monitor = None  # progress of the subsampling threads, set in main
+
 def subsample_queryLG_flux():
     print("collecting atom information")
     cmd = "cpptraj -i atominfo_%s_query.ctl -o info_%s_out_query.txt" % (PDB_id_query,PDB_id_query)
@@ -239,8 +307,8 @@ def subsample_queryLG_flux():
     os.system(cmd)
     print("subsampling queryLG protein fluctuations")
     print("NOTE: may take many minutes depending upon N subsamples & frames per subsample")
-    cmd = "cpptraj -i atomflux_%s_sub_queryLG.ctl -o fluct_%s_out_sub_queryLG.txt" % (PDB_id_query,PDB_id_query)
-    os.system(cmd)
+    cmd = "cpptraj -i atomflux_%s_sub_queryLG.ctl" % PDB_id_query
+    scheduler.run_counted(cmd, "fluct_%s_out_sub_queryLG.txt" % PDB_id_query, monitor, "queryLG flux", 0 if(cached_average(traj_file_query) is not None) else 1, n_bootstrap)
     print("copying atom flux files to atomflux folder")
     os.system('cp fluct_%s_sub_queryLG.txt ./subsamples/atomflux_queryLG/fluct_%s_sub_queryLG.txt' % (PDB_id_query, PDB_id_query))
 
@@ -254,8 +322,8 @@ def subsample_queryLG_corr():
     os.system(cmd)
     print("subsampling queryLG protein correlations")
     print("NOTE: may take many minutes depending upon N subsamples & frames per subsample")
-    cmd = "cpptraj -i atomcorr_%s_sub_queryLG.ctl -o corr_%s_out_sub_queryLG.txt" % (PDB_id_query,PDB_id_query)
-    os.system(cmd)
+    cmd = "cpptraj -i atomcorr_%s_sub_queryLG.ctl" % PDB_id_query
+    scheduler.run_counted(cmd, "corr_%s_out_sub_queryLG.txt" % PDB_id_query, monitor, "queryLG corr", 0, n_bootstrap)
 
 #####################################################
 #####################################################
@@ -342,6 +410,14 @@ def matrix_maker_batch_old_queryLG():
                 pos_counter = pos_counter+1
             
 
+def matrix_maker_parallel_queryLG():
+    # same matrix files as matrix_maker_old_queryLG/matrix_maker_batch_old_queryLG, parsed in bulk on a process pool
+    print("converting atomiccorr output to matrix (queryLG protein, %s processes)" % scheduler.default_jobs(max_jobs))
+    pairs = [("./corr_%s_all_queryLG.txt" % PDB_id_query, "./corr_%s_all_queryLG_matrix.txt" % PDB_id_query)]
+    for i in range(n_bootstrap):
+        pairs.append(("./subsamples/atomcorr_queryLG/corr_%s_sub_queryLG_%s.txt" % (PDB_id_query, i), "./subsamples/atomcorr_queryLG_matrix/corr_%s_sub_queryLG_matrix_%s.txt" % (PDB_id_query, i)))
+    convert_corr_files(pairs, length_prot, matrix_binary == "yes", scheduler.default_jobs(max_jobs), precision)
+
 def matrix_maker_new_queryLG():
     print("converting atomiccorr output to matrix (queryLG protein)")
     f_in = open("./corr_%s_all_queryLG.txt" % PDB_id_query, "r")
@@ -401,6 +477,15 @@ def feature_deploy():
     if not os.path.exists('features/feature_sub_queryLG_reduced'):
         os.makedirs('features/feature_sub_queryLG_reduced')  
     
+    ##############################################################
+    ###### subsample correlation features                  ######
+    ##############################################################
+    # one process pool over the subsamples (chunks of subsamples per worker)
+    corr_jobs = {}
+    corr_jobs["queryLG"] = [("./subsamples/atomcorr_queryLG_matrix/corr_%s_sub_queryLG_matrix_%s.txt" % (PDB_id_query, i), "./features/feature_sub_queryLG/feature_%s_sub_queryLG_%s.txt" % (PDB_id_query, i), corr_threshold, feature_text == "yes", precision) for i in range(n_bootstrap)]
+    print("building subsample correlation features (%s processes)" % scheduler.default_jobs(max_jobs))
+    corr_densities = corr_reduction.build_corr_features(corr_jobs, scheduler.default_jobs(max_jobs))
+    
     #######################################################
     ###### feature vector for whole query MD run ##########
     #######################################################
@@ -435,15 +520,13 @@ def feature_deploy():
     #print(feature_all_query)
     df1 = feature_all_query
     writePath = "./features/feature_all_queryLG/feature_%s_all_queryLG.txt" % PDB_id_query
-    with open(writePath, 'w') as f1:
-        dfAsString = df1.to_string(header=False, index=True)
-        f1.write(dfAsString)
+    feature_store.save_features(writePath, df1, feature_text == "yes")
     # create reduced atom correlation matrix (from sparse matrix)
     M = dfcorr_all_query
     #print("Original Matrix:")
     #print(M)
     # create sparse matrix
-    M[np.abs(M) < 0.005] = 0 # plug in zero values if below threshold
+    M[np.abs(M) < corr_threshold] = 0 # plug in zero values if below threshold
     #print("Sparse Matrix:")
     #print(M)
     svd =  TruncatedSVD(n_components = setSize)
@@ -465,9 +548,7 @@ def feature_deploy():
     
     df2 = feature_all_query_reduced
     writePath = "./features/feature_all_queryLG_reduced/feature_%s_all_queryLG.txt" % PDB_id_query
-    with open(writePath, 'w') as f2:
-        dfAsString = df2.to_string(header=False, index=True)
-        f2.write(dfAsString)
+    feature_store.save_features(writePath, df2, feature_text == "yes")
     print("feature vector (whole query MD run) = reduced atom corr features:")
     print(feature_all_query_reduced)
         
@@ -475,87 +556,21 @@ def feature_deploy():
     ###### feature vectors for subsampled query MD runs     ######
     ##############################################################
     
-    for i in range(n_bootstrap):
-        print("creating reduced feature vector for subsample %s MD queryLG run" % i)
-        influx_sub_query = "./subsamples/atomflux_queryLG/fluct_%s_sub_queryLG.txt" % PDB_id_query 
-        incorr_sub_query = "./subsamples/atomcorr_queryLG_matrix/corr_%s_sub_queryLG_matrix_%s.txt" % (PDB_id_query, i)    
-        dfflux_sub_query = pd.read_csv(influx_sub_query, sep="\s+")
-        dfcorr_sub_query = pd.read_csv(incorr_sub_query, sep="\s+", header=None)
-        del dfflux_sub_query[dfflux_sub_query.columns[0]] # remove first column
-        #del dfflux_sub_query[dfflux_sub_query.columns[0]] # remove next column
-        # iterate over atom flux columns 
-        column = dfflux_sub_query.columns[i]
-        #print(column)
-        # normalize atom fluctuations (minmax method)
-        dfflux_sub_query[column] = (dfflux_sub_query[column] - dfflux_sub_query[column].min()) / (dfflux_sub_query[column].max() - dfflux_sub_query[column].min())
-        #dfflux_sub_query[column] = dfflux_sub_query[column] # option skip normalization
-        myColumn = dfflux_sub_query[column]
-        myColumn = pd.DataFrame(myColumn)
-        #print(myColumn)
-        #dfflux_sub_query = dfflux_sub_query[column]
-        # trim uneccessary columns
-        del dfcorr_sub_query[dfcorr_sub_query.columns[0]] # remove first column
-        del dfcorr_sub_query[dfcorr_sub_query.columns[-1]] # remove last column = NaN
-        #print(dfflux_sub_query)
-        #print(dfcorr_sub_query)
-        
-        ### option to combine flux and corr ###
-        #frames_sub_query = [myColumn, dfcorr_sub_query]
-        #feature_sub_query = pd.concat(frames_sub_query, axis = 1, join="inner")
-        
-        ### option to include only corr ###
-        feature_sub_query = dfcorr_sub_query
-        
-        #print(dfflux_sub_query)
-        #print(dfcorr_sub_query)
-        #print(feature_sub_query)
-        df1 = feature_sub_query
-        writePath = "./features/feature_sub_queryLG/feature_%s_sub_queryLG_%s.txt" % (PDB_id_query, i)
-        with open(writePath, 'w') as f1:
-            dfAsString = df1.to_string(header=False, index=True)
-            f1.write(dfAsString)
-        # create reduced atom correlation matrix (from sparse matrix)
-        M = dfcorr_sub_query
-        #print("Original Matrix:")
-        #print(M)
-        # create sparse matrix
-        M[np.abs(M) < 0.005] = 0 # plug in zero values if below threshold
-        #print("Sparse Matrix:")
-        #print(M)
-        ##################################################################################################
-        #### tune size of truncation of SVD to capture 80% of variance explained by site correlations ####
-        ##################################################################################################
-        #if (i == 0):
-        #   ratio = 0.9
-        #    setSize = int(ratio*length_prot)
-        #    #print(setSize)
-        #    svd =  TruncatedSVD(n_components = setSize)
-        #    M_transf = svd.fit_transform(M)
-        #    tve = svd.explained_variance_ratio_.sum()
-        #    while (tve >= 0.8 and setSize >= 5):
-        #       setSize = int(ratio*length_prot)
-        #        #print(setSize)
-        #        svd =  TruncatedSVD(n_components = setSize)
-        #        M_transf = svd.fit_transform(M)
-        #        #print(svd.explained_variance_ratio_.sum())
-        #        tve = svd.explained_variance_ratio_.sum()
-        #        #print(tve)
-        #        ratio = ratio-0.02
-        #    print("determine reduced feature vector size")
-        #    print(setSize)
-        ##################################################################################################
-        
-        svd =  TruncatedSVD(n_components = setSize)
-        M_transf = svd.fit_transform(M)
+    densities = corr_densities["queryLG"]  # fraction of correlations kept, per subsample
+    
+    corr_reduction.density_report("queryLG", densities, corr_threshold)
+    # all subsample matrices of the state in batched randomized SVD passes
+    sub_files = ["./features/feature_sub_queryLG/feature_%s_sub_queryLG_%s.txt" % (PDB_id_query, i) for i in range(n_bootstrap)]
+    for (i, M_transf, singular_values, variance_ratio) in corr_reduction.reduce_feature_files(sub_files, setSize, scheduler.default_jobs(max_jobs), corr_threshold, check_tol=precision_tol):
         if (i == 0):
             print("singular values")
-            print(svd.singular_values_)
+            print(singular_values)
             print("explained variance ratio")
-            print(svd.explained_variance_ratio_)
+            print(variance_ratio)
             print("total variance explained")
-            print(svd.explained_variance_ratio_.sum())
+            print(variance_ratio.sum())
         #print("Singular values:")
-        #print(svd.singular_values_)
+        #print(singular_values)
         #print("Transformed Matrix after reducing to 5 features:")
         #print(M_transf)
         M_transf = pd.DataFrame(M_transf)
@@ -571,9 +586,7 @@ def feature_deploy():
         
         df2 = feature_sub_query_reduced
         writePath = "./features/feature_sub_queryLG_reduced/feature_%s_sub_queryLG_%s.txt" % (PDB_id_query, i)
-        with open(writePath, 'w') as f2:
-            dfAsString = df2.to_string(header=False, index=True)
-            f2.write(dfAsString)
+        feature_store.save_features(writePath, df2, feature_text == "yes")
         #print("feature vector(subsampled reference MD run %s) = atom fluct + 5 reduced atom corr features:" % i)
         #print(feature_sub_ref_reduced) 
     
@@ -588,72 +601,20 @@ def feature_deploy():
         os.makedirs('features/featureCOMBINE_sub_queryLG')  
        
     
+    # neighbor windows and combined vectors of all subsamples of a state at once
+    influx_sub_query = "./subsamples/atomflux_queryLG/fluct_%s_sub_queryLG.txt" % PDB_id_query
+    featureFLUX_sub_query, featureCOMBINE_sub_query = flux_features.state_features(influx_sub_query, "./features/feature_sub_queryLG_reduced/feature_%s_sub_queryLG_%%s.txt" % PDB_id_query, n_bootstrap, length_prot, flux_window)
     for i in range(n_bootstrap):
         
         ############ query protein  ##########################
         print("creating fluctuation feature vector for subsample %s MD queryLG run" % i)
-        influx_sub_query = "./subsamples/atomflux_queryLG/fluct_%s_sub_queryLG.txt" % PDB_id_query 
-        dfflux_sub_query = pd.read_csv(influx_sub_query, sep="\s+")
-        del dfflux_sub_query[dfflux_sub_query.columns[0]] # remove first column
-        #del dfflux_sub_query[dfflux_sub_query.columns[0]] # remove next column
-        # iterate over atom flux columns 
-        column = dfflux_sub_query.columns[i]
-        #print(column)
-        # normalize atom fluctuations (minmax method)
-        dfflux_sub_query[column] = (dfflux_sub_query[column] - dfflux_sub_query[column].min()) / (dfflux_sub_query[column].max() - dfflux_sub_query[column].min())
-        #dfflux_sub_query[column] = dfflux_sub_query[column] # option skip normalization
-        dfflux_sub_query = dfflux_sub_query[column]
-        #print(dfflux_sub_query)
-        # collect adjacent flux values from nearby residues
-        featureMatrix = []
-        for j in range(length_prot):
-            if(j-2 in range(0, length_prot)):
-                my_minus2 = dfflux_sub_query[j-2]
-            else:
-                my_minus2 = dfflux_sub_query[j]
-            #print(my_minus2)
-            if(j-1 in range(0, length_prot)):
-                my_minus1 = dfflux_sub_query[j-1]
-            else:
-                my_minus1 = dfflux_sub_query[j]
-            #print(my_minus1)
-            if(j in range(0, length_prot)):
-                my_plus0 = dfflux_sub_query[j]
-            else:
-                my_plus0 = 0
-            #print(my_plus0)
-            if(j+1 in range(0, length_prot)):
-                my_plus1 = dfflux_sub_query[j+1]
-            else:
-                my_plus1 = dfflux_sub_query[j]
-            #print(my_plus1)
-            if(j+2 in range(0, length_prot)):
-                my_plus2 = dfflux_sub_query[j+2]
-            else:
-                my_plus2 = dfflux_sub_query[j]
-            featureRow = (my_minus2, my_minus1, my_plus0, my_plus1, my_plus2)
-            featureMatrix.append(featureRow)
-        
-        featureMatrix = pd.DataFrame(featureMatrix)
-        #print(featureMatrix)
-        # print to file
-        featureFLUX_sub_query = featureMatrix
-        df1 = featureFLUX_sub_query
+        df1 = featureFLUX_sub_query[i]
         writePath = "./features/featureFLUX_sub_queryLG/feature_%s_sub_queryLG_%s.txt" % (PDB_id_query, i)
-        with open(writePath, 'w') as f1:
-            dfAsString = df1.to_string(header=False, index=True)
-            f1.write(dfAsString)
-        #read in reduced correlations and create combined flux+corr feature vector
-        read_corr = "./features/feature_sub_queryLG_reduced/feature_%s_sub_queryLG_%s.txt" % (PDB_id_query, i)    
-        df3 = pd.read_csv(read_corr, sep="\s+", header=None)
-        del df3[df3.columns[0]] # remove first column
-        df3 = df3.iloc[:,:5]  # option take first 5 columns of correlations
-        frames = [df1, df3]
-        df_combined = pd.concat(frames, axis=1, join='inner')
+        feature_store.save_features(writePath, df1, feature_text == "yes")
+        #combined flux+corr feature vector
+        df_combined = featureCOMBINE_sub_query[i]
         writePath = "./features/featureCOMBINE_sub_queryLG/feature_%s_sub_queryLG_%s.txt" % (PDB_id_query, i)
-        with open(writePath, 'w') as f3:
-            dfAsString = df_combined.to_string(header=False, index=True)
-            f3.write(dfAsString)
+        feature_store.save_features(writePath, df_combined, feature_text == "yes")
         
             
      
@@ -666,72 +627,16 @@ def coordinated_site_matrix():
     learn_profile_obs = []
     learn_profile_matrix = []
     
+    # site-major (sites x subsamples x features) feature tensors: one slice per site
+    site_reference = feature_store.site_tensor("./features/featureCOMBINE_sub_ref/feature_%s_sub_ref_%%s.txt" % PDB_id_reference, subsamples)
+    site_query = feature_store.site_tensor("./features/featureCOMBINE_sub_query/feature_%s_sub_query_%%s.txt" % PDB_id_query, subsamples)
+    site_queryLG = feature_store.site_tensor("./features/featureCOMBINE_sub_queryLG/feature_%s_sub_queryLG_%%s.txt" % PDB_id_query, n_bootstrap)
     for i in range(length_prot-1): # loop over sites
         # initiatize arrays
-        feature_reference = []
-        feature_queryLG = []
-        feature_query = []
-                
-        for j in range(subsamples): # loop over subsamples
-            samp = j+1
-            #print("collecting subsample %s" % samp)
-            
-            ######## reference protein ###########
-            #infeature_reference = "./features/feature_sub_ref_reduced/feature_%s_sub_ref_%s.txt" % (PDB_id_reference, j)
-            #infeature_reference = "./features/featureFLUX_sub_ref/feature_%s_sub_ref_%s.txt" % (PDB_id_reference, j)
-            infeature_reference = "./features/featureCOMBINE_sub_ref/feature_%s_sub_ref_%s.txt" % (PDB_id_reference, j)
-            df_feature_reference = pd.read_csv(infeature_reference, sep="\s+")
-            #print(df_feature_reference)
-            del df_feature_reference[df_feature_reference.columns[0]] # remove first column
-            #print(df_feature_reference)
-            sample_feature_reference = df_feature_reference.iloc[i]
-            sample_feature_reference = np.array(sample_feature_reference)
-            #print(sample_feature_reference)
-            feature_reference.append(sample_feature_reference)
-            
-            ######### reference control protein #####
-            ##infeature_referenceCTL = "./feature_sub_refCTL_reduced/feature_%s_sub_refCTL_%s.txt" % (PDB_id_reference, j)
-            ##infeature_referenceCTL = "./featureFLUX_sub_refCTL/feature_%s_sub_refCTL_%s.txt" % (PDB_id_reference, j)
-            #infeature_referenceCTL = "./features/featureCOMBINE_sub_refCTL/feature_%s_sub_refCTL_%s.txt" % (PDB_id_reference, j)
-            #df_feature_referenceCTL = pd.read_csv(infeature_referenceCTL, sep="\s+")
-            ##print(df_feature_referenceCTL)
-            #del df_feature_referenceCTL[df_feature_referenceCTL.columns[0]] # remove first column
-            ##print(df_feature_referenceCTL)
-            #sample_feature_referenceCTL = df_feature_referenceCTL.iloc[i]
-            #sample_feature_referenceCTL = np.array(sample_feature_referenceCTL)
-            ##print(sample_feature_referenceCTL)
-            #feature_referenceCTL.append(sample_feature_referenceCTL)
-            
-            ######### query protein #########
-            #infeature_query = "./features/feature_sub_query_reduced/feature_%s_sub_query_%s.txt" % (PDB_id_query, j)
-            #infeature_query = "./features/featureFLUX_sub_query/feature_%s_sub_query_%s.txt" % (PDB_id_query, j)
-            infeature_query = "./features/featureCOMBINE_sub_query/feature_%s_sub_query_%s.txt" % (PDB_id_query, j)
-            df_feature_query = pd.read_csv(infeature_query, sep="\s+")
-            #print(df_feature_query)
-            del df_feature_query[df_feature_query.columns[0]] # remove first column
-            #print(df_feature_query)
-            sample_feature_query = df_feature_query.iloc[i]
-            sample_feature_query= np.array(sample_feature_query)
-            #print(sample_feature_query)
-            feature_query.append(sample_feature_query)
-        
-        
-        for k in range(n_bootstrap): # loop over subsamples
-            samp = k+1
-            #print("collecting subsample %s" % samp)   
-            ######### queryLG protein #########
-            #infeature_query = "./features/feature_sub_query_reduced/feature_%s_sub_query_%s.txt" % (PDB_id_query, j)
-            #infeature_query = "./features/featureFLUX_sub_query/feature_%s_sub_query_%s.txt" % (PDB_id_query, j)
-            infeature_query = "./features/featureCOMBINE_sub_queryLG/feature_%s_sub_queryLG_%s.txt" % (PDB_id_query, k)
-            df_feature_query = pd.read_csv(infeature_query, sep="\s+")
-            #print(df_feature_query)
-            del df_feature_query[df_feature_query.columns[0]] # remove first column
-            #print(df_feature_query)
-            sample_feature_query = df_feature_query.iloc[i]
-            sample_feature_query= np.array(sample_feature_query)
-            #print(sample_feature_query)
-            feature_queryLG.append(sample_feature_query)       
-    
+        feature_reference = list(np.array(site_reference[i]))
+        feature_query = list(np.array(site_query[i]))
+        feature_queryLG = list(np.array(site_queryLG[i]))
+
         print("calculating coordinated dynamics feature identification for site %s" % i)     
         #print(feature_reference)
         #print(feature_query)
@@ -803,7 +708,11 @@ def coordinated_site_matrix():
         #mykernel = k1+k2
         # observed model
         #gpc = GaussianProcessClassifier(kernel=mykernel,random_state=None).fit(X_obs, y_train)
-        gpc = svm.SVC(kernel='rbf', gamma='auto', probability=True)
+        if(rff_classifier == "yes"):
+            # same kernel width as gamma='auto' (1/features), linear in the subsamples
+            gpc = rff_features.linear_classifier(1.0/X_obs.shape[1], rff_components, rff_seed)
+        else:
+            gpc = svm.SVC(kernel='rbf', gamma='auto', probability=True)
         gpc = gpc.fit(X_obs, y_train)
         
         training_accuracy = gpc.score(X_obs, y_train)
@@ -889,42 +798,29 @@ def coordinated_dynamics():
     print(myMATRIX_plot)
 
 ###############################################################
-def runProgressBar():
-    import time
-    from progress.bar import IncrementalBar
-    bar = IncrementalBar('subsamples_completed', max=subsamples*5)
-    lst = os.listdir('subsamples/atomcorr_queryLG') # your directory path
-    num_files = 0
-    next_num_files = 0
-    while (num_files < subsamples*5):
-        if(num_files != next_num_files):
-            bar.next()
-        lst = os.listdir('subsamples/atomcorr_queryLG') # your directory path
-        num_files = len(lst)
-        time.sleep(2)
-        lst = os.listdir('subsamples/atomcorr_queryLG') # your directory path
-        next_num_files = len(lst)
-    bar.finish()
-
 
 ###############################################################
 ###############################################################
 
 def main():
     deployment_sampling_ctl()
+    global monitor
+    monitor = ProgressMonitor({"queryLG flux": n_bootstrap, "queryLG corr": n_bootstrap})
     t1 = threading.Thread(target=subsample_queryLG_flux)
     t2 = threading.Thread(target=subsample_queryLG_corr)
-    t3 = threading.Thread(target=runProgressBar)
     t1.start() # start threads
     t2.start()
-    t3.start() 
     t1.join()  # wait until threads are completely executed
     t2.join()
-    t3.join() 
+    monitor.close()
+    if not monitor.complete():
+        print("ERROR: subsampling did not complete")
+        sys.exit(1)
     
     print("subsampling of MD trajectories is completed") 
-    matrix_maker_old_queryLG()  # for older version of cpptraj
-    matrix_maker_batch_old_queryLG() # for older version of cpptraj
+    matrix_maker_parallel_queryLG()  # for older version of cpptraj
+    #matrix_maker_old_queryLG()  # for older version of cpptraj (one file at a time)
+    #matrix_maker_batch_old_queryLG() # for older version of cpptraj (one file at a time)
     #matrix_maker_new_queryLG()
     #matrix_maker_batch_new_queryLG()
     feature_deploy()
@@ -24,6 +24,9 @@ import re
 # for ggplot
 import pandas as pd
 import numpy as np
+import feature_store
+import mmd_engine
+import cpptraj_scheduler as scheduler
 import scipy as sp
 from pandas.api.types import CategoricalDtype
 from plotnine import *
@@ -34,6 +37,14 @@ from plotnine import *
 ################################################################################
 # READ CONTROL FORM
 # read ChimeraX visualization ctl file
+# optional settings (defaults used when DROIDS.ctl has no such line)
+precision_tol = 1e-3  # float32 features: largest accepted deviation of the MMD from a float64 recomputation
+mmd_memory_mb = 256  # kernel matrices held at once by the batched all-sites MMD
+max_jobs = 0  # processes sharing the sites of the MMD and its bootstrap; 0 = one per core
+mmd_estimator = "quadratic"  # quadratic (all subsample pairs, bootstrap null), linear or block (normal null), rff (approximate kernel)
+mmd_block = 10  # subsamples per block of the block estimator
+rff_components = 500  # rff estimator: dimension of the random Fourier feature embedding
+rff_seed = 0  # rff estimator: seed of the random frequencies
 infile = open("DROIDS.ctl", "r")
 infile_lines = infile.readlines()
 for x in range(len(infile_lines)):
@@ -101,6 +112,29 @@ for x in range(len(infile_lines)):
     if(header == "coordination"):
         coord_anal = value
         print("run coordinated dynamics is",coord_anal)
+    if(header == "precision_tol"):
+        precision_tol = float(value)
+        print("my precision tolerance is",precision_tol)
+    if(header == "mmd_memory_mb"):
+        mmd_memory_mb = float(value)
+        print("my MMD memory budget (MB) is",mmd_memory_mb)
+    if(header == "max_jobs"):
+        max_jobs = int(value)
+        print("my max concurrent jobs is",max_jobs)
+    if(header == "mmd_estimator"):
+        mmd_estimator = value.strip()
+        if mmd_estimator not in mmd_engine.ESTIMATORS:
+            raise ValueError("mmd_estimator must be one of %s, not %s" % (", ".join(mmd_engine.ESTIMATORS), mmd_estimator))
+        print("my MMD estimator is",mmd_estimator)
+    if(header == "mmd_block"):
+        mmd_block = int(value)
+        print("my MMD block size is",mmd_block)
+    if(header == "rff_components"):
+        rff_components = int(value)
+        print("my random Fourier features are",rff_components)
+    if(header == "rff_seed"):
+        rff_seed = int(value)
+        print("my random Fourier feature seed is",rff_seed)
     #if(header == "variants"):
     #    var_anal = value
     #    print("run variant dynamics is",var_anal)
@@ -130,11 +164,9 @@ coord_anal = ""+coord_anal+""
 ###############################################################################
 # set number of features for tuning gamma in RBF kernel
 infeature_ref = "./features/featureFLUX_sub_ref/feature_%s_sub_ref_0.txt" % PDB_id_reference
-df_feature_ref = pd.read_csv(infeature_ref, sep="\s+")
-n_features_flux = df_feature_ref.shape[1] - 1
+n_features_flux = feature_store.feature_shape(infeature_ref)[1]
 infeature_ref = "./features/feature_sub_ref_reduced/feature_%s_sub_ref_0.txt" % PDB_id_reference
-df_feature_ref = pd.read_csv(infeature_ref, sep="\s+")
-n_features_corr = df_feature_ref.shape[1] - 1      
+n_features_corr = feature_store.feature_shape(infeature_ref)[1]      
 
 n_bootstrap = subsamples*5
 if(n_bootstrap > 500):
@@ -158,138 +190,46 @@ def compare_dynamics_MMD_flux():
     MMD_output = []
     PVAL_output = []
     PLAB_output = []
+    # site-major (sites x subsamples x features) feature tensors: one slice per site
+    site_reference = feature_store.site_tensor("./features/featureFLUX_sub_ref/feature_%s_sub_ref_%%s.txt" % PDB_id_reference, subsamples)
+    site_referenceCTL = feature_store.site_tensor("./features/featureFLUX_sub_refCTL/feature_%s_sub_refCTL_%%s.txt" % PDB_id_reference, subsamples)
+    site_query = feature_store.site_tensor("./features/featureFLUX_sub_query/feature_%s_sub_query_%%s.txt" % PDB_id_query, subsamples)
+    # observed MMD of every site in batched kernel passes, and the neutral MMDs of random reference vs
+    # reference control subsample pairs (one cross kernel per site, replicates by lookup); sites split over a process pool
+    site_neutralError = None  # bootstrap null (replicates); the block estimators have a normal null instead
+    if(mmd_estimator == "quadratic"):
+        boot_reference, boot_referenceCTL = mmd_engine.bootstrap_pairs(length_prot-1, n_bootstrap, subsamples, subsamples, np.random.default_rng(rnd.getrandbits(64)))
+        site_MMD, site_neutralMMD = mmd_engine.compare_sites(site_reference[:length_prot-1], site_query[:length_prot-1], site_referenceCTL[:length_prot-1], 1.0/n_features_flux, boot_reference, boot_referenceCTL, int(mmd_memory_mb*2**20), scheduler.default_jobs(max_jobs))
+    elif(mmd_estimator == "rff"):
+        # kernel approximated by random Fourier features: MMD as a difference of mean embeddings
+        boot_reference, boot_referenceCTL = mmd_engine.bootstrap_pairs(length_prot-1, n_bootstrap, subsamples, subsamples, np.random.default_rng(rnd.getrandbits(64)))
+        site_MMD, site_neutralMMD = mmd_engine.compare_sites_rff(site_reference[:length_prot-1], site_query[:length_prot-1], site_referenceCTL[:length_prot-1], 1.0/n_features_flux, boot_reference, boot_referenceCTL, rff_components, rff_seed, int(mmd_memory_mb*2**20), scheduler.default_jobs(max_jobs))
+    else:
+        # linear-time block estimator: reference vs query and reference vs reference control over the same blocks
+        block_size = mmd_engine.ESTIMATORS[mmd_estimator] or mmd_block
+        orders = mmd_engine.block_orders(subsamples, subsamples, subsamples, block_size, np.random.default_rng(rnd.getrandbits(64)))
+        site_MMD, site_MMDerror, site_neutralMMD, site_neutralError = mmd_engine.compare_sites_block(site_reference[:length_prot-1], site_query[:length_prot-1], site_referenceCTL[:length_prot-1], 1.0/n_features_flux, block_size, orders, int(mmd_memory_mb*2**20), scheduler.default_jobs(max_jobs))
+        # signed like the observed MMD: negative where the reference control mean is below the reference mean
+        site_neutralMMD = np.where(site_referenceCTL[:length_prot-1].mean(axis=(1,2)) < site_reference[:length_prot-1].mean(axis=(1,2)), -site_neutralMMD, site_neutralMMD)
+    # sign of every site's MMD: negative where the query mean is below the reference mean
+    site_sign = np.sign(site_query[:length_prot-1].mean(axis=(1,2)) - site_reference[:length_prot-1].mean(axis=(1,2)))
     for i in range(length_prot-1):
-        # initiatize arrays
-        feature_reference = []
-        feature_referenceCTL = []
-        feature_query = []
-        for j in range(subsamples):
-            samp = j+1
-            #print("collecting subsample %s" % samp)
-            ######## reference protein ###########
-            #infeature_reference = "./feature_sub_ref_reduced/feature_%s_sub_ref_%s.txt" % (PDB_id_reference, j)
-            infeature_reference = "./features/featureFLUX_sub_ref/feature_%s_sub_ref_%s.txt" % (PDB_id_reference, j)
-            #infeature_reference = "./featureCOMBINE_sub_ref/feature_%s_sub_ref_%s.txt" % (PDB_id_reference, j)
-            
-            df_feature_reference = pd.read_csv(infeature_reference, sep="\s+")
-            #print(df_feature_reference)
-            del df_feature_reference[df_feature_reference.columns[0]] # remove first column
-            #print(df_feature_reference)
-            sample_feature_reference = df_feature_reference.iloc[i]
-            sample_feature_reference = np.array(sample_feature_reference)
-            #print(sample_feature_reference)
-            feature_reference.append(sample_feature_reference)
-            ######## reference control protein #####
-            #infeature_referenceCTL = "./feature_sub_refCTL_reduced/feature_%s_sub_refCTL_%s.txt" % (PDB_id_reference, j)
-            infeature_referenceCTL = "./features/featureFLUX_sub_refCTL/feature_%s_sub_refCTL_%s.txt" % (PDB_id_reference, j)
-            #infeature_referenceCTL = "./featureCOMBINE_sub_refCTL/feature_%s_sub_refCTL_%s.txt" % (PDB_id_reference, j)
-            
-            df_feature_referenceCTL = pd.read_csv(infeature_referenceCTL, sep="\s+")
-            #print(df_feature_referenceCTL)
-            del df_feature_referenceCTL[df_feature_referenceCTL.columns[0]] # remove first column
-            #print(df_feature_referenceCTL)
-            sample_feature_referenceCTL = df_feature_referenceCTL.iloc[i]
-            sample_feature_referenceCTL = np.array(sample_feature_referenceCTL)
-            #print(sample_feature_referenceCTL)
-            feature_referenceCTL.append(sample_feature_referenceCTL)
-            ######### query protein #########
-            #infeature_query = "./feature_sub_query_reduced/feature_%s_sub_query_%s.txt" % (PDB_id_query, j)
-            infeature_query = "./features/featureFLUX_sub_query/feature_%s_sub_query_%s.txt" % (PDB_id_query, j)
-            #infeature_query = "./featureCOMBINE_sub_query/feature_%s_sub_query_%s.txt" % (PDB_id_query, j)
-            
-            df_feature_query = pd.read_csv(infeature_query, sep="\s+")
-            #print(df_feature_query)
-            del df_feature_query[df_feature_query.columns[0]] # remove first column
-            #print(df_feature_query)
-            sample_feature_query = df_feature_query.iloc[i]
-            sample_feature_query= np.array(sample_feature_query)
-            #print(sample_feature_query)
-            feature_query.append(sample_feature_query)
-            
         print("calculating and bootstrapping MMD for site %s" % i)     
-        #print(feature_reference)
-        #print(feature_query)
-        df_feature_ref = pd.DataFrame(feature_reference)
-        df_feature_refCTL = pd.DataFrame(feature_referenceCTL)
-        df_feature_query = pd.DataFrame(feature_query)
-        feature_ref_mean = df_feature_ref.mean()
-        ref_mean = feature_ref_mean.mean()
-        #print(feature_ref_mean)
-        #print(ref_mean)
-        feature_query_mean = df_feature_query.mean()
-        query_mean = feature_query_mean.mean()
-        #print(feature_query_mean)
-        #print(query_mean)
-        diff_mean = (query_mean-ref_mean)
-        #print(diff_mean)
-        if(diff_mean >= 0):
-            sign = "pos"
-        elif(diff_mean < 0):
-            sign = "neg"
-        else:
-            sign = "NA"
-        # convert back to array for MMD calc
-        feature_ref_mean = np.array(feature_ref_mean)
-        feature_query_mean = np.array(feature_query_mean)
-        feature_ref_mean = feature_ref_mean.reshape(1, -1)
-        feature_query_mean = feature_query_mean.reshape(1, -1)
-        #print(feature_ref_mean)
-        #print(feature_query_mean)
-        myMMD = mmd_rbf_flux(feature_reference, feature_query) # calulate MMD
-        #myMMD = mmd_rbf(df_feature_ref, df_feature_query) # calulate MMD
-        #myMMD = mmd_rbf(feature_ref_mean, feature_query_mean) # calulate MMD
-        if(sign == "neg"):
+        myMMD = site_MMD[i] # calulate MMD
+        if(i == 0 and site_reference.dtype == np.float32 and mmd_estimator == "quadratic"):
+            feature_store.precision_report("MMD site 0", myMMD, mmd_rbf_flux(np.array(site_reference[0], dtype=np.float64), np.array(site_query[0], dtype=np.float64)), precision_tol)
+        if(site_sign[i] < 0):
             myMMD = -myMMD
         #print("obs MMD")
         #print(myMMD)
         MMD_output.append(myMMD) # build MMD list for each site
         
         ##### BOOTSTRAP TEST FOR MMD #########
-        cntGREATER = 1
-        cntLESSER = 1
-        neutralMMDs = []
-        sign = "NA"
-        for t in range(n_bootstrap):
-            # bootstrap1 feature_reference
-            rand1 = rnd.randint(0, subsamples-1)
-            #print("rand1")
-            #print(rand1)
-            #print(feature_reference[rand])
-            samp1 = feature_reference[rand1]
-            samp1 = samp1.reshape(1, -1)
-            #print (samp1)
-            samp1_mean = samp1.mean()
-            #print(samp1_mean)
-            # bootstrap2 feature_reference control 
-            rand2 = rnd.randint(0, subsamples-1)
-            #print("rand2")
-            #print(rand2)
-            samp2 = feature_referenceCTL[rand2]
-            samp2 = samp2.reshape(1, -1)
-            #print (samp2)
-            samp2_mean = samp2.mean()
-            #print(samp2_mean)
-            # neutral MMD (ref1 vs ref2)
-            diff_mean = (samp1_mean-samp2_mean)
-            #print(diff_mean)
-            if(diff_mean >= 0):
-                sign = "pos"
-            elif(diff_mean < 0):
-                sign = "neg"
-            else:
-                sign = "NA"
-            neutralMMD = mmd_rbf_flux(samp1, samp2) # calulate MMD
-            if(sign == "neg"):
-                neutralMMD = -neutralMMD
-            #print("neutral MMD %s" % t)
-            #print(neutralMMD)
-            #print(myMMD)
-            neutralMMDs.append(neutralMMD)
+        neutralMMDs = site_neutralMMD[i]
+        if(site_neutralError is None):
             # empirical p-value  (freq neutral MMD > alternative MMD)
-            if(myMMD > neutralMMD):
-                cntGREATER = cntGREATER+1
-            if(myMMD <= neutralMMD):
-                cntLESSER = cntLESSER+1
+            cntGREATER = 1+np.count_nonzero(myMMD > neutralMMDs)
+            cntLESSER = 1+np.count_nonzero(myMMD <= neutralMMDs)
         # avg neutral MMD
         #print(cntLESSER)
         #print(cntGREATER)
@@ -297,7 +237,10 @@ def compare_dynamics_MMD_flux():
         #print("avg neutral MMD")
         #print(mean_neutralMMD)
         # empiriacl p value
-        emp_P = cntGREATER/(cntGREATER+cntLESSER)
+        if(site_neutralError is None):
+            emp_P = cntGREATER/(cntGREATER+cntLESSER)
+        else:  # normal test of the observed against the reference vs reference control block estimate
+            emp_P = float(mmd_engine.block_p(myMMD, site_MMDerror[i], site_neutralMMD[i], site_neutralError[i]))
         #print("empirical P value")
         #print(emp_P)
         cutoff = 0.05
@@ -415,138 +358,46 @@ def compare_dynamics_MMD_corr():
     MMD_output = []
     PVAL_output = []
     PLAB_output = []
+    # site-major (sites x subsamples x features) feature tensors: one slice per site
+    site_reference = feature_store.site_tensor("./features/feature_sub_ref_reduced/feature_%s_sub_ref_%%s.txt" % PDB_id_reference, subsamples)
+    site_referenceCTL = feature_store.site_tensor("./features/feature_sub_refCTL_reduced/feature_%s_sub_refCTL_%%s.txt" % PDB_id_reference, subsamples)
+    site_query = feature_store.site_tensor("./features/feature_sub_query_reduced/feature_%s_sub_query_%%s.txt" % PDB_id_query, subsamples)
+    # observed MMD of every site in batched kernel passes, and the neutral MMDs of random reference vs
+    # reference control subsample pairs (one cross kernel per site, replicates by lookup); sites split over a process pool
+    site_neutralError = None  # bootstrap null (replicates); the block estimators have a normal null instead
+    if(mmd_estimator == "quadratic"):
+        boot_reference, boot_referenceCTL = mmd_engine.bootstrap_pairs(length_prot-1, n_bootstrap, subsamples, subsamples, np.random.default_rng(rnd.getrandbits(64)))
+        site_MMD, site_neutralMMD = mmd_engine.compare_sites(site_reference[:length_prot-1], site_query[:length_prot-1], site_referenceCTL[:length_prot-1], 1.0/n_features_corr, boot_reference, boot_referenceCTL, int(mmd_memory_mb*2**20), scheduler.default_jobs(max_jobs))
+    elif(mmd_estimator == "rff"):
+        # kernel approximated by random Fourier features: MMD as a difference of mean embeddings
+        boot_reference, boot_referenceCTL = mmd_engine.bootstrap_pairs(length_prot-1, n_bootstrap, subsamples, subsamples, np.random.default_rng(rnd.getrandbits(64)))
+        site_MMD, site_neutralMMD = mmd_engine.compare_sites_rff(site_reference[:length_prot-1], site_query[:length_prot-1], site_referenceCTL[:length_prot-1], 1.0/n_features_corr, boot_reference, boot_referenceCTL, rff_components, rff_seed, int(mmd_memory_mb*2**20), scheduler.default_jobs(max_jobs))
+    else:
+        # linear-time block estimator: reference vs query and reference vs reference control over the same blocks
+        block_size = mmd_engine.ESTIMATORS[mmd_estimator] or mmd_block
+        orders = mmd_engine.block_orders(subsamples, subsamples, subsamples, block_size, np.random.default_rng(rnd.getrandbits(64)))
+        site_MMD, site_MMDerror, site_neutralMMD, site_neutralError = mmd_engine.compare_sites_block(site_reference[:length_prot-1], site_query[:length_prot-1], site_referenceCTL[:length_prot-1], 1.0/n_features_corr, block_size, orders, int(mmd_memory_mb*2**20), scheduler.default_jobs(max_jobs))
+        # signed like the observed MMD: negative where the reference control mean is below the reference mean
+        site_neutralMMD = np.where(site_referenceCTL[:length_prot-1].mean(axis=(1,2)) < site_reference[:length_prot-1].mean(axis=(1,2)), -site_neutralMMD, site_neutralMMD)
+    # sign of every site's MMD: negative where the query mean is below the reference mean
+    site_sign = np.sign(site_query[:length_prot-1].mean(axis=(1,2)) - site_reference[:length_prot-1].mean(axis=(1,2)))
     for i in range(length_prot-1):
-        # initiatize arrays
-        feature_reference = []
-        feature_referenceCTL = []
-        feature_query = []
-        for j in range(subsamples):
-            samp = j+1
-            #print("collecting subsample %s" % samp)
-            ######## reference protein ###########
-            infeature_reference = "./features/feature_sub_ref_reduced/feature_%s_sub_ref_%s.txt" % (PDB_id_reference, j)
-            #infeature_reference = "./featureFLUX_sub_ref/feature_%s_sub_ref_%s.txt" % (PDB_id_reference, j)
-            #infeature_reference = "./featureCOMBINE_sub_ref/feature_%s_sub_ref_%s.txt" % (PDB_id_reference, j)
-            
-            df_feature_reference = pd.read_csv(infeature_reference, sep="\s+")
-            #print(df_feature_reference)
-            del df_feature_reference[df_feature_reference.columns[0]] # remove first column
-            #print(df_feature_reference)
-            sample_feature_reference = df_feature_reference.iloc[i]
-            sample_feature_reference = np.array(sample_feature_reference)
-            #print(sample_feature_reference)
-            feature_reference.append(sample_feature_reference)
-            ######## reference control protein #####
-            infeature_referenceCTL = "./features/feature_sub_refCTL_reduced/feature_%s_sub_refCTL_%s.txt" % (PDB_id_reference, j)
-            #infeature_referenceCTL = "./featureFLUX_sub_refCTL/feature_%s_sub_refCTL_%s.txt" % (PDB_id_reference, j)
-            #infeature_referenceCTL = "./featureCOMBINE_sub_refCTL/feature_%s_sub_refCTL_%s.txt" % (PDB_id_reference, j)
-            
-            df_feature_referenceCTL = pd.read_csv(infeature_referenceCTL, sep="\s+")
-            #print(df_feature_referenceCTL)
-            del df_feature_referenceCTL[df_feature_referenceCTL.columns[0]] # remove first column
-            #print(df_feature_referenceCTL)
-            sample_feature_referenceCTL = df_feature_referenceCTL.iloc[i]
-            sample_feature_referenceCTL = np.array(sample_feature_referenceCTL)
-            #print(sample_feature_referenceCTL)
-            feature_referenceCTL.append(sample_feature_referenceCTL)
-            ######### query protein #########
-            infeature_query = "./features/feature_sub_query_reduced/feature_%s_sub_query_%s.txt" % (PDB_id_query, j)
-            #infeature_query = "./featureFLUX_sub_query/feature_%s_sub_query_%s.txt" % (PDB_id_query, j)
-            #infeature_query = "./featureCOMBINE_sub_query/feature_%s_sub_query_%s.txt" % (PDB_id_query, j)
-            
-            df_feature_query = pd.read_csv(infeature_query, sep="\s+")
-            #print(df_feature_query)
-            del df_feature_query[df_feature_query.columns[0]] # remove first column
-            #print(df_feature_query)
-            sample_feature_query = df_feature_query.iloc[i]
-            sample_feature_query= np.array(sample_feature_query)
-            #print(sample_feature_query)
-            feature_query.append(sample_feature_query)
-            
         print("calculating and bootstrapping MMD for site %s" % i)     
-        #print(feature_reference)
-        #print(feature_query)
-        df_feature_ref = pd.DataFrame(feature_reference)
-        df_feature_refCTL = pd.DataFrame(feature_referenceCTL)
-        df_feature_query = pd.DataFrame(feature_query)
-        feature_ref_mean = df_feature_ref.mean()
-        ref_mean = feature_ref_mean.mean()
-        #print(feature_ref_mean)
-        #print(ref_mean)
-        feature_query_mean = df_feature_query.mean()
-        query_mean = feature_query_mean.mean()
-        #print(feature_query_mean)
-        #print(query_mean)
-        diff_mean = (query_mean-ref_mean)
-        #print(diff_mean)
-        if(diff_mean >= 0):
-            sign = "pos"
-        elif(diff_mean < 0):
-            sign = "neg"
-        else:
-            sign = "NA"
-        # convert back to array for MMD calc
-        feature_ref_mean = np.array(feature_ref_mean)
-        feature_query_mean = np.array(feature_query_mean)
-        feature_ref_mean = feature_ref_mean.reshape(1, -1)
-        feature_query_mean = feature_query_mean.reshape(1, -1)
-        #print(feature_ref_mean)
-        #print(feature_query_mean)
-        myMMD = mmd_rbf_corr(feature_reference, feature_query) # calulate MMD
-        #myMMD = mmd_rbf(df_feature_ref, df_feature_query) # calulate MMD
-        #myMMD = mmd_rbf(feature_ref_mean, feature_query_mean) # calulate MMD
-        if(sign == "neg"):
+        myMMD = site_MMD[i] # calulate MMD
+        if(i == 0 and site_reference.dtype == np.float32 and mmd_estimator == "quadratic"):
+            feature_store.precision_report("MMD site 0", myMMD, mmd_rbf_corr(np.array(site_reference[0], dtype=np.float64), np.array(site_query[0], dtype=np.float64)), precision_tol)
+        if(site_sign[i] < 0):
             myMMD = -myMMD
         #print("obs MMD")
         #print(myMMD)
         MMD_output.append(myMMD) # build MMD list for each site
         
         ##### BOOTSTRAP TEST FOR MMD #########
-        cntGREATER = 1
-        cntLESSER = 1
-        neutralMMDs = []
-        sign = "NA"
-        for t in range(n_bootstrap):
-            # bootstrap1 feature_reference
-            rand1 = rnd.randint(0, subsamples-1)
-            #print("rand1")
-            #print(rand1)
-            #print(feature_reference[rand])
-            samp1 = feature_reference[rand1]
-            samp1 = samp1.reshape(1, -1)
-            #print (samp1)
-            samp1_mean = samp1.mean()
-            #print(samp1_mean)
-            # bootstrap2 feature_reference control 
-            rand2 = rnd.randint(0, subsamples-1)
-            #print("rand2")
-            #print(rand2)
-            samp2 = feature_referenceCTL[rand2]
-            samp2 = samp2.reshape(1, -1)
-            #print (samp2)
-            samp2_mean = samp2.mean()
-            #print(samp2_mean)
-            # neutral MMD (ref1 vs ref2)
-            diff_mean = (samp1_mean-samp2_mean)
-            #print(diff_mean)
-            if(diff_mean >= 0):
-                sign = "pos"
-            elif(diff_mean < 0):
-                sign = "neg"
-            else:
-                sign = "NA"
-            neutralMMD = mmd_rbf_corr(samp1, samp2) # calulate MMD
-            if(sign == "neg"):
-                neutralMMD = -neutralMMD
-            #print("neutral MMD %s" % t)
-            #print(neutralMMD)
-            #print(myMMD)
-            neutralMMDs.append(neutralMMD)
+        neutralMMDs = site_neutralMMD[i]
+        if(site_neutralError is None):
             # empirical p-value  (freq neutral MMD > alternative MMD)
-            if(myMMD > neutralMMD):
-                cntGREATER = cntGREATER+1
-            if(myMMD <= neutralMMD):
-                cntLESSER = cntLESSER+1
+            cntGREATER = 1+np.count_nonzero(myMMD > neutralMMDs)
+            cntLESSER = 1+np.count_nonzero(myMMD <= neutralMMDs)
         # avg neutral MMD
         #print(cntLESSER)
         #print(cntGREATER)
@@ -554,7 +405,10 @@ def compare_dynamics_MMD_corr():
         #print("avg neutral MMD")
         #print(mean_neutralMMD)
         # empiriacl p value
-        emp_P = cntGREATER/(cntGREATER+cntLESSER)
+        if(site_neutralError is None):
+            emp_P = cntGREATER/(cntGREATER+cntLESSER)
+        else:  # normal test of the observed against the reference vs reference control block estimate
+            emp_P = float(mmd_engine.block_p(myMMD, site_MMDerror[i], site_neutralMMD[i], site_neutralError[i]))
         #print("empirical P value")
         #print(emp_P)
         cutoff = 0.05
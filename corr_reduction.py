@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+#############################################################################
+######   This script reduces the residue correlation matrices of all
+######   subsamples of a state to their leading components with batched
+######   randomized SVD passes (numpy stacked linear algebra, or sparse
+######   products for mostly zero thresholded matrices), optionally spread
+######   over a process pool
+######   It is part of the DROIDS v6.0 ChimeraX plug-in suite for
+######   machine-learning assisted comparative protein dynamics
+######   produced by Dr. Gregory A. Babbitt and students at the
+######   Rochester Instituteof Technology in 2022.   License under GPL v3.0
+#############################################################################
+
+import json
+import os
+import numpy as np
+import pandas as pd
+from scipy.linalg import lu, svd
+import scipy.sparse as sparse
+from concurrent.futures import ProcessPoolExecutor
+import feature_store
+
+CORR_THRESHOLD = 0.005  # correlations weaker than this are set to zero before the SVD
+N_OVERSAMPLES = 10  # extra random directions, as sklearn TruncatedSVD
+N_ITER = 5  # power iterations, as sklearn TruncatedSVD
+BATCH = 8  # matrices per stacked pass (bounds the memory of one pass)
+TARGET_VARIANCE = 0.8  # variance the reduced correlation features should explain
+COMPONENTS = "components.json"  # cached component count of a state, in its feature folder
+SPARSE_DENSITY = 0.25  # below this fraction of non-zeros sparse products beat dense BLAS
+
+def flip_signs(Vt):
+    # deterministic signs: largest loading of every component positive (svd_flip on V)
+    rows = np.argmax(np.abs(Vt), axis=-1)
+    signs = np.sign(np.take_along_axis(Vt, rows[..., None], axis=-1))
+    signs[signs == 0] = 1
+    return Vt * signs
+
+def random_basis(n_features, n_components, random_state=0):
+    # one Gaussian test matrix per state, so results do not depend on batching or workers
+    n_random = min(n_components+N_OVERSAMPLES, n_features)
+    return np.random.default_rng(random_state).standard_normal((n_features, n_random))
+
+def batched_randomized_svd(stack, n_components, omega):
+    """truncated SVD of every matrix of a stack (Halko et al. randomized range finder)
+    Arguments:
+        stack {ndarray} -- [S x L x F matrices]
+        n_components {int} -- [components kept]
+        omega {ndarray} -- [F x (n_components + oversamples) random test matrix]
+    Returns:
+        [ndarray] -- [S x L x n_components transformed matrices (X V), as TruncatedSVD.fit_transform]
+        [ndarray] -- [S x n_components singular values]
+        [ndarray] -- [S x n_components explained variance ratios]
+    """
+    stack_t = np.ascontiguousarray(np.swapaxes(stack, 1, 2))  # strided views fall off the BLAS path
+    Q = omega.astype(stack.dtype, copy=False)  # float32 stacks stay float32 throughout
+    for it in range(N_ITER):
+        # LU keeps the power iterations stable at a fraction of the cost of QR (as sklearn)
+        Q, _ = lu(stack @ Q, permute_l=True)
+        Q, _ = lu(stack_t @ Q, permute_l=True)
+    Q, _ = np.linalg.qr(stack @ Q)
+    B = np.ascontiguousarray(np.swapaxes(Q, 1, 2)) @ stack
+    Ub, s, Vt = np.linalg.svd(B, full_matrices=False)
+    s = s[:, :n_components]
+    Vt = flip_signs(Vt[:, :n_components, :])
+    transformed = stack @ np.ascontiguousarray(np.swapaxes(Vt, 1, 2))
+    full_var = np.var(stack, axis=1).sum(axis=1)
+    ratio = np.var(transformed, axis=1) / full_var[:, None]
+    return transformed, s, ratio
+
+def sparse_randomized_svd(X, n_components, omega):
+    """batched_randomized_svd for one sparse matrix; every product costs O(nnz) per column
+    Arguments:
+        X {spmatrix} -- [L x F thresholded correlations (CSR)]
+    Returns:
+        [tuple] -- [L x n_components transformed matrix, singular values, explained variance ratios]
+    """
+    X = sparse.csr_matrix(X)
+    Xt = X.T.tocsr()
+    Q = omega.astype(X.dtype, copy=False)
+    for it in range(N_ITER):
+        Q, _ = lu(X @ Q, permute_l=True)
+        Q, _ = lu(Xt @ Q, permute_l=True)
+    Q, _ = np.linalg.qr(X @ Q)
+    B = (Xt @ Q).T
+    Ub, s, Vt = np.linalg.svd(B, full_matrices=False)
+    s = s[:n_components]
+    Vt = flip_signs(Vt[:n_components, :])
+    transformed = X @ Vt.T
+    mean = np.asarray(X.mean(axis=0)).ravel()
+    full_var = (np.asarray(X.multiply(X).mean(axis=0)).ravel() - mean**2).sum()
+    ratio = np.var(transformed, axis=0) / full_var
+    return transformed, s, ratio
+
+def float_type(matrix):
+    # float32 input is kept (precision,float32), everything else is computed in float64
+    return np.float32 if getattr(matrix, "dtype", None) == np.float32 else np.float64
+
+def thresholded(matrix, threshold=CORR_THRESHOLD):
+    # weak correlations are zeroed before any reduction, as the analyzers always have
+    if sparse.issparse(matrix):
+        matrix = matrix.toarray()
+    M = np.array(matrix, dtype=float_type(matrix))
+    M[np.abs(M) < threshold] = 0
+    return M
+
+def sparse_thresholded(matrix, threshold=CORR_THRESHOLD):
+    # the same zeroing, kept as CSR so storage and products scale with the strong correlations
+    if sparse.issparse(matrix):
+        M = sparse.csr_matrix(matrix, dtype=float_type(matrix), copy=True)
+    else:
+        M = sparse.csr_matrix(np.asarray(matrix, dtype=float_type(matrix)))
+    M.data[np.abs(M.data) < threshold] = 0
+    M.eliminate_zeros()
+    return M
+
+def density(matrix):
+    # fraction of non-zero entries
+    nnz = matrix.nnz if sparse.issparse(matrix) else np.count_nonzero(matrix)
+    return nnz / float(max(1, matrix.shape[0]*matrix.shape[1]))
+
+def density_report(label, densities, threshold=CORR_THRESHOLD):
+    # one line per state: how much of its correlation matrices survived the threshold
+    densities = np.asarray(densities)
+    if (len(densities) == 0):
+        print("%s correlation density: no matrices built in this run" % label)
+        return
+    print("%s correlation density (|r| >= %s): mean %.4f min %.4f max %.4f over %s matrices (%s reduction)"
+          % (label, threshold, densities.mean(), densities.min(), densities.max(), len(densities),
+             "sparse" if densities.max() < SPARSE_DENSITY else "dense"))
+
+def explained_variance_curve(M):
+    """cumulative explained variance ratio of the first k SVD components, for every k
+    One exact SVD; the leading components of a truncated fit are the same for any k,
+    so entry k-1 equals TruncatedSVD(n_components = k).explained_variance_ratio_.sum()
+    Returns:
+        [ndarray] -- [min(L, F) cumulative ratios]
+    """
+    M = np.asarray(M, dtype=np.float64)  # the size choice is made in float64 in either precision
+    U, s, Vt = svd(M, full_matrices=False, check_finite=False)
+    component_var = np.var(U * s, axis=0)
+    return np.cumsum(component_var) / np.var(M, axis=0).sum()
+
+def select_components(cumulative, length_prot, target=TARGET_VARIANCE, min_size=5):
+    # same search as the analyzers' old refitting loop: shrink setSize from 0.9 x length
+    # in steps of 0.02 x length and stop at the first size explaining less than target
+    def tve(setSize):
+        return cumulative[min(max(setSize, 1), len(cumulative))-1]
+    ratio = 0.9
+    setSize = int(ratio*length_prot)
+    total = tve(setSize)
+    while (total >= target and setSize >= min_size):
+        setSize = int(ratio*length_prot)
+        total = tve(setSize)
+        ratio = ratio-0.02
+    return min(max(setSize, 1), len(cumulative))
+
+def tuned_components(path, length_prot, threshold=CORR_THRESHOLD, target=TARGET_VARIANCE):
+    """number of SVD components (setSize) for a state's reduced correlation features
+    Chosen on one stored subsample matrix and cached in the feature folder, so reruns
+    (and other scripts reducing the same state) do not repeat the SVD.
+    Arguments:
+        path {str} -- [feature_sub_* file of the subsample used for the choice]
+        length_prot {int} -- [protein length, the scale of the size search]
+        threshold {float} -- [weaker correlations are zeroed] (default: {CORR_THRESHOLD})
+        target {float} -- [variance to explain] (default: {TARGET_VARIANCE})
+    Returns:
+        [int] -- [setSize]
+        [float] -- [variance explained by setSize components]
+    """
+    npy = feature_store.feature_file(path)
+    source = [f for f in (npy, feature_store.sparse_file(path), path) if os.path.exists(f)][0]
+    key = {"source": os.path.basename(source), "mtime": os.path.getmtime(source),
+           "length_prot": length_prot, "threshold": threshold, "target": target}
+    cache_file = os.path.join(os.path.dirname(npy), COMPONENTS)
+    if os.path.exists(cache_file):
+        with open(cache_file, "r") as f:
+            cached = json.load(f)
+        if all(cached.get(k) == v for k, v in key.items()):
+            return cached["setSize"], cached["total_variance"]
+    cumulative = explained_variance_curve(thresholded(feature_store.load_features(path), threshold))
+    setSize = select_components(cumulative, length_prot, target)
+    key["setSize"] = setSize
+    key["total_variance"] = float(cumulative[setSize-1])
+    tmp = "%s.tmp%s" % (cache_file, os.getpid())
+    with open(tmp, "w") as f:
+        json.dump(key, f, indent=1, sort_keys=True)
+    os.replace(tmp, cache_file)
+    return setSize, key["total_variance"]
+
+def cached_components(path):
+    # setSize another script chose for the state of path, or None before it ran
+    cache_file = os.path.join(os.path.dirname(feature_store.feature_file(path)), COMPONENTS)
+    if not os.path.exists(cache_file):
+        return None
+    with open(cache_file, "r") as f:
+        return json.load(f)["setSize"]
+
+def corr_feature(args):
+    """build one subsample's thresholded correlation feature matrix from its atomcorr matrix
+    Arguments:
+        args {tuple} -- [(corr_*_matrix_*.txt, feature_sub_* file to write, threshold, text dump,
+                          precision of the stored matrix)]
+    Returns:
+        [float] -- [density of the stored matrix]
+    """
+    (in_file, out_file, threshold, text, dtype) = args
+    npy = "%s.npy" % os.path.splitext(in_file)[0]  # written by the sampler with matrix_binary,yes
+    if (os.path.exists(npy) and os.path.getmtime(npy) >= os.path.getmtime(in_file)):
+        matrix = np.load(npy)[:, :-1]  # values only; the text matrix also loses its last column
+    else:
+        # trim uneccessary columns: site column and last column, as the analyzers always have
+        matrix = pd.read_csv(in_file, sep="\s+", header=None).values[:, 1:-1]
+    M = sparse_thresholded(np.asarray(matrix, dtype=dtype), threshold)
+    return feature_store.save_sparse_features(out_file, M, text, dtype)
+
+def build_corr_features(state_jobs, max_jobs=1):
+    """run the corr_feature jobs of several states on one process pool, in chunks of subsamples
+    Every output is written atomically, so a failed run never leaves half a matrix behind.
+    Arguments:
+        state_jobs {dict} -- [state label -> list of corr_feature arguments]
+        max_jobs {int} -- [worker processes; 1 builds everything in this process] (default: {1})
+    Returns:
+        [dict] -- [state label -> density of every subsample matrix, in job order]
+    """
+    labels = list(state_jobs)
+    jobs = [job for label in labels for job in state_jobs[label]]
+    if (max_jobs <= 1 or len(jobs) <= 1):
+        densities = [corr_feature(job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=max_jobs) as pool:
+            densities = list(pool.map(corr_feature, jobs, chunksize=max(1, len(jobs) // (4*max_jobs))))
+    out = {}
+    for label in labels:
+        out[label] = densities[:len(state_jobs[label])]
+        densities = densities[len(state_jobs[label]):]
+    return out
+
+def _reduce_batch(args):
+    (paths, n_components, omega, threshold) = args
+    matrices = [feature_store.load_sparse_features(path) for path in paths]
+    if all(M is not None and density(M) < SPARSE_DENSITY for M in matrices):
+        results = [sparse_randomized_svd(sparse_thresholded(M, threshold), n_components, omega) for M in matrices]
+        return tuple(np.stack([r[k] for r in results]) for k in range(3))
+    stack = np.stack([thresholded(feature_store.load_features(path, mmap=True), threshold) for path in paths])
+    return batched_randomized_svd(stack, n_components, omega)
+
+def reduce_feature_files(paths, n_components, max_jobs=1, threshold=CORR_THRESHOLD, random_state=0, check_tol=None, indices=None):
+    """reduce the stored correlation features of every subsample of a state
+    Arguments:
+        paths {list} -- [feature_sub_* files (L x F, dense or sparse, see feature_store) in subsample order]
+        n_components {int} -- [components kept (setSize)]
+        max_jobs {int} -- [worker processes; 1 runs every batch in this process] (default: {1})
+        threshold {float} -- [weaker correlations are zeroed] (default: {CORR_THRESHOLD})
+        random_state {int} -- [seed of the random test matrix] (default: {0})
+        check_tol {float} -- [float32 matrices: compare the first reduction with a float64
+                              recomputation and report the deviation] (default: {None})
+        indices {list} -- [subsample index of each path, when only some subsamples are reduced]
+                          (default: {None}, the position in paths)
+    Yields:
+        [tuple] -- [(subsample index, L x n_components reduced features, singular values,
+                     explained variance ratios), in subsample order]
+    """
+    if (len(paths) == 0):
+        return
+    if indices is None:
+        indices = list(range(len(paths)))
+    n_features = feature_store.feature_shape(paths[0])[1]
+    if (n_components > n_features):
+        raise ValueError("n_components(%s) must be <= n_features(%s)." % (n_components, n_features))
+    omega = random_basis(n_features, n_components, random_state)
+    # small enough batches that every worker gets one (results do not depend on batching)
+    size = max(1, min(BATCH, -(-len(paths) // max(1, max_jobs))))
+    firsts = list(range(0, len(paths), size))
+    batches = [(paths[b:b+size], n_components, omega, threshold) for b in firsts]
+    pool = None
+    if (max_jobs > 1 and len(batches) > 1):
+        pool = ProcessPoolExecutor(max_workers=max_jobs)
+        results = pool.map(_reduce_batch, batches)
+    else:
+        results = map(_reduce_batch, batches)
+    try:
+        for first, (transformed, s, ratio) in zip(firsts, results):
+            for k in range(len(transformed)):
+                if (first+k == 0 and check_tol is not None and transformed.dtype == np.float32):
+                    stack = thresholded(feature_store.load_features(paths[0]), threshold)[None].astype(np.float64)
+                    reference = batched_randomized_svd(stack, n_components, omega)
+                    feature_store.precision_report("reduced correlations", transformed[k], reference[0][0], check_tol)
+                yield (indices[first+k], transformed[k], s[k], ratio[k])
+    finally:
+        if pool is not None:
+            pool.shutdown()
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+#############################################################################
+######   This script is a python (numpy) replacement for the cpptraj
+######   rms / average / atomicfluct / atomiccorr actions used by the
+######   DROIDS samplers, working directly on memory-mapped trajectories
+######   It is part of the DROIDS v6.0 ChimeraX plug-in suite for
+######   machine-learning assisted comparative protein dynamics
+######   produced by Dr. Gregory A. Babbitt and students at the
+######   Rochester Instituteof Technology in 2022.   License under GPL v3.0
+#############################################################################
+
+import numpy as np
+from amber_netcdf import read_prmtop, SOLVENT_RESIDUES
+
+CHUNK_FRAMES = 500  # frames pulled from the memory map per step
+
+################################################################################
+# superposition
+################################################################################
+
+def fit_frames(frames, ref):
+    """rms-fit every frame onto a reference structure (Kabsch, no mass weighting)
+    Arguments:
+        frames {[n_frames, n_atoms, 3]} -- [coordinates]
+        ref {[n_atoms, 3]} -- [reference coordinates]
+    Returns:
+        [n_frames, n_atoms, 3] -- [fitted coordinates]
+    """
+    ref_center = ref.mean(axis=0)
+    X = frames - frames.mean(axis=1, keepdims=True)
+    H = np.einsum('nki,kj->nij', X, ref - ref_center)
+    U, S, Vt = np.linalg.svd(H)
+    d = np.sign(np.linalg.det(np.matmul(U, Vt)))
+    U[:, :, -1] *= d[:, None]
+    return np.matmul(X, np.matmul(U, Vt)) + ref_center
+
+def selected_frames(traj, atoms, start=1, stop=None):
+    # yield float64 chunks of the selected atoms for frames start..stop (1-based, inclusive)
+    if stop is None or stop > traj.n_frames:
+        stop = traj.n_frames
+    for c in range(start-1, stop, CHUNK_FRAMES):
+        yield np.asarray(traj.coordinates[c:min(c+CHUNK_FRAMES, stop), atoms], dtype=np.float64)
+
+def average_structure(traj, atoms):
+    """equivalent of cpptraj 'rms first' + 'average crdset MyAvg' over the whole run
+    Arguments:
+        traj {AmberTrajectory} -- [memory-mapped trajectory]
+        atoms {[n_atoms]} -- [0-based atom indices]
+    Returns:
+        [n_atoms, 3] -- [average structure]
+    """
+    first = np.asarray(traj.coordinates[0, atoms], dtype=np.float64)
+    total = np.zeros_like(first)
+    for frames in selected_frames(traj, atoms):
+        total += fit_frames(frames, first).sum(axis=0)
+    return total / traj.n_frames
+
+################################################################################
+# per-window fluctuation and correlation
+################################################################################
+
+def residue_fluct(sum_x, sum_xx, n, sel):
+    # mass-weighted per residue average of atomic RMSF (cpptraj atomicfluct byres)
+    msf = sum_xx/n - np.square(sum_x/n).sum(axis=1)
+    rmsf = np.sqrt(np.clip(msf, 0, None))
+    masses = sel["masses"]
+    res = sel["residue_of_atom"]
+    return np.bincount(res, weights=masses*rmsf) / np.bincount(res, weights=masses)
+
+def residue_corr(frames_res):
+    # correlation of residue centre displacements (cpptraj atomiccorr byres)
+    D = frames_res - frames_res.mean(axis=0)
+    cov = np.einsum('nri,nsi->rs', D, D)
+    norm = np.sqrt(np.diag(cov))
+    norm[norm == 0] = 1.0
+    return cov / np.outer(norm, norm)
+
+def residue_centers(frames, sel):
+    # geometric centre of the selected atoms of each residue
+    res = sel["residue_of_atom"]
+    counts = np.bincount(res)
+    A = np.zeros((len(res), len(counts)))
+    A[np.arange(len(res)), res] = 1.0/counts[res]
+    return np.einsum('nki,kr->nri', frames, A)
+
+def window_fluct(traj, sel, avg, start=1, stop=None):
+    """residue fluctuations for frames start..stop after fitting to the average structure
+    Returns:
+        [n_residues] -- [AtomicFlx column]
+    """
+    sum_x = np.zeros_like(avg)
+    sum_xx = np.zeros(len(avg))
+    n = 0
+    for frames in selected_frames(traj, sel["atoms"], start, stop):
+        fitted = fit_frames(frames, avg) - avg
+        sum_x += fitted.sum(axis=0)
+        sum_xx += np.square(fitted).sum(axis=(0, 2))
+        n += len(fitted)
+    return residue_fluct(sum_x, sum_xx, n, sel)
+
+class WindowFluxEngine:
+    """prefix sums of fitted x and x^2 per atom for O(1) window fluctuations
+
+    One pass over the trajectory fits every frame to the average structure and
+    keeps the running sums at the requested window boundaries only, so memory
+    grows with the number of windows rather than the number of frames.
+    """
+    def __init__(self, traj, sel, avg, windows=()):
+        self.sel = sel
+        self.n_frames = traj.n_frames
+        # prefix position p holds the sum over frames 1..p (1-based)
+        positions = set([0, traj.n_frames])
+        for (start, stop) in windows:
+            positions.add(start-1)
+            positions.add(min(stop, traj.n_frames))
+        positions = sorted(positions)
+        self._row = dict((p, r) for r, p in enumerate(positions))
+        self._sum_x = np.zeros((len(positions),) + avg.shape)
+        self._sum_xx = np.zeros((len(positions), len(avg)))
+        run_x = np.zeros_like(avg)
+        run_xx = np.zeros(len(avg))
+        done = 0
+        p = 1  # positions[0] == 0 is the empty prefix
+        for frames in selected_frames(traj, sel["atoms"]):
+            fitted = fit_frames(frames, avg) - avg
+            cum_x = np.cumsum(fitted, axis=0) + run_x
+            cum_xx = np.cumsum(np.square(fitted).sum(axis=2), axis=0) + run_xx
+            while (p < len(positions) and positions[p] <= done+len(fitted)):
+                self._sum_x[p] = cum_x[positions[p]-done-1]
+                self._sum_xx[p] = cum_xx[positions[p]-done-1]
+                p = p+1
+            run_x = cum_x[-1]
+            run_xx = cum_xx[-1]
+            done = done+len(fitted)
+
+    def fluct(self, start=1, stop=None):
+        """residue fluctuations for frames start..stop (1-based, inclusive, as in cpptraj)
+        Returns:
+            [n_residues] -- [AtomicFlx column]
+        """
+        if stop is None or stop > self.n_frames:
+            stop = self.n_frames
+        a = self._row[start-1]
+        b = self._row[stop]
+        return residue_fluct(self._sum_x[b]-self._sum_x[a], self._sum_xx[b]-self._sum_xx[a], stop-start+1, self.sel)
+
+def window_corr(traj, sel, avg, start=1, stop=None):
+    """residue correlation matrix for frames start..stop after fitting to the average structure
+    Returns:
+        [n_residues, n_residues] -- [correlation matrix]
+    """
+    centers = [residue_centers(fit_frames(frames, avg), sel) for frames in selected_frames(traj, sel["atoms"], start, stop)]
+    return residue_corr(np.concatenate(centers))
+
+def window_fluct_corr(traj, sel, avg, start=1, stop=None):
+    """residue fluctuations and correlation matrix from a single read of frames start..stop
+    Returns:
+        [n_residues] -- [AtomicFlx column]
+        [n_residues, n_residues] -- [correlation matrix]
+    """
+    sum_x = np.zeros_like(avg)
+    sum_xx = np.zeros(len(avg))
+    n = 0
+    centers = []
+    for frames in selected_frames(traj, sel["atoms"], start, stop):
+        fitted = fit_frames(frames, avg)
+        centers.append(residue_centers(fitted, sel))
+        fitted = fitted - avg
+        sum_x += fitted.sum(axis=0)
+        sum_xx += np.square(fitted).sum(axis=(0, 2))
+        n += len(fitted)
+    return residue_fluct(sum_x, sum_xx, n, sel), residue_corr(np.concatenate(centers))
+
+################################################################################
+# output in cpptraj layout
+################################################################################
+
+def write_fluct_table(path, res_ids, columns):
+    # same layout as cpptraj 'atomicfluct out' with one data set per column
+    names = ["AtomicFlx"] + ["AtomicFlx_%05d" % x for x in range(1, len(columns))]
+    with open(path, "w") as f:
+        f.write("#Res     %s\n" % " ".join("%12s" % name for name in names))
+        for r in range(len(res_ids)):
+            f.write("%8.3f %s\n" % (res_ids[r], " ".join("%12.4f" % col[r] for col in columns)))
+
+def write_corr_pairs(path, res_ids, matrix):
+    # same layout as (older) cpptraj 'atomiccorr out ... byres' pair lists
+    with open(path, "w") as f:
+        f.write("#Res1     Res2   AtomicCorr\n")
+        for i in range(len(res_ids)):
+            for j in range(len(res_ids)):
+                f.write(" %7d %8d %12.4f\n" % (res_ids[i], res_ids[j], matrix[i, j]))
+
+def write_resinfo(top_file, path):
+    # residue table in the layout of cpptraj 'resinfo' (read by resinfo())
+    top = read_prmtop(top_file)
+    labels = top["RESIDUE_LABEL"]
+    pointers = top["RESIDUE_POINTER"] + [len(top["ATOM_NAME"])+1]
+    with open(path, "w") as f:
+        f.write("#Res  Name   First    Last\n")
+        for r in range(len(labels)):
+            if labels[r] in SOLVENT_RESIDUES:
+                continue
+            f.write("%8d %4s %8d %8d\n" % (r+1, labels[r], pointers[r], pointers[r+1]-1))
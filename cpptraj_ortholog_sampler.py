@@ -16,8 +16,18 @@ import random as rnd
 import re
 import threading
 import pandas as pd
+from cpptraj_windows import plan_windows
+import cpptraj_scheduler as scheduler
+from atomcorr_matrix import convert_corr_files
+from progress_monitor import ProgressMonitor
 
 # READ CONTROL FORM
+# optional settings (defaults used when DROIDS.ctl has no such line)
+plan_seed = None  # seed of the subsample window plan; None = keep saved plan or draw a new seed
+average_cache = "no"  # yes = average the trajectory once to MyAvg_*.rst7 and load it in every cpptraj job
+matrix_binary = "no"  # yes = also save every correlation matrix as a .npy array
+precision = "float64"  # float32 = store the .npy correlation matrices (and features downstream) in single precision
+max_jobs = 0  # processes for the matrix conversion; 0 = one per core
 # read ChimeraX visualization ctl file
 infileALT = open("maxDemon.ctl", "r")
 infileALT_lines = infileALT.readlines()
@@ -92,6 +102,21 @@ for x in range(len(infile_lines)):
     if(header == "length"):
         l_pr = value
         print("my total protein length is",l_pr)    
+    if(header == "seed"):
+        plan_seed = value.strip()
+        print("my window plan seed is",plan_seed)
+    if(header == "average_cache"):
+        average_cache = value.strip()
+        print("my cached average structure is",average_cache)
+    if(header == "matrix_binary"):
+        matrix_binary = value.strip()
+        print("my binary correlation matrices is",matrix_binary)
+    if(header == "precision"):
+        precision = value.strip()
+        print("my precision is",precision)
+    if(header == "max_jobs"):
+        max_jobs = int(value)
+        print("my max concurrent jobs is",max_jobs)
         
 ###### variable assignments ######
 PDB_id_query = ""+query_id+""
@@ -155,6 +180,12 @@ if not os.path.exists('subsamples/atomcorr_ortho'):
 if not os.path.exists('subsamples/atomcorr_ortho_matrix'):
     os.makedirs('subsamples/atomcorr_ortho_matrix')
     
+def cached_average(traj_file):
+    # None makes the ctl rebuild MyAvg itself
+    if(average_cache == "yes"):
+        return scheduler.average_file(traj_file)
+    return None
+
 # collect atom information
 def write_control_files():
     
@@ -172,9 +203,7 @@ def write_control_files():
     f = open("./atomflux_%s_all_ortho.ctl" % PDB_id_ortho, "w")
     f.write("parm %s\n" % top_file_ortho)
     f.write("trajin %s\n" % traj_file_ortho)
-    f.write("rms first\n")
-    f.write("average crdset MyAvg\n")
-    f.write("run\n")
+    scheduler.write_average_setup(f, cached_average(traj_file_ortho))
     f.write("rms ref MyAvg\n")
     f.write("atomicfluct out fluct_%s_all_ortho.txt @CA,C,O,N&!(:WAT) byres\n" % PDB_id_ortho)
     f.write("run\n")
@@ -183,9 +212,7 @@ def write_control_files():
     f = open("./atomcorr_%s_all_ortho.ctl" % PDB_id_ortho, "w") 
     f.write("parm %s\n" % top_file_ortho)
     f.write("trajin %s\n" % traj_file_ortho)
-    f.write("rms first\n")
-    f.write("average crdset MyAvg\n")
-    f.write("run\n")
+    scheduler.write_average_setup(f, cached_average(traj_file_ortho))
     f.write("rms ref MyAvg\n")
     f.write("atomiccorr out corr_%s_all_ortho.txt @CA,C,O,N&!(:WAT) byres\n" % PDB_id_ortho)
     f.write("run\n")
@@ -196,29 +223,34 @@ def write_control_files():
     f2 = open("./atomcorr_%s_sub_ortho.ctl" % PDB_id_ortho, "w")
     f1.write("parm %s\n" % top_file_ortho)
     f1.write("trajin %s\n"% traj_file_ortho)
-    f1.write("rms first\n")
-    f1.write("average crdset MyAvg\n")
-    f1.write("run\n")
+    scheduler.write_average_setup(f1, cached_average(traj_file_ortho))
     f2.write("parm %s\n" % top_file_ortho)
     f2.write("trajin %s\n"% traj_file_ortho)
+    windows = plan_windows("ortho", subsamples, n_frames, frame_size, traj_file_ortho, plan_seed)
     for x in range(subsamples):
-        upper_limit = n_frames-frame_size
-        start = rnd.randint(1, upper_limit)
-        stop = start+frame_size
+        (start, stop) = windows[x]
         f1.write("rms ref MyAvg\n")
         f1.write("atomicfluct out fluct_%s_sub_ortho.txt @CA,C,O,N&!(:WAT) byres start %s stop %s\n" % (PDB_id_ortho, start, stop))
         f1.write("run\n")
+        f2.write("clear trajin\n")  # each window on its own, not added to the earlier ones
         f2.write("trajin %s %s %s\n"% (traj_file_ortho, start, stop))
         f2.write("atomiccorr out ./subsamples/atomcorr_ortho/corr_%s_sub_ortho_%s.txt @CA,C,O,N&!(:WAT) byres\n" % (PDB_id_ortho, x))
         f2.write("run\n")
     f1.close()
     f2.close()
     
+    if(average_cache == "yes"):
+        print("averaging ortho trajectory once (cached average structure)")
+        if not scheduler.run_job(scheduler.average_job(top_file_ortho, traj_file_ortho)):
+            print("ERROR: averaging %s failed" % traj_file_ortho)
+            sys.exit(1)
+    
       
     
 ##################################################################
 
 # run subsampling routines
+monitor = None  # progress of the subsampling threads, set in main
     
 def subsample_ortho_flux():
     print("collecting atom information")
@@ -233,8 +265,8 @@ def subsample_ortho_flux():
     os.system(cmd)
     print("subsampling ortho protein fluctuations")
     print("NOTE: may take many minutes depending upon N subsamples & frames per subsample")
-    cmd = "cpptraj -i atomflux_%s_sub_ortho.ctl -o fluct_%s_out_sub_ortho.txt" % (PDB_id_ortho,PDB_id_ortho)
-    os.system(cmd)
+    cmd = "cpptraj -i atomflux_%s_sub_ortho.ctl" % PDB_id_ortho
+    scheduler.run_counted(cmd, "fluct_%s_out_sub_ortho.txt" % PDB_id_ortho, monitor, "ortho flux", 0 if(cached_average(traj_file_ortho) is not None) else 1, subsamples)
     
 def subsample_ortho_corr():
     print("overall correlation - ortho protein")
@@ -244,8 +276,8 @@ def subsample_ortho_corr():
     os.system(cmd)
     print("subsampling ortho protein correlations")
     print("NOTE: may take many minutes depending upon N subsamples & frames per subsample")
-    cmd = "cpptraj -i atomcorr_%s_sub_ortho.ctl -o corr_%s_out_sub_ortho.txt" % (PDB_id_ortho,PDB_id_ortho)
-    os.system(cmd)
+    cmd = "cpptraj -i atomcorr_%s_sub_ortho.ctl" % PDB_id_ortho
+    scheduler.run_counted(cmd, "corr_%s_out_sub_ortho.txt" % PDB_id_ortho, monitor, "ortho corr", 0, subsamples)
 
 
 #################################################################################
@@ -385,6 +417,14 @@ def matrix_maker_batch_new():
         
 
 
+def matrix_maker_parallel():
+    # same matrix files as matrix_maker_old/matrix_maker_batch_old, parsed in bulk on a process pool
+    print("converting atomiccorr output to matrix (ortho protein, %s processes)" % scheduler.default_jobs(max_jobs))
+    pairs = [("./corr_%s_all_ortho.txt" % PDB_id_ortho, "./corr_%s_all_ortho_matrix.txt" % PDB_id_ortho)]
+    for i in range(subsamples):
+        pairs.append(("./subsamples/atomcorr_ortho/corr_%s_sub_ortho_%s.txt" % (PDB_id_ortho, i), "./subsamples/atomcorr_ortho_matrix/corr_%s_sub_ortho_matrix_%s.txt" % (PDB_id_ortho, i)))
+    convert_corr_files(pairs, length_prot, matrix_binary == "yes", scheduler.default_jobs(max_jobs), precision)
+
 def copy_flux():
     print("copying atom flux files to atomflux folder")
     os.system('cp fluct_%s_sub_ortho.txt ./subsamples/atomflux_ortho/fluct_%s_sub_ortho.txt' % (PDB_id_ortho, PDB_id_ortho))
@@ -417,22 +457,6 @@ def resinfo():
                outfile.write("\n")
     outfile.close
 
-def runProgressBar():
-    import time
-    from progress.bar import IncrementalBar
-    bar = IncrementalBar('subsamples_completed', max=subsamples)
-    lst = os.listdir('subsamples/atomcorr_ortho') # your directory path
-    num_files = 0
-    next_num_files = 0
-    while (num_files < subsamples):
-        if(num_files != next_num_files):
-            bar.next()
-        lst = os.listdir('subsamples/atomcorr_ortho') # your directory path
-        num_files = len(lst)
-        time.sleep(2)
-        lst = os.listdir('subsamples/atomcorr_ortho') # your directory path
-        next_num_files = len(lst)
-    bar.finish()
 ###############################################################
 ###############################################################
 
@@ -440,20 +464,24 @@ def main():
     write_control_files()
     # creating thread
     
+    global monitor
+    monitor = ProgressMonitor({"ortho flux": subsamples, "ortho corr": subsamples})
     t1 = threading.Thread(target=subsample_ortho_flux)
     t2 = threading.Thread(target=subsample_ortho_corr)
-    t3 = threading.Thread(target=runProgressBar)
     t1.start() # start threads
     t2.start()
-    t3.start() 
     t1.join()  # wait until threads are completely executed
     t2.join()
-    t3.join() 
+    monitor.close()
+    if not monitor.complete():
+        print("ERROR: subsampling did not complete")
+        sys.exit(1)
     
     
     print("subsampling of MD trajectories is completed") 
-    matrix_maker_old()  # for older version of cpptraj
-    matrix_maker_batch_old() # for older version of cpptraj
+    matrix_maker_parallel()  # for older version of cpptraj
+    #matrix_maker_old()  # for older version of cpptraj (one file at a time)
+    #matrix_maker_batch_old() # for older version of cpptraj (one file at a time)
     #matrix_maker_new()
     #matrix_maker_batch_new()
     copy_flux()
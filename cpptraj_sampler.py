@@ -14,10 +14,34 @@ import os
 #import nglview as nv
 import random as rnd
 import re
+import shutil
 import threading
+import time
 import pandas as pd
+from amber_netcdf import AmberTrajectory, backbone_selection
+import cpptraj_native as native
+import cpptraj_scheduler as scheduler
+from atomcorr_matrix import convert_corr_files
+import sampler_cache
+from cpptraj_windows import plan_windows, saved_windows
+from progress_monitor import ProgressMonitor
 
 # READ CONTROL FORM
+# optional settings (defaults used when DROIDS.ctl has no such line)
+sampler_backend = "cpptraj"  # cpptraj or native (in-process memory-mapped NetCDF reader)
+flux_backend = ""  # cpptraj, native or prefixsum (one-pass prefix sums); empty = same as backend
+fused_stage = "no"  # yes = fluctuation and correlation of each window from one trajectory read
+use_scheduler = "no"  # yes = shard subsample windows over a bounded pool of cpptraj processes
+max_jobs = 0  # concurrent cpptraj processes for the scheduler; 0 = one per core
+job_retries = 1  # extra attempts for a failed scheduler job
+plan_seed = None  # seed of the subsample window plan; None = keep saved plan or draw a new seed
+average_cache = "no"  # yes = average each trajectory once to MyAvg_*.rst7 and load it in every cpptraj job
+matrix_binary = "no"  # yes = also save every correlation matrix as a .npy array
+precision = "float64"  # float32 = store the .npy correlation matrices (and features downstream) in single precision
+use_cache = "no"  # yes = reuse cached per-window and whole-run outputs, skipping their jobs
+cache_dir = "~/.droids_cache"  # content-addressed cache folder (shared by all runs of this user)
+cache_size_gb = 20.0  # least recently used entries are evicted above this size
+extend = "no"  # yes = keep the outputs of the windows already sampled and sample only the new ones
 # read ChimeraX visualization ctl file
 infile = open("DROIDS.ctl", "r")
 infile_lines = infile.readlines()
@@ -68,6 +92,48 @@ for x in range(len(infile_lines)):
     if(header == "length"):
         l_pr = value
         print("my total protein length is",l_pr)    
+    if(header == "backend"):
+        sampler_backend = value.strip()
+        print("my sampler backend is",sampler_backend)
+    if(header == "flux_backend"):
+        flux_backend = value.strip()
+        print("my fluctuation backend is",flux_backend)
+    if(header == "fused"):
+        fused_stage = value.strip()
+        print("my fused flux/corr stage is",fused_stage)
+    if(header == "scheduler"):
+        use_scheduler = value.strip()
+        print("my sharded job scheduler is",use_scheduler)
+    if(header == "max_jobs"):
+        max_jobs = int(value)
+        print("my max concurrent jobs is",max_jobs)
+    if(header == "job_retries"):
+        job_retries = int(value)
+        print("my job retries is",job_retries)
+    if(header == "seed"):
+        plan_seed = value.strip()
+        print("my window plan seed is",plan_seed)
+    if(header == "average_cache"):
+        average_cache = value.strip()
+        print("my cached average structure is",average_cache)
+    if(header == "matrix_binary"):
+        matrix_binary = value.strip()
+        print("my binary correlation matrices is",matrix_binary)
+    if(header == "precision"):
+        precision = value.strip()
+        print("my precision is",precision)
+    if(header == "cache"):
+        use_cache = value.strip()
+        print("my sampler cache is",use_cache)
+    if(header == "cache_dir"):
+        cache_dir = value.strip()
+        print("my sampler cache folder is",cache_dir)
+    if(header == "cache_size_gb"):
+        cache_size_gb = float(value)
+        print("my sampler cache size (GB) is",cache_size_gb)
+    if(header == "extend"):
+        extend = value.strip()
+        print("my subsample extension is",extend)
         
 ###### variable assignments ######
 PDB_id_query = ""+query_id+""
@@ -83,6 +149,24 @@ frame_size = int(fr_sz)
 n_frames = int(n_fr)
 num_chains = int(n_ch)
 length_prot = int(l_pr)
+if(flux_backend == ""):
+    flux_backend = sampler_backend
+
+# states run on the same topology and trajectory share the whole-run products
+# (atom info, overall fluctuation/correlation, average structure) of the first of them
+state_inputs = {"reference": (PDB_id_reference, top_file_reference, traj_file_reference),
+                "query": (PDB_id_query, top_file_query, traj_file_query),
+                "referenceCTL": (PDB_id_reference, top_file_reference, traj_file_reference)}
+shared_with = {}
+for state in ["reference", "query", "referenceCTL"]:
+    shared_with[state] = state
+    for other in ["reference", "query", "referenceCTL"]:
+        if(other == state):
+            break
+        if(os.path.realpath(state_inputs[other][1]) == os.path.realpath(state_inputs[state][1]) and os.path.realpath(state_inputs[other][2]) == os.path.realpath(state_inputs[state][2])):
+            shared_with[state] = other
+            print("%s protein shares topology and trajectory with %s protein; whole-run products are computed once" % (state, other))
+            break
 
 
 #subsamples = 10
@@ -121,9 +205,37 @@ if not os.path.exists('subsamples/atomcorr_refCTL_matrix'):
 if not os.path.exists('subsamples/atomcorr_query_matrix'):
     os.makedirs('subsamples/atomcorr_query_matrix')
 
+# subsample windows (start, stop) per state, taken from the window plan in write_control_files
+sub_windows = {"reference": [], "query": [], "referenceCTL": []}
+# indices of the windows still to compute, and whether the whole-run products are computed, per state
+# (everything, unless the sampler cache already holds it)
+todo = {"reference": [], "query": [], "referenceCTL": []}
+run_whole = dict((state, shared_with[state] == state) for state in shared_with)
+corr_dirs = {"reference": "atomcorr_ref", "query": "atomcorr_query", "referenceCTL": "atomcorr_refCTL"}
+
 
 # collect atom information
+def cached_average(traj_file):
+    # None makes the ctl rebuild MyAvg itself
+    if(average_cache == "yes"):
+        return scheduler.average_file(traj_file)
+    return None
+
+def average_runs(traj_file):
+    # cpptraj runs spent on MyAvg at the top of a subsampling ctl (not subsample windows)
+    return 0 if(cached_average(traj_file) is not None) else 1
+
 def write_control_files():
+    old_windows = dict((state, saved_windows(state)) for state in sub_windows)
+    sub_windows["reference"] = plan_windows("reference", subsamples, n_frames, frame_size, traj_file_reference, plan_seed, extend=(extend == "yes"))
+    sub_windows["query"] = plan_windows("query", subsamples, n_frames, frame_size, traj_file_query, plan_seed, extend=(extend == "yes"))
+    sub_windows["referenceCTL"] = plan_windows("referenceCTL", subsamples, n_frames, frame_size, traj_file_reference, plan_seed, extend=(extend == "yes"))
+    for state in todo:
+        todo[state] = list(range(subsamples))
+    if(extend == "yes"):
+        extend_restore(old_windows)
+    if(use_cache == "yes"):
+        cache_restore()
     
     ################# reference protein ############################
     # for getting atom info
@@ -139,9 +251,7 @@ def write_control_files():
     f = open("./atomflux_%s_all_reference.ctl" % PDB_id_reference, "w")
     f.write("parm %s\n" % top_file_reference)
     f.write("trajin %s\n" % traj_file_reference)
-    f.write("rms first\n")
-    f.write("average crdset MyAvg\n")
-    f.write("run\n")
+    scheduler.write_average_setup(f, cached_average(traj_file_reference))
     f.write("rms ref MyAvg\n")
     f.write("atomicfluct out fluct_%s_all_reference.txt @CA,C,O,N&!(:WAT) byres\n" % PDB_id_reference)
     f.write("run\n")
@@ -150,9 +260,7 @@ def write_control_files():
     f = open("./atomcorr_%s_all_reference.ctl" % PDB_id_reference, "w") 
     f.write("parm %s\n" % top_file_reference)
     f.write("trajin %s\n" % traj_file_reference)
-    f.write("rms first\n")
-    f.write("average crdset MyAvg\n")
-    f.write("run\n")
+    scheduler.write_average_setup(f, cached_average(traj_file_reference))
     f.write("rms ref MyAvg\n")
     f.write("atomiccorr out corr_%s_all_reference.txt @CA,C,O,N&!(:WAT) byres\n" % PDB_id_reference)
     f.write("run\n")
@@ -163,18 +271,15 @@ def write_control_files():
     f2 = open("./atomcorr_%s_sub_reference.ctl" % PDB_id_reference, "w")
     f1.write("parm %s\n" % top_file_reference)
     f1.write("trajin %s\n"% traj_file_reference)
-    f1.write("rms first\n")
-    f1.write("average crdset MyAvg\n")
-    f1.write("run\n")
+    scheduler.write_average_setup(f1, cached_average(traj_file_reference))
     f2.write("parm %s\n" % top_file_reference)
     f2.write("trajin %s\n"% traj_file_reference)
-    for x in range(subsamples):
-        upper_limit = n_frames-frame_size
-        start = rnd.randint(1, upper_limit)
-        stop = start+frame_size
+    for x in todo["reference"]:
+        (start, stop) = sub_windows["reference"][x]
         f1.write("rms ref MyAvg\n")
         f1.write("atomicfluct out fluct_%s_sub_reference.txt @CA,C,O,N&!(:WAT) byres start %s stop %s\n" % (PDB_id_reference, start, stop))
         f1.write("run\n")
+        f2.write("clear trajin\n")  # each window on its own, not added to the earlier ones
         f2.write("trajin %s %s %s\n"% (traj_file_reference, start, stop))
         f2.write("atomiccorr out ./subsamples/atomcorr_ref/corr_%s_sub_reference_%s.txt @CA,C,O,N&!(:WAT) byres\n" % (PDB_id_reference, x))
         f2.write("run\n")
@@ -195,9 +300,7 @@ def write_control_files():
     f = open("./atomflux_%s_all_query.ctl" % PDB_id_query, "w")
     f.write("parm %s\n" % top_file_query)
     f.write("trajin %s\n" % traj_file_query)
-    f.write("rms first\n")
-    f.write("average crdset MyAvg\n")
-    f.write("run\n")
+    scheduler.write_average_setup(f, cached_average(traj_file_query))
     f.write("rms ref MyAvg\n")
     f.write("atomicfluct out fluct_%s_all_query.txt @CA,C,O,N&!(:WAT) byres\n" % PDB_id_query)
     f.write("run\n")
@@ -206,9 +309,7 @@ def write_control_files():
     f = open("./atomcorr_%s_all_query.ctl" % PDB_id_query, "w") 
     f.write("parm %s\n" % top_file_query)
     f.write("trajin %s\n" % traj_file_query)
-    f.write("rms first\n")
-    f.write("average crdset MyAvg\n")
-    f.write("run\n")
+    scheduler.write_average_setup(f, cached_average(traj_file_query))
     f.write("rms ref MyAvg\n")
     f.write("atomiccorr out corr_%s_all_query.txt @CA,C,O,N&!(:WAT) byres\n" % PDB_id_query)
     f.write("run\n")
@@ -219,18 +320,15 @@ def write_control_files():
     f2 = open("./atomcorr_%s_sub_query.ctl" % PDB_id_query, "w")
     f1.write("parm %s\n" % top_file_query)
     f1.write("trajin %s\n"% traj_file_query)
-    f1.write("rms first\n")
-    f1.write("average crdset MyAvg\n")
-    f1.write("run\n")
+    scheduler.write_average_setup(f1, cached_average(traj_file_query))
     f2.write("parm %s\n" % top_file_query)
     f2.write("trajin %s\n"% traj_file_query)
-    for x in range(subsamples):
-        upper_limit = n_frames-frame_size
-        start = rnd.randint(1, upper_limit)
-        stop = start+frame_size
+    for x in todo["query"]:
+        (start, stop) = sub_windows["query"][x]
         f1.write("rms ref MyAvg\n")
         f1.write("atomicfluct out fluct_%s_sub_query.txt @CA,C,O,N&!(:WAT) byres start %s stop %s\n" % (PDB_id_query, start, stop))
         f1.write("run\n")
+        f2.write("clear trajin\n")  # each window on its own, not added to the earlier ones
         f2.write("trajin %s %s %s\n"% (traj_file_query, start, stop))
         f2.write("atomiccorr out ./subsamples/atomcorr_query/corr_%s_sub_query_%s.txt @CA,C,O,N&!(:WAT) byres\n" % (PDB_id_query, x))
         f2.write("run\n")
@@ -251,9 +349,7 @@ def write_control_files():
     f = open("./atomflux_%s_all_referenceCTL.ctl" % PDB_id_reference, "w")
     f.write("parm %s\n" % top_file_reference)
     f.write("trajin %s\n" % traj_file_reference)
-    f.write("rms first\n")
-    f.write("average crdset MyAvg\n")
-    f.write("run\n")
+    scheduler.write_average_setup(f, cached_average(traj_file_reference))
     f.write("rms ref MyAvg\n")
     f.write("atomicfluct out fluct_%s_all_referenceCTL.txt @CA,C,O,N&!(:WAT) byres\n" % PDB_id_reference)
     f.write("run\n")
@@ -262,9 +358,7 @@ def write_control_files():
     f = open("./atomcorr_%s_all_referenceCTL.ctl" % PDB_id_reference, "w") 
     f.write("parm %s\n" % top_file_reference)
     f.write("trajin %s\n" % traj_file_reference)
-    f.write("rms first\n")
-    f.write("average crdset MyAvg\n")
-    f.write("run\n")
+    scheduler.write_average_setup(f, cached_average(traj_file_reference))
     f.write("rms ref MyAvg\n")
     f.write("atomiccorr out corr_%s_all_referenceCTL.txt @CA,C,O,N&!(:WAT) byres\n" % PDB_id_reference)
     f.write("run\n")
@@ -275,111 +369,479 @@ def write_control_files():
     f2 = open("./atomcorr_%s_sub_referenceCTL.ctl" % PDB_id_reference, "w")
     f1.write("parm %s\n" % top_file_reference)
     f1.write("trajin %s\n"% traj_file_reference)
-    f1.write("rms first\n")
-    f1.write("average crdset MyAvg\n")
-    f1.write("run\n")
+    scheduler.write_average_setup(f1, cached_average(traj_file_reference))
     f2.write("parm %s\n" % top_file_reference)
     f2.write("trajin %s\n"% traj_file_reference)
-    for x in range(subsamples):
-        upper_limit = n_frames-frame_size
-        start = rnd.randint(1, upper_limit)
-        stop = start+frame_size
+    for x in todo["referenceCTL"]:
+        (start, stop) = sub_windows["referenceCTL"][x]
         f1.write("rms ref MyAvg\n")
         f1.write("atomicfluct out fluct_%s_sub_referenceCTL.txt @CA,C,O,N&!(:WAT) byres start %s stop %s\n" % (PDB_id_reference, start, stop))
         f1.write("run\n")
+        f2.write("clear trajin\n")  # each window on its own, not added to the earlier ones
         f2.write("trajin %s %s %s\n"% (traj_file_reference, start, stop))
         f2.write("atomiccorr out ./subsamples/atomcorr_refCTL/corr_%s_sub_referenceCTL_%s.txt @CA,C,O,N&!(:WAT) byres\n" % (PDB_id_reference, x))
         f2.write("run\n")
     f1.close()
     f2.close()
     
+    if(fused_stage == "yes"):
+        write_fused_control_file(PDB_id_reference, top_file_reference, traj_file_reference, "reference", "atomcorr_ref")
+        write_fused_control_file(PDB_id_query, top_file_query, traj_file_query, "query", "atomcorr_query")
+        write_fused_control_file(PDB_id_reference, top_file_reference, traj_file_reference, "referenceCTL", "atomcorr_refCTL")
     
+def write_fused_control_file(PDB_id, top_file, traj_file, state, corr_dir):
+    # atomicfluct and atomiccorr share each run, so every window is read from disk once
+    f = open("./atomfused_%s_sub_%s.ctl" % (PDB_id, state), "w")
+    f.write("parm %s\n" % top_file)
+    f.write("trajin %s\n" % traj_file)
+    scheduler.write_average_setup(f, cached_average(traj_file))
+    if(run_whole[state]):
+        f.write("rms ref MyAvg\n")
+        f.write("atomicfluct out fluct_%s_all_%s.txt @CA,C,O,N&!(:WAT) byres\n" % (PDB_id, state))
+        f.write("atomiccorr out corr_%s_all_%s.txt @CA,C,O,N&!(:WAT) byres\n" % (PDB_id, state))
+        f.write("run\n")
+    for x in todo[state]:
+        (start, stop) = sub_windows[state][x]
+        f.write("clear trajin\n")
+        f.write("trajin %s %s %s\n" % (traj_file, start, stop))
+        f.write("rms ref MyAvg\n")
+        f.write("atomicfluct out fluct_%s_sub_%s.txt @CA,C,O,N&!(:WAT) byres\n" % (PDB_id, state))
+        f.write("atomiccorr out ./subsamples/%s/corr_%s_sub_%s_%s.txt @CA,C,O,N&!(:WAT) byres\n" % (corr_dir, PDB_id, state, x))
+        f.write("run\n")
+    f.close()
     
     
     
 ##################################################################
 
+# native backend: compute straight from the memory-mapped trajectory
+# average structures already computed, per (topology, trajectory), shared by all states and metrics
+avg_cache = {}
+avg_locks = {}
+avg_locks_guard = threading.Lock()
+
+def shared_average(top_file, traj_file, traj, atoms):
+    key = (os.path.realpath(top_file), os.path.realpath(traj_file))
+    with avg_locks_guard:
+        lock = avg_locks.setdefault(key, threading.Lock())
+    with lock:  # a second thread on the same trajectory waits instead of recomputing
+        if key not in avg_cache:
+            avg_cache[key] = native.average_structure(traj, atoms)
+    return avg_cache[key]
+
+def native_flux(PDB_id, top_file, traj_file, state):
+    whole_run = run_whole[state]
+    windows = [sub_windows[state][x] for x in todo[state]]
+    if(whole_run):
+        print("collecting atom information (native backend)")
+        native.write_resinfo(top_file, "cpptraj_atominfo_%s.txt" % PDB_id)
+    sel = backbone_selection(top_file)
+    with AmberTrajectory(traj_file) as traj:
+        avg = shared_average(top_file, traj_file, traj, sel["atoms"])
+        if(flux_backend == "prefixsum"):
+            print("overall and subsampled fluctuation - %s protein (single pass prefix sums)" % state)
+            engine = native.WindowFluxEngine(traj, sel, avg, windows)
+            flux_all = engine.fluct()
+            flux_sub = [engine.fluct(start, stop) for (start, stop) in windows]
+            monitor.done("%s flux" % state, len(windows))
+        else:
+            print("overall and subsampled fluctuation - %s protein (native backend)" % state)
+            if(whole_run):
+                flux_all = native.window_fluct(traj, sel, avg)
+            flux_sub = []
+            for (start, stop) in windows:
+                flux_sub.append(native.window_fluct(traj, sel, avg, start, stop))
+                monitor.done("%s flux" % state)
+    if(whole_run):
+        native.write_fluct_table("fluct_%s_all_%s.txt" % (PDB_id, state), sel["res_ids"], [flux_all])
+    native.write_fluct_table("fluct_%s_sub_%s.txt" % (PDB_id, state), sel["res_ids"], flux_sub)
+
+def native_corr(PDB_id, top_file, traj_file, state, corr_dir):
+    sel = backbone_selection(top_file)
+    with AmberTrajectory(traj_file) as traj:
+        avg = shared_average(top_file, traj_file, traj, sel["atoms"])
+        if(run_whole[state]):
+            print("overall correlation - %s protein (native backend)" % state)
+            corr_all = native.window_corr(traj, sel, avg)
+            native.write_corr_pairs("corr_%s_all_%s.txt" % (PDB_id, state), sel["res_ids"], corr_all)
+        print("subsampling %s protein correlations (native backend)" % state)
+        for x in todo[state]:
+            (start, stop) = sub_windows[state][x]
+            corr_sub = native.window_corr(traj, sel, avg, start, stop)
+            native.write_corr_pairs("./subsamples/%s/corr_%s_sub_%s_%s.txt" % (corr_dir, PDB_id, state, x), sel["res_ids"], corr_sub)
+            monitor.done("%s corr" % state)
+
+def native_fused(PDB_id, top_file, traj_file, state, corr_dir):
+    whole_run = run_whole[state]
+    if(whole_run):
+        print("collecting atom information (native backend)")
+        native.write_resinfo(top_file, "cpptraj_atominfo_%s.txt" % PDB_id)
+    sel = backbone_selection(top_file)
+    flux_sub = []
+    with AmberTrajectory(traj_file) as traj:
+        avg = shared_average(top_file, traj_file, traj, sel["atoms"])
+        if(whole_run):
+            print("overall fluctuation and correlation - %s protein (fused native pass)" % state)
+            flux_all, corr_all = native.window_fluct_corr(traj, sel, avg)
+            native.write_corr_pairs("corr_%s_all_%s.txt" % (PDB_id, state), sel["res_ids"], corr_all)
+            native.write_fluct_table("fluct_%s_all_%s.txt" % (PDB_id, state), sel["res_ids"], [flux_all])
+        print("subsampling %s protein fluctuations and correlations (fused native pass)" % state)
+        for x in todo[state]:
+            (start, stop) = sub_windows[state][x]
+            flux, corr_sub = native.window_fluct_corr(traj, sel, avg, start, stop)
+            flux_sub.append(flux)
+            native.write_corr_pairs("./subsamples/%s/corr_%s_sub_%s_%s.txt" % (corr_dir, PDB_id, state, x), sel["res_ids"], corr_sub)
+            monitor.done(state)
+    native.write_fluct_table("fluct_%s_sub_%s.txt" % (PDB_id, state), sel["res_ids"], flux_sub)
+
+def copy_shared_products():
+    # give states that share a topology and trajectory the whole-run outputs of the first of them
+    for state in ["reference", "query", "referenceCTL"]:
+        other = shared_with[state]
+        if(other == state):
+            continue
+        PDB_id = state_inputs[state][0]
+        PDB_id_other = state_inputs[other][0]
+        print("reusing overall fluctuation and correlation of %s protein for %s protein" % (other, state))
+        shutil.copyfile("fluct_%s_all_%s.txt" % (PDB_id_other, other), "fluct_%s_all_%s.txt" % (PDB_id, state))
+        shutil.copyfile("corr_%s_all_%s.txt" % (PDB_id_other, other), "corr_%s_all_%s.txt" % (PDB_id, state))
+        if(PDB_id != PDB_id_other):
+            shutil.copyfile("cpptraj_atominfo_%s.txt" % PDB_id_other, "cpptraj_atominfo_%s.txt" % PDB_id)
+        if os.path.exists("info_%s_all_%s.txt" % (PDB_id_other, other)):
+            shutil.copyfile("info_%s_all_%s.txt" % (PDB_id_other, other), "info_%s_all_%s.txt" % (PDB_id, state))
+
 # run subsampling routines
+def subsample_fused(PDB_id, top_file, traj_file, state, corr_dir):
+    if(sampler_backend == "native"):
+        native_fused(PDB_id, top_file, traj_file, state, corr_dir)
+        return
+    if(run_whole[state]):  # else cached or copied from the state sharing this trajectory
+        print("collecting atom information")
+        cmd = "cpptraj -i atominfo_%s_%s.ctl -o info_%s_out_%s.txt" % (PDB_id,state,PDB_id,state)
+        os.system(cmd)
+        cmd = "cpptraj -i atominfo_%s_%s.ctl | tee cpptraj_atominfo_%s.txt" % (PDB_id,state,PDB_id)
+        os.system(cmd)
+    print("overall and subsampled fluctuation and correlation - %s protein (fused stage)" % state)
+    print("NOTE: may take many minutes depending upon N subsamples & frames per subsample")
+    cmd = "cpptraj -i atomfused_%s_sub_%s.ctl" % (PDB_id,state)
+    scheduler.run_counted(cmd, "fused_%s_out_sub_%s.txt" % (PDB_id,state), monitor, state, average_runs(traj_file)+(1 if run_whole[state] else 0), len(todo[state]))
+
 def subsample_reference_flux():
-    print("collecting atom information")
-    cmd = "cpptraj -i atominfo_%s_reference.ctl -o info_%s_out_reference.txt" % (PDB_id_reference,PDB_id_reference)
-    os.system(cmd)
-    cmd = "cpptraj -i atominfo_%s_reference.ctl | tee cpptraj_atominfo_%s.txt" % (PDB_id_reference,PDB_id_reference)
-    os.system(cmd)
-    print("overall fluctuation - reference protein")
-    #flux = pt.all_actions.atomicfluct(traj = traj_ref, mask = '@CA,C,O,N&!(:WAT)', options = 'byres')
-    #print(flux)  # overall fluctuation
-    cmd = 'cpptraj -i atomflux_%s_all_reference.ctl -o fluct_%s_out_all_reference.txt' % (PDB_id_reference,PDB_id_reference)
-    os.system(cmd)
+    if(flux_backend != "cpptraj"):
+        native_flux(PDB_id_reference, top_file_reference, traj_file_reference, "reference")
+        return
+    if(run_whole["reference"]):  # else cached or copied from the state sharing this trajectory
+        print("collecting atom information")
+        cmd = "cpptraj -i atominfo_%s_reference.ctl -o info_%s_out_reference.txt" % (PDB_id_reference,PDB_id_reference)
+        os.system(cmd)
+        cmd = "cpptraj -i atominfo_%s_reference.ctl | tee cpptraj_atominfo_%s.txt" % (PDB_id_reference,PDB_id_reference)
+        os.system(cmd)
+        print("overall fluctuation - reference protein")
+        #flux = pt.all_actions.atomicfluct(traj = traj_ref, mask = '@CA,C,O,N&!(:WAT)', options = 'byres')
+        #print(flux)  # overall fluctuation
+        cmd = 'cpptraj -i atomflux_%s_all_reference.ctl -o fluct_%s_out_all_reference.txt' % (PDB_id_reference,PDB_id_reference)
+        os.system(cmd)
     print("subsampling reference protein fluctuations")
     print("NOTE: may take many minutes depending upon N subsamples & frames per subsample")
-    cmd = "cpptraj -i atomflux_%s_sub_reference.ctl -o fluct_%s_out_sub_reference.txt" % (PDB_id_reference,PDB_id_reference)
-    os.system(cmd)
+    cmd = "cpptraj -i atomflux_%s_sub_reference.ctl" % PDB_id_reference
+    scheduler.run_counted(cmd, "fluct_%s_out_sub_reference.txt" % PDB_id_reference, monitor, "reference flux", average_runs(traj_file_reference), len(todo["reference"]))
     
 def subsample_reference_corr():
-    print("overall correlation - reference protein")
-    #corr = pt.all_actions.atomiccorr(traj = traj_ref, mask = '@CA,C,O,N&!(:WAT)', byres = True)
-    #print(corr)  # overall correlation
-    cmd = 'cpptraj -i atomcorr_%s_all_reference.ctl -o corr_%s_out_all_reference.txt' % (PDB_id_reference,PDB_id_reference) 
-    os.system(cmd)
+    if(sampler_backend == "native"):
+        native_corr(PDB_id_reference, top_file_reference, traj_file_reference, "reference", "atomcorr_ref")
+        return
+    if(run_whole["reference"]):  # else cached or copied from the state sharing this trajectory
+        print("overall correlation - reference protein")
+        #corr = pt.all_actions.atomiccorr(traj = traj_ref, mask = '@CA,C,O,N&!(:WAT)', byres = True)
+        #print(corr)  # overall correlation
+        cmd = 'cpptraj -i atomcorr_%s_all_reference.ctl -o corr_%s_out_all_reference.txt' % (PDB_id_reference,PDB_id_reference) 
+        os.system(cmd)
     print("subsampling reference protein correlations")
     print("NOTE: may take many minutes depending upon N subsamples & frames per subsample")
-    cmd = "cpptraj -i atomcorr_%s_sub_reference.ctl -o corr_%s_out_sub_reference.txt" % (PDB_id_reference,PDB_id_reference)
-    os.system(cmd)
+    cmd = "cpptraj -i atomcorr_%s_sub_reference.ctl" % PDB_id_reference
+    scheduler.run_counted(cmd, "corr_%s_out_sub_reference.txt" % PDB_id_reference, monitor, "reference corr", 0, len(todo["reference"]))
     
 def subsample_query_flux():
-    print("collecting atom information")
-    cmd = "cpptraj -i atominfo_%s_query.ctl -o info_%s_out_query.txt" % (PDB_id_query,PDB_id_query)
-    os.system(cmd)
-    cmd = "cpptraj -i atominfo_%s_query.ctl | tee cpptraj_atominfo_%s.txt" % (PDB_id_query,PDB_id_query)
-    os.system(cmd)
-    print("overall fluctuation - query protein")
-    #flux = pt.all_actions.atomicfluct(traj = traj_query, mask = '@CA,C,O,N&!(:WAT)', options = 'byres')
-    #print(flux)  # overall fluctuation
-    cmd = 'cpptraj -i atomflux_%s_all_query.ctl -o fluct_%s_out_all_query.txt' % (PDB_id_query,PDB_id_query)
-    os.system(cmd)
+    if(flux_backend != "cpptraj"):
+        native_flux(PDB_id_query, top_file_query, traj_file_query, "query")
+        return
+    if(run_whole["query"]):  # else cached or copied from the state sharing this trajectory
+        print("collecting atom information")
+        cmd = "cpptraj -i atominfo_%s_query.ctl -o info_%s_out_query.txt" % (PDB_id_query,PDB_id_query)
+        os.system(cmd)
+        cmd = "cpptraj -i atominfo_%s_query.ctl | tee cpptraj_atominfo_%s.txt" % (PDB_id_query,PDB_id_query)
+        os.system(cmd)
+        print("overall fluctuation - query protein")
+        #flux = pt.all_actions.atomicfluct(traj = traj_query, mask = '@CA,C,O,N&!(:WAT)', options = 'byres')
+        #print(flux)  # overall fluctuation
+        cmd = 'cpptraj -i atomflux_%s_all_query.ctl -o fluct_%s_out_all_query.txt' % (PDB_id_query,PDB_id_query)
+        os.system(cmd)
     print("subsampling query protein fluctuations")
     print("NOTE: may take many minutes depending upon N subsamples & frames per subsample")
-    cmd = "cpptraj -i atomflux_%s_sub_query.ctl -o fluct_%s_out_sub_query.txt" % (PDB_id_query,PDB_id_query)
-    os.system(cmd)
+    cmd = "cpptraj -i atomflux_%s_sub_query.ctl" % PDB_id_query
+    scheduler.run_counted(cmd, "fluct_%s_out_sub_query.txt" % PDB_id_query, monitor, "query flux", average_runs(traj_file_query), len(todo["query"]))
     
 def subsample_query_corr():
-    print("overall correlation - query protein")
-    #corr = pt.all_actions.atomiccorr(traj = traj_query, mask = '@CA,C,O,N&!(:WAT)', byres = True)
-    #print(corr)  # overall correlation
-    cmd = 'cpptraj -i atomcorr_%s_all_query.ctl -o corr_%s_out_all_query.txt' % (PDB_id_query,PDB_id_query) 
-    os.system(cmd)
+    if(sampler_backend == "native"):
+        native_corr(PDB_id_query, top_file_query, traj_file_query, "query", "atomcorr_query")
+        return
+    if(run_whole["query"]):  # else cached or copied from the state sharing this trajectory
+        print("overall correlation - query protein")
+        #corr = pt.all_actions.atomiccorr(traj = traj_query, mask = '@CA,C,O,N&!(:WAT)', byres = True)
+        #print(corr)  # overall correlation
+        cmd = 'cpptraj -i atomcorr_%s_all_query.ctl -o corr_%s_out_all_query.txt' % (PDB_id_query,PDB_id_query) 
+        os.system(cmd)
     print("subsampling query protein correlations")
     print("NOTE: may take many minutes depending upon N subsamples & frames per subsample")
-    cmd = "cpptraj -i atomcorr_%s_sub_query.ctl -o corr_%s_out_sub_query.txt" % (PDB_id_query,PDB_id_query)
-    os.system(cmd)
+    cmd = "cpptraj -i atomcorr_%s_sub_query.ctl" % PDB_id_query
+    scheduler.run_counted(cmd, "corr_%s_out_sub_query.txt" % PDB_id_query, monitor, "query corr", 0, len(todo["query"]))
 
 def subsample_referenceCTL_flux():
-    print("collecting atom information")
-    cmd = "cpptraj -i atominfo_%s_referenceCTL.ctl -o info_%s_out_referenceCTL.txt" % (PDB_id_reference,PDB_id_reference)
-    os.system(cmd)
-    cmd = "cpptraj -i atominfo_%s_referenceCTL.ctl | tee cpptraj_atominfo_%s.txt" % (PDB_id_reference,PDB_id_reference)
-    os.system(cmd)
-    print("overall fluctuation - reference protein")
-    #flux = pt.all_actions.atomicfluct(traj = traj_ref, mask = '@CA,C,O,N&!(:WAT)', options = 'byres')
-    #print(flux)  # overall fluctuation
-    cmd = 'cpptraj -i atomflux_%s_all_referenceCTL.ctl -o fluct_%s_out_all_referenceCTL.txt' % (PDB_id_reference,PDB_id_reference)
-    os.system(cmd)
+    if(flux_backend != "cpptraj"):
+        native_flux(PDB_id_reference, top_file_reference, traj_file_reference, "referenceCTL")
+        return
+    if(run_whole["referenceCTL"]):  # else cached or copied from the state sharing this trajectory
+        print("collecting atom information")
+        cmd = "cpptraj -i atominfo_%s_referenceCTL.ctl -o info_%s_out_referenceCTL.txt" % (PDB_id_reference,PDB_id_reference)
+        os.system(cmd)
+        cmd = "cpptraj -i atominfo_%s_referenceCTL.ctl | tee cpptraj_atominfo_%s.txt" % (PDB_id_reference,PDB_id_reference)
+        os.system(cmd)
+        print("overall fluctuation - reference protein")
+        #flux = pt.all_actions.atomicfluct(traj = traj_ref, mask = '@CA,C,O,N&!(:WAT)', options = 'byres')
+        #print(flux)  # overall fluctuation
+        cmd = 'cpptraj -i atomflux_%s_all_referenceCTL.ctl -o fluct_%s_out_all_referenceCTL.txt' % (PDB_id_reference,PDB_id_reference)
+        os.system(cmd)
     print("subsampling reference protein fluctuations")
     print("NOTE: may take many minutes depending upon N subsamples & frames per subsample")
-    cmd = "cpptraj -i atomflux_%s_sub_referenceCTL.ctl -o fluct_%s_out_sub_referenceCTL.txt" % (PDB_id_reference,PDB_id_reference)
-    os.system(cmd)
+    cmd = "cpptraj -i atomflux_%s_sub_referenceCTL.ctl" % PDB_id_reference
+    scheduler.run_counted(cmd, "fluct_%s_out_sub_referenceCTL.txt" % PDB_id_reference, monitor, "referenceCTL flux", average_runs(traj_file_reference), len(todo["referenceCTL"]))
     
 def subsample_referenceCTL_corr():
-    print("overall correlation - reference protein")
-    #corr = pt.all_actions.atomiccorr(traj = traj_ref, mask = '@CA,C,O,N&!(:WAT)', byres = True)
-    #print(corr)  # overall correlation
-    cmd = 'cpptraj -i atomcorr_%s_all_referenceCTL.ctl -o corr_%s_out_all_referenceCTL.txt' % (PDB_id_reference,PDB_id_reference) 
-    os.system(cmd)
+    if(sampler_backend == "native"):
+        native_corr(PDB_id_reference, top_file_reference, traj_file_reference, "referenceCTL", "atomcorr_refCTL")
+        return
+    if(run_whole["referenceCTL"]):  # else cached or copied from the state sharing this trajectory
+        print("overall correlation - reference protein")
+        #corr = pt.all_actions.atomiccorr(traj = traj_ref, mask = '@CA,C,O,N&!(:WAT)', byres = True)
+        #print(corr)  # overall correlation
+        cmd = 'cpptraj -i atomcorr_%s_all_referenceCTL.ctl -o corr_%s_out_all_referenceCTL.txt' % (PDB_id_reference,PDB_id_reference) 
+        os.system(cmd)
     print("subsampling reference protein correlations")
     print("NOTE: may take many minutes depending upon N subsamples & frames per subsample")
-    cmd = "cpptraj -i atomcorr_%s_sub_referenceCTL.ctl -o corr_%s_out_sub_referenceCTL.txt" % (PDB_id_reference,PDB_id_reference)
-    os.system(cmd)
+    cmd = "cpptraj -i atomcorr_%s_sub_referenceCTL.ctl" % PDB_id_reference
+    scheduler.run_counted(cmd, "corr_%s_out_sub_referenceCTL.txt" % PDB_id_reference, monitor, "referenceCTL corr", 0, len(todo["referenceCTL"]))
+
+# progress of the subsampling workers (see start_monitor)
+monitor = None
+
+# content-addressed cache of per-window and whole-run outputs
+cache = None
+cached_flux = {"reference": {}, "query": {}, "referenceCTL": {}}
+run_started = None  # time the subsampling of this run began (see clear_todo_outputs)
+
+def cache_recipe(kind):
+    # how a product is computed; different recipes never share cache entries
+    if(kind == "atomicfluct" and fused_stage != "yes"):
+        return flux_backend
+    return "%s-%s" % (sampler_backend, "fused" if(fused_stage == "yes") else "split")
+
+def window_key(kind, state, x):
+    (start, stop) = sub_windows[state][x]
+    return sampler_cache.cache_key(kind, [state_inputs[state][1], state_inputs[state][2]], mask=scheduler.MASK, start=start, stop=stop, recipe=cache_recipe(kind))
+
+def whole_run_products(state):
+    # (cache key, output file) of everything the whole-run jobs of a state write
+    PDB_id = state_inputs[state][0]
+    inputs = [state_inputs[state][1], state_inputs[state][2]]
+    return [(sampler_cache.cache_key("atomicfluct", inputs, mask=scheduler.MASK, start=1, stop=None, recipe=cache_recipe("atomicfluct")), "fluct_%s_all_%s.txt" % (PDB_id, state)),
+            (sampler_cache.cache_key("atomiccorr", inputs, mask=scheduler.MASK, start=1, stop=None, recipe=cache_recipe("atomiccorr")), "corr_%s_all_%s.txt" % (PDB_id, state)),
+            (sampler_cache.cache_key("resinfo", [state_inputs[state][1]], recipe=sampler_backend), "cpptraj_atominfo_%s.txt" % PDB_id)]
+
+def cache_restore():
+    # copy every cached output in place and leave only the missing windows in todo
+    global cache
+    cache = sampler_cache.SamplerCache(cache_dir, int(cache_size_gb*1e9))
+    for state in ["reference", "query", "referenceCTL"]:
+        PDB_id = state_inputs[state][0]
+        missing = todo[state]
+        todo[state] = []
+        for x in missing:
+            flux_tmp = "fluct_%s_sub_%s_cached.txt" % (PDB_id, state)
+            corr_file = "./subsamples/%s/corr_%s_sub_%s_%s.txt" % (corr_dirs[state], PDB_id, state, x)
+            if(cache.fetch(window_key("atomicfluct", state, x), flux_tmp) and cache.fetch(window_key("atomiccorr", state, x), corr_file)):
+                cached_flux[state][x] = scheduler.read_fluct_columns(flux_tmp)
+            else:
+                todo[state].append(x)
+            if os.path.exists(flux_tmp):
+                os.remove(flux_tmp)
+        if(run_whole[state] and all(cache.fetch(key, out_file) for (key, out_file) in whole_run_products(state))):
+            run_whole[state] = False
+            print("%s protein: whole-run products restored from cache" % state)
+        print("%s protein: %s of %s subsample windows restored from cache" % (state, len(missing)-len(todo[state]), len(missing)))
+
+def extend_restore(old_windows):
+    # keep every leading window whose plan, fluctuation column and correlation file are unchanged,
+    # and the whole-run products, so that only the new windows are sampled
+    for state in ["reference", "query", "referenceCTL"]:
+        PDB_id = state_inputs[state][0]
+        flux_file = "fluct_%s_sub_%s.txt" % (PDB_id, state)
+        labels = []
+        columns = []
+        if os.path.exists(flux_file):
+            labels, columns = scheduler.read_fluct_columns(flux_file)
+        n_kept = 0
+        while(n_kept < min(len(columns), len(old_windows[state]), subsamples) and old_windows[state][n_kept] == sub_windows[state][n_kept]
+              and os.path.exists("./subsamples/%s/corr_%s_sub_%s_%s.txt" % (corr_dirs[state], PDB_id, state, n_kept))):
+            cached_flux[state][n_kept] = (labels, [columns[n_kept]])
+            n_kept += 1
+        todo[state] = [x for x in todo[state] if(x >= n_kept)]
+        if(run_whole[state] and all(os.path.exists(out_file) for (key, out_file) in whole_run_products(state))):
+            run_whole[state] = False
+        print("%s protein: keeping %s subsample windows, sampling %s new ones" % (state, n_kept, len(todo[state])))
+
+def clear_todo_outputs():
+    # remove what earlier runs left at the paths of the windows to compute (as run_job does per job),
+    # so that a window cpptraj skips stays missing instead of reappearing with an old plan's data
+    global run_started
+    run_started = time.time()
+    for state in ["reference", "query", "referenceCTL"]:
+        PDB_id = state_inputs[state][0]
+        paths = ["./subsamples/%s/corr_%s_sub_%s_%s.txt" % (corr_dirs[state], PDB_id, state, x) for x in todo[state]]
+        if(len(todo[state]) > 0):
+            paths.append("fluct_%s_sub_%s.txt" % (PDB_id, state))
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+def written_this_run(path):
+    # output exists and is not older than the start of the subsampling (1 s for coarse file timestamps)
+    return (os.path.exists(path) and os.path.getmtime(path) >= run_started - 1)
+
+def finish_flux_tables():
+    # store what this run computed (cache) and rebuild each fluct_*_sub_* table in window order;
+    # only outputs written by this run are cached, missing windows stop the run after the others are stored
+    incomplete = []
+    for state in ["reference", "query", "referenceCTL"]:
+        PDB_id = state_inputs[state][0]
+        flux_file = "fluct_%s_sub_%s.txt" % (PDB_id, state)
+        labels = []
+        computed = []
+        if(len(todo[state]) > 0 and written_this_run(flux_file)):
+            labels, computed = scheduler.read_fluct_columns(flux_file)
+        if(len(computed) != len(todo[state])):  # columns cannot be matched to windows
+            print("WARNING: %s has %s fluctuation columns for %s subsample windows, none of them cached" % (flux_file, len(computed), len(todo[state])))
+            computed = []
+        columns = []
+        missing = []
+        for x in range(subsamples):
+            if x in cached_flux[state]:
+                (labels, cached_columns) = cached_flux[state][x]
+                columns.append(cached_columns[0])
+                continue
+            corr_file = "./subsamples/%s/corr_%s_sub_%s_%s.txt" % (corr_dirs[state], PDB_id, state, x)
+            if(len(computed) == 0 or not written_this_run(corr_file)):
+                missing.append(x)
+                continue
+            column = computed[todo[state].index(x)]
+            if cache is not None:
+                flux_tmp = "fluct_%s_sub_%s_cached.txt" % (PDB_id, state)
+                scheduler.write_fluct_columns(flux_tmp, labels, [column])
+                cache.store(window_key("atomicfluct", state, x), flux_tmp)
+                os.remove(flux_tmp)
+                cache.store(window_key("atomiccorr", state, x), corr_file)
+            columns.append(column)
+        if(len(missing) > 0):
+            print("WARNING: %s protein: subsample windows %s were not written by this run and are not cached" % (state, ", ".join(str(x) for x in missing)))
+            incomplete.append(state)
+            continue
+        scheduler.write_fluct_columns(flux_file, labels, columns)
+        if(run_whole[state] and cache is not None):
+            for (key, out_file) in whole_run_products(state):
+                if written_this_run(out_file):
+                    cache.store(key, out_file)
+                else:
+                    print("WARNING: %s was not written by this run and is not cached" % out_file)
+    if cache is not None:
+        removed = cache.evict()
+        print("sampler cache: %s hits, %s misses, %s old entries evicted" % (cache.hits, cache.misses, removed))
+    if(len(incomplete) > 0):
+        print("ERROR: subsampling did not write every window (%s)" % ", ".join(incomplete))
+        sys.exit(1)
+
+def compute_averages():
+    # one averaging pass per trajectory; every later ctl loads the result as MyAvg
+    print("averaging each trajectory once (cached average structure)")
+    jobs = []
+    for state in ["reference", "query", "referenceCTL"]:
+        users = [other for other in shared_with if(shared_with[other] == state)]
+        if(len(users) > 0 and any(run_whole[other] or len(todo[other]) > 0 for other in users)):
+            jobs.append(scheduler.average_job(state_inputs[state][1], state_inputs[state][2]))
+    failed = scheduler.run_jobs(jobs, max_jobs, job_retries)
+    if(len(failed) > 0):
+        print("ERROR: averaging failed after %s retries: %s" % (job_retries, ", ".join(failed)))
+        sys.exit(1)
+
+# sharded cpptraj runs: every state x metric is split over up to max_jobs shards
+def scheduled_jobs(PDB_id, top_file, traj_file, state, corr_dir):
+    jobs = []
+    if(run_whole[state]):  # else cached or copied from the state sharing this trajectory
+        jobs.append({"name": "atominfo_%s" % state, "outputs": [],
+                     "cmd": "cpptraj -i atominfo_%s_%s.ctl -o info_%s_out_%s.txt" % (PDB_id, state, PDB_id, state)})
+        jobs.append({"name": "resinfo_%s" % state, "outputs": [],
+                     "cmd": "cpptraj -i atominfo_%s_%s.ctl | tee cpptraj_atominfo_%s.txt" % (PDB_id, state, PDB_id)})
+        jobs.append({"name": "atomflux_all_%s" % state, "outputs": ["fluct_%s_all_%s.txt" % (PDB_id, state)],
+                     "cmd": "cpptraj -i atomflux_%s_all_%s.ctl -o fluct_%s_out_all_%s.txt" % (PDB_id, state, PDB_id, state)})
+        jobs.append({"name": "atomcorr_all_%s" % state, "outputs": ["corr_%s_all_%s.txt" % (PDB_id, state)],
+                     "cmd": "cpptraj -i atomcorr_%s_all_%s.ctl -o corr_%s_out_all_%s.txt" % (PDB_id, state, PDB_id, state)})
+    if(fused_stage == "yes"):
+        metrics = ["fused"]  # one shard ctl writes both fluct columns and corr files
+    else:
+        metrics = ["flux", "corr"]
+    windows = sub_windows[state]
+    shards = []
+    if(len(todo[state]) > 0):
+        shards = [[todo[state][k] for k in shard] for shard in scheduler.shard_windows(len(todo[state]), scheduler.default_jobs(max_jobs))]
+    for metric in metrics:
+        for k, indices in enumerate(shards):
+            ctl = "./atom%s_%s_sub_%s_shard%s.ctl" % (metric, PDB_id, state, k)
+            flux_out = None
+            corr_out = None
+            outputs = []
+            if(metric != "corr"):
+                flux_out = "fluct_%s_sub_%s_shard%s.txt" % (PDB_id, state, k)
+                outputs.append(flux_out)
+            if(metric != "flux"):
+                corr_out = "./subsamples/%s/corr_%s_sub_%s_%%s.txt" % (corr_dir, PDB_id, state)
+                outputs.extend([corr_out % x for x in indices])
+            scheduler.write_shard_control_file(ctl, top_file, traj_file, windows, indices, flux_out, corr_out, cached_average(traj_file))
+            jobs.append({"name": "atom%s_%s_shard%s" % (metric, state, k), "outputs": outputs,
+                         "stream": state if(metric == "fused") else "%s %s" % (state, metric), "windows": len(indices),
+                         "cmd": "cpptraj -i %s -o %s_%s_out_sub_%s_shard%s.txt" % (ctl, metric, PDB_id, state, k)})
+    return jobs, len(shards)
+
+def scheduled_subsampling():
+    print("subsampling all proteins on a bounded pool of %s cpptraj processes" % scheduler.default_jobs(max_jobs))
+    print("NOTE: may take many minutes depending upon N subsamples & frames per subsample")
+    states = [(PDB_id_reference, top_file_reference, traj_file_reference, "reference", "atomcorr_ref"),
+              (PDB_id_query, top_file_query, traj_file_query, "query", "atomcorr_query"),
+              (PDB_id_reference, top_file_reference, traj_file_reference, "referenceCTL", "atomcorr_refCTL")]
+    jobs = []
+    n_shards = {}
+    for (PDB_id, top_file, traj_file, state, corr_dir) in states:
+        state_jobs, n_shards[state] = scheduled_jobs(PDB_id, top_file, traj_file, state, corr_dir)
+        jobs.extend(state_jobs)
+    failed = scheduler.run_jobs(jobs, max_jobs, job_retries, monitor)
+    if(len(failed) > 0):
+        monitor.close()
+        print("ERROR: cpptraj jobs failed after %s retries: %s" % (job_retries, ", ".join(failed)))
+        sys.exit(1)
+    for (PDB_id, top_file, traj_file, state, corr_dir) in states:
+        if(n_shards[state] == 0):
+            continue  # every window came from the cache
+        shard_files = ["fluct_%s_sub_%s_shard%s.txt" % (PDB_id, state, k) for k in range(n_shards[state])]
+        scheduler.merge_fluct_shards(shard_files, "fluct_%s_sub_%s.txt" % (PDB_id, state))
+        for shard_file in shard_files:
+            os.remove(shard_file)
 
 #################################################################################
 # parse data files for further analyses
@@ -742,6 +1204,22 @@ def matrix_maker_batch_new():
             f_out.write("\n")   
 
 
+def matrix_maker_parallel():
+    # same matrix files as matrix_maker_old/matrix_maker_batch_old, parsed in bulk on a process pool
+    print("converting atomiccorr output to matrix (all proteins, %s processes)" % scheduler.default_jobs(max_jobs))
+    pairs = [("./corr_%s_all_query.txt" % PDB_id_query, "./corr_%s_all_query_matrix.txt" % PDB_id_query),
+             ("./corr_%s_all_reference.txt" % PDB_id_reference, "./corr_%s_all_reference_matrix.txt" % PDB_id_reference),
+             ("./corr_%s_all_referenceCTL.txt" % PDB_id_reference, "./corr_%s_all_referenceCTL_matrix.txt" % PDB_id_reference)]
+    for i in range(subsamples):
+        pairs.append(("./subsamples/atomcorr_query/corr_%s_sub_query_%s.txt" % (PDB_id_query, i), "./subsamples/atomcorr_query_matrix/corr_%s_sub_query_matrix_%s.txt" % (PDB_id_query, i)))
+        pairs.append(("./subsamples/atomcorr_ref/corr_%s_sub_reference_%s.txt" % (PDB_id_reference, i), "./subsamples/atomcorr_ref_matrix/corr_%s_sub_reference_matrix_%s.txt" % (PDB_id_reference, i)))
+        pairs.append(("./subsamples/atomcorr_refCTL/corr_%s_sub_referenceCTL_%s.txt" % (PDB_id_reference, i), "./subsamples/atomcorr_refCTL_matrix/corr_%s_sub_referenceCTL_matrix_%s.txt" % (PDB_id_reference, i)))
+    if(extend == "yes"):
+        # matrices of kept windows are already newer than their atomiccorr output
+        pairs = [(in_file, out_file) for (in_file, out_file) in pairs if not(os.path.exists(out_file) and os.path.getmtime(out_file) >= os.path.getmtime(in_file))]
+        print("%s correlation matrices to convert" % len(pairs))
+    convert_corr_files(pairs, length_prot, matrix_binary == "yes", scheduler.default_jobs(max_jobs), precision)
+
 def copy_flux():
     print("copying atom flux files to atomflux folder")
     os.system('cp fluct_%s_sub_query.txt ./subsamples/atomflux_query/fluct_%s_sub_query.txt' % (PDB_id_query, PDB_id_query))
@@ -776,53 +1254,78 @@ def resinfo():
                outfile.write("\n")
     outfile.close
 
-def runProgressBar():
-    import time
-    from progress.bar import IncrementalBar
-    bar = IncrementalBar('subsamples_completed', max=subsamples)
-    lst = os.listdir('subsamples/atomcorr_ref') # your directory path
-    num_files = 0
-    next_num_files = 0
-    while (num_files < subsamples):
-        if(num_files != next_num_files):
-            bar.next()
-        lst = os.listdir('subsamples/atomcorr_ref') # your directory path
-        num_files = len(lst)
-        time.sleep(2)
-        lst = os.listdir('subsamples/atomcorr_ref') # your directory path
-        next_num_files = len(lst)
-    bar.finish()
+def start_monitor():
+    # one progress stream per state and metric (per state when fused), fed by the workers
+    global monitor
+    streams = {}
+    for state in ["reference", "query", "referenceCTL"]:
+        if(fused_stage == "yes"):
+            streams[state] = len(todo[state])
+        else:
+            streams["%s flux" % state] = len(todo[state])
+            streams["%s corr" % state] = len(todo[state])
+    monitor = ProgressMonitor(streams)
+
+def finish_monitor():
+    # every worker has returned; stop on any failed or unfinished stream
+    monitor.close()
+    if not monitor.complete():
+        unfinished = [name for (name, message) in monitor.failures]
+        if(len(unfinished) == 0):  # a worker died without reporting (e.g. a native backend exception)
+            unfinished = [name for name in monitor.expected if(monitor.counts[name] < monitor.expected[name])]
+        print("ERROR: subsampling did not complete (%s)" % ", ".join(unfinished))
+        sys.exit(1)
 ###############################################################
 ###############################################################
 
 def main():
     write_control_files()
-    # creating thread
-    t1 = threading.Thread(target=subsample_reference_flux)
-    t2 = threading.Thread(target=subsample_referenceCTL_flux)
-    t3 = threading.Thread(target=subsample_query_flux)
-    t4 = threading.Thread(target=subsample_reference_corr)
-    t5 = threading.Thread(target=subsample_referenceCTL_corr)
-    t6 = threading.Thread(target=subsample_query_corr)
-    t7 = threading.Thread(target=runProgressBar)
-    t1.start() # start threads
-    t2.start()
-    t3.start() 
-    t4.start()
-    t5.start() 
-    t6.start()
-    t7.start()
-    t1.join()  # wait until threads are completely executed
-    t2.join()
-    t3.join() 
-    t4.join()
-    t5.join() 
-    t6.join()
-    t7.join()
+    if(average_cache == "yes" and (sampler_backend == "cpptraj" or flux_backend == "cpptraj")):
+        compute_averages()
+    clear_todo_outputs()
+    start_monitor()
+    if(use_scheduler == "yes" and sampler_backend == "cpptraj"):
+        scheduled_subsampling()
+    elif(fused_stage == "yes"):
+        # one thread per state, each window read once for both flux and corr
+        t1 = threading.Thread(target=subsample_fused, args=(PDB_id_reference, top_file_reference, traj_file_reference, "reference", "atomcorr_ref"))
+        t2 = threading.Thread(target=subsample_fused, args=(PDB_id_reference, top_file_reference, traj_file_reference, "referenceCTL", "atomcorr_refCTL"))
+        t3 = threading.Thread(target=subsample_fused, args=(PDB_id_query, top_file_query, traj_file_query, "query", "atomcorr_query"))
+        t1.start() # start threads
+        t2.start()
+        t3.start()
+        t1.join()  # wait until threads are completely executed
+        t2.join()
+        t3.join()
+    else:
+        # creating thread
+        t1 = threading.Thread(target=subsample_reference_flux)
+        t2 = threading.Thread(target=subsample_referenceCTL_flux)
+        t3 = threading.Thread(target=subsample_query_flux)
+        t4 = threading.Thread(target=subsample_reference_corr)
+        t5 = threading.Thread(target=subsample_referenceCTL_corr)
+        t6 = threading.Thread(target=subsample_query_corr)
+        t1.start() # start threads
+        t2.start()
+        t3.start() 
+        t4.start()
+        t5.start() 
+        t6.start()
+        t1.join()  # wait until threads are completely executed
+        t2.join()
+        t3.join() 
+        t4.join()
+        t5.join() 
+        t6.join()
+    finish_monitor()
     
+    if(use_cache == "yes" or extend == "yes"):
+        finish_flux_tables()
+    copy_shared_products()
     print("subsampling of MD trajectories is completed") 
-    matrix_maker_old()  # for older version of cpptraj
-    matrix_maker_batch_old() # for older version of cpptraj
+    matrix_maker_parallel()  # for older version of cpptraj
+    #matrix_maker_old()  # for older version of cpptraj (one file at a time)
+    #matrix_maker_batch_old() # for older version of cpptraj (one file at a time)
     #matrix_maker_new()
     #matrix_maker_batch_new()
     copy_flux()
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+#############################################################################
+######   This script splits the DROIDS subsample windows into shards,
+######   writes one cpptraj .ctl per shard, runs them on a bounded pool
+######   sized to the machine and merges the shard outputs back into the
+######   files the rest of the pipeline reads
+######   It is part of the DROIDS v6.0 ChimeraX plug-in suite for
+######   machine-learning assisted comparative protein dynamics
+######   produced by Dr. Gregory A. Babbitt and students at the
+######   Rochester Instituteof Technology in 2022.   License under GPL v3.0
+#############################################################################
+
+import hashlib
+import os
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+MASK = "@CA,C,O,N&!(:WAT)"
+
+def default_jobs(max_jobs=0):
+    # max_jobs <= 0 means one job per available core
+    if(max_jobs <= 0):
+        if hasattr(os, "sched_getaffinity"):
+            return max(1, len(os.sched_getaffinity(0)))
+        return max(1, os.cpu_count() or 1)
+    return max_jobs
+
+def shard_windows(n_windows, n_shards):
+    """split subsample indices 0..n_windows-1 into contiguous, near equal shards
+    Arguments:
+        n_windows {int} -- [number of subsample windows]
+        n_shards {int} -- [requested number of shards]
+    Returns:
+        [list] -- [one list of window indices per (non-empty) shard]
+    """
+    n_shards = max(1, min(n_shards, n_windows))
+    size, extra = divmod(n_windows, n_shards)
+    shards = []
+    first = 0
+    for k in range(n_shards):
+        last = first+size+(1 if k < extra else 0)
+        shards.append(list(range(first, last)))
+        first = last
+    return shards
+
+def write_shard_control_file(path, top_file, traj_file, windows, indices, flux_out=None, corr_out=None, avg_file=None):
+    """write one cpptraj .ctl covering a shard of subsample windows
+    Arguments:
+        path {str} -- [.ctl file to write]
+        windows {list} -- [(start, stop) of every subsample window]
+        indices {list} -- [window indices in this shard]
+        flux_out {str} -- [atomicfluct output for the shard, one column per window] (default: {None})
+        corr_out {str} -- [atomiccorr output pattern with one %s for the window index] (default: {None})
+        avg_file {str} -- [cached average structure; None rebuilds it from the whole run] (default: {None})
+    """
+    f = open(path, "w")
+    f.write("parm %s\n" % top_file)
+    if flux_out is not None:
+        # fluctuations are taken about the whole-run average structure
+        if avg_file is None:
+            f.write("trajin %s\n" % traj_file)
+        write_average_setup(f, avg_file)
+    for x in indices:
+        (start, stop) = windows[x]
+        f.write("clear trajin\n")
+        f.write("trajin %s %s %s\n" % (traj_file, start, stop))
+        if flux_out is not None:
+            f.write("rms ref MyAvg\n")
+            f.write("atomicfluct out %s %s byres\n" % (flux_out, MASK))
+        if corr_out is not None:
+            f.write("atomiccorr out %s %s byres\n" % (corr_out % x, MASK))
+        f.write("run\n")
+    f.close()
+
+def average_name(traj_file):
+    # trajectory basename plus a short hash of its real path, so that e.g. ref/prod.nc and
+    # query/prod.nc never share an average (or its ctl) while every script finds the same file
+    path_hash = hashlib.sha256(os.path.realpath(traj_file).encode()).hexdigest()[:8]
+    return "%s_%s" % (os.path.splitext(os.path.basename(traj_file))[0], path_hash)
+
+def average_file(traj_file):
+    # cached average structure (MyAvg) of a trajectory, named after the trajectory
+    return "MyAvg_%s.rst7" % average_name(traj_file)
+
+def write_average_setup(f, avg_file=None):
+    # make MyAvg available to later 'rms ref MyAvg' lines of an open .ctl
+    if avg_file is None:
+        f.write("rms first\n")
+        f.write("average crdset MyAvg\n")
+        f.write("run\n")
+    else:
+        f.write("loadcrd %s MyAvg\n" % avg_file)
+
+def average_job(top_file, traj_file):
+    """write the .ctl that averages a trajectory once into average_file(traj_file)
+    Arguments:
+        top_file {str} -- [topology]
+        traj_file {str} -- [trajectory]
+    Returns:
+        [dict] -- [job for run_job/run_jobs]
+    """
+    avg_file = average_file(traj_file)
+    name = average_name(traj_file)
+    f = open("./atomavg_%s.ctl" % name, "w")
+    f.write("parm %s\n" % top_file)
+    f.write("trajin %s\n" % traj_file)
+    f.write("rms first\n")
+    f.write("average %s\n" % avg_file)
+    f.write("run\n")
+    f.close()
+    return {"name": "average_%s" % name, "outputs": [avg_file],
+            "cmd": "cpptraj -i atomavg_%s.ctl -o avg_%s_out.txt" % (name, name)}
+
+def run_job(job, retries=1, monitor=None):
+    """run one shell job, retrying when it fails or leaves an expected output missing
+    Arguments:
+        job {dict} -- [name, cmd and outputs (files that must exist afterwards); optional
+                       stream and windows to report to a progress monitor]
+        retries {int} -- [extra attempts after the first] (default: {1})
+        monitor {ProgressMonitor} -- [receives the job's windows or its failure] (default: {None})
+    Returns:
+        [bool] -- [True when the job succeeded]
+    """
+    for attempt in range(retries+1):
+        for out in job["outputs"]:
+            if os.path.exists(out):
+                os.remove(out)  # a failed attempt must not leave half written columns behind
+        status = subprocess.call(job["cmd"], shell=True)
+        missing = [out for out in job["outputs"] if not os.path.exists(out)]
+        if (status == 0 and len(missing) == 0):
+            if (monitor is not None and job.get("stream") is not None):
+                monitor.done(job["stream"], job.get("windows", 0))
+            return True
+        print("job %s failed (exit %s, %s missing outputs), attempt %s of %s" % (job["name"], status, len(missing), attempt+1, retries+1))
+    if monitor is not None:
+        monitor.failed(job.get("stream") or job["name"], "job %s gave up after %s attempts" % (job["name"], retries+1))
+    return False
+
+def run_jobs(jobs, max_jobs=0, retries=1, monitor=None):
+    """run jobs on at most max_jobs concurrent cpptraj processes
+    Arguments:
+        jobs {list} -- [job dicts, see run_job]
+        max_jobs {int} -- [concurrency limit, <= 0 for one per core] (default: {0})
+        retries {int} -- [per job retries] (default: {1})
+        monitor {ProgressMonitor} -- [progress of the jobs, see run_job] (default: {None})
+    Returns:
+        [list] -- [names of jobs that still failed after all retries]
+    """
+    # each worker only waits on its cpptraj child process, so threads are enough to
+    # keep max_jobs processes busy without pickling anything
+    with ThreadPoolExecutor(max_workers=default_jobs(max_jobs)) as pool:
+        results = list(pool.map(run_job, jobs, [retries]*len(jobs), [monitor]*len(jobs)))
+    return [job["name"] for job, ok in zip(jobs, results) if not ok]
+
+def run_counted(cmd, log_file, monitor=None, stream=None, skip=0, windows=None):
+    """run one cpptraj command over many windows, reporting each window as it finishes
+    cpptraj prints a RUN TIMING block at the end of every 'run'; the first skip runs
+    (e.g. the whole-run average) are not windows. Output goes to log_file as with -o.
+    A run that exits 0 with fewer windows than expected fails the stream.
+    Arguments:
+        cmd {str} -- [cpptraj command without -o]
+        log_file {str} -- [cpptraj output log]
+        monitor {ProgressMonitor} -- [progress of stream] (default: {None})
+        stream {str} -- [progress stream of the windows] (default: {None})
+        skip {int} -- [leading runs that are not subsample windows] (default: {0})
+        windows {int} -- [subsample windows the command must run; None = not checked] (default: {None})
+    Returns:
+        [int] -- [exit status]
+    """
+    runs = 0
+    with open(log_file, "w") as log:
+        proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+        for line in proc.stdout:
+            log.write(line)
+            if "RUN TIMING" in line:
+                runs += 1
+                if (monitor is not None and runs > skip):
+                    monitor.done(stream)
+        status = proc.wait()
+    if monitor is not None:
+        if (status != 0):
+            monitor.failed(stream, "'%s' exited with %s, see %s" % (cmd, status, log_file))
+        elif (windows is not None and runs-skip < windows):
+            monitor.failed(stream, "'%s' ran %s of %s windows, see %s" % (cmd, max(0, runs-skip), windows, log_file))
+        else:
+            monitor.finish_stream(stream)
+    return status
+
+def read_fluct_columns(path):
+    """split an atomicfluct table into its residue labels and value columns (kept as text)
+    Returns:
+        [list] -- [residue labels]
+        [list] -- [one list of values per data column]
+    """
+    with open(path, "r") as f:
+        rows = [line.split() for line in f if line.strip() != ""]
+    labels = [row[0] for row in rows[1:]]
+    columns = [[row[c] for row in rows[1:]] for c in range(1, len(rows[0]))]
+    return labels, columns
+
+def write_fluct_columns(path, labels, columns):
+    # same layout as write_fluct_table / cpptraj 'atomicfluct out' with one column per window
+    names = ["AtomicFlx"] + ["AtomicFlx_%05d" % x for x in range(1, len(columns))]
+    with open(path, "w") as f:
+        f.write("#Res     %s\n" % " ".join("%12s" % name for name in names))
+        for r in range(len(labels)):
+            f.write("%8s %s\n" % (labels[r], " ".join("%12s" % col[r] for col in columns)))
+
+def merge_fluct_shards(shard_files, out_file):
+    """join per-shard atomicfluct tables column-wise, in shard order
+    Arguments:
+        shard_files {list} -- [shard outputs in window order]
+        out_file {str} -- [merged fluct_*_sub_*.txt file]
+    """
+    labels = []
+    columns = []
+    for shard_file in shard_files:
+        labels, shard_columns = read_fluct_columns(shard_file)
+        columns.extend(shard_columns)
+    write_fluct_columns(out_file, labels, columns)
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+#############################################################################
+######   This script keeps the seeded subsample window plan that every
+######   DROIDS sampler (cpptraj_sampler, cpptraj_ortholog_sampler and the
+######   queryLG deployment runs of chimerax_coordyn) takes its frames from
+######   It is part of the DROIDS v6.0 ChimeraX plug-in suite for
+######   machine-learning assisted comparative protein dynamics
+######   produced by Dr. Gregory A. Babbitt and students at the
+######   Rochester Instituteof Technology in 2022.   License under GPL v3.0
+#############################################################################
+
+import json
+import os
+import random as rnd
+
+PLAN_FILE = "subsamples/window_plan.json"
+
+def load_plan(path=PLAN_FILE):
+    # empty plan when nothing was saved yet
+    if not os.path.exists(path):
+        return {"seed": None, "states": {}}
+    with open(path, "r") as f:
+        return json.load(f)
+
+def saved_windows(state, path=PLAN_FILE):
+    # windows of a state in the saved plan, as (start, stop); empty when it has none
+    entry = load_plan(path)["states"].get(state)
+    if entry is None:
+        return []
+    return [(start, stop) for (start, stop) in entry["windows"]]
+
+def save_plan(plan, path=PLAN_FILE):
+    # write next to the target and rename, so readers never see a half written plan
+    folder = os.path.dirname(path)
+    if (folder != "" and not os.path.exists(folder)):
+        os.makedirs(folder)
+    tmp = "%s.tmp%s" % (path, os.getpid())
+    with open(tmp, "w") as f:
+        json.dump(plan, f, indent=1)
+    os.replace(tmp, path)
+
+def draw_windows(n_windows, n_frames, frame_size, rng):
+    """draw random subsample windows as the samplers always have
+    Arguments:
+        n_windows {int} -- [number of windows]
+        n_frames {int} -- [frames in the trajectory]
+        frame_size {int} -- [frames per window]
+        rng {random.Random} -- [random number generator]
+    Returns:
+        [list] -- [[start, stop] pairs, 1-based frames as used by cpptraj trajin]
+    """
+    windows = []
+    for x in range(n_windows):
+        upper_limit = n_frames-frame_size
+        start = rng.randint(1, upper_limit)
+        stop = start+frame_size
+        windows.append([start, stop])
+    return windows
+
+def plan_windows(state, n_windows, n_frames, frame_size, traj_file, seed=None, path=PLAN_FILE, extend=False):
+    """windows for one state, reused from the saved plan when it still matches the run
+    Arguments:
+        state {str} -- [reference, query, referenceCTL, queryLG, ortho ...]
+        n_windows {int} -- [number of subsample windows]
+        n_frames {int} -- [frames in the trajectory]
+        frame_size {int} -- [frames per window]
+        traj_file {str} -- [trajectory the windows index into]
+        seed {str} -- [plan seed; None keeps the saved seed or draws a new one] (default: {None})
+        path {str} -- [plan file] (default: {PLAN_FILE})
+        extend {bool} -- [keep the saved windows of a smaller plan and append new ones; they are
+                          the windows a fresh plan of n_windows would draw] (default: {False})
+    Returns:
+        [list] -- [(start, stop) per subsample window]
+    """
+    plan = load_plan(path)
+    if (seed is not None and str(seed) != plan["seed"]):
+        plan = {"seed": None, "states": {}}  # new seed, new plan
+    if plan["seed"] is None:
+        plan["seed"] = str(seed) if seed is not None else str(rnd.SystemRandom().randrange(2**31))
+    entry = plan["states"].get(state)
+    if (extend and entry is not None and entry["n_frames"] == n_frames and entry["frame_size"] == frame_size
+            and entry["traj_file"] == traj_file and len(entry["windows"]) < n_windows):
+        # the state's stream repeats the saved windows first, so only the tail is new
+        rng = rnd.Random("%s_%s" % (plan["seed"], state))
+        n_kept = len(entry["windows"])
+        entry["windows"] = entry["windows"] + draw_windows(n_windows, n_frames, frame_size, rng)[n_kept:]
+        save_plan(plan, path)
+        print("extended the subsample windows of %s from %s to %s (plan seed %s)" % (state, n_kept, n_windows, plan["seed"]))
+    if (entry is None or entry["n_frames"] != n_frames or entry["frame_size"] != frame_size
+            or entry["traj_file"] != traj_file or len(entry["windows"]) != n_windows):
+        # every state has its own stream, so states stay independent draws
+        rng = rnd.Random("%s_%s" % (plan["seed"], state))
+        entry = {"n_frames": n_frames, "frame_size": frame_size, "traj_file": traj_file,
+                 "windows": draw_windows(n_windows, n_frames, frame_size, rng)}
+        plan["states"][state] = entry
+        save_plan(plan, path)
+        print("drew %s subsample windows for %s (plan seed %s)" % (n_windows, state, plan["seed"]))
+    else:
+        print("reusing %s subsample windows for %s from %s" % (n_windows, state, path))
+    return [(start, stop) for (start, stop) in entry["windows"]]
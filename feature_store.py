@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+#############################################################################
+######   This script stores the DROIDS machine-learning feature matrices
+######   (sites x features, one per state and subsample) as binary .npy
+######   files (thresholded correlations as sparse CSR .npz files) with a
+######   small JSON manifest per feature folder, plus an optional text
+######   export in the old DataFrame.to_string layout
+######   It is part of the DROIDS v6.0 ChimeraX plug-in suite for
+######   machine-learning assisted comparative protein dynamics
+######   produced by Dr. Gregory A. Babbitt and students at the
+######   Rochester Instituteof Technology in 2022.   License under GPL v3.0
+#############################################################################
+
+import json
+import os
+import numpy as np
+import pandas as pd
+import scipy.sparse as sparse
+try:
+    import fcntl
+except ImportError:  # no advisory locks (Windows): write a feature folder from one process
+    fcntl = None
+
+MANIFEST = "manifest.json"
+SETTINGS = "settings"  # manifest entry of the settings a folder's features were built with
+PRECISIONS = ("float64", "float32")
+precision = "float64"  # storage type of the feature matrices, see set_precision
+
+def set_precision(name):
+    # float32 halves every feature file and the stacks and tensors built from them
+    global precision
+    if name not in PRECISIONS:
+        raise ValueError("precision must be one of %s, not %s" % (", ".join(PRECISIONS), name))
+    precision = name
+
+def precision_report(label, value, reference, tol):
+    """compare a float32 result with its float64 recomputation
+    Arguments:
+        label {str} -- [what was compared]
+        value {ndarray} -- [float32 result]
+        reference {ndarray} -- [float64 result of the same computation]
+        tol {float} -- [largest accepted deviation, relative to the largest reference value]
+    Returns:
+        [bool] -- [True when the deviation is within tol]
+    """
+    value = np.asarray(value, dtype=np.float64)
+    reference = np.asarray(reference, dtype=np.float64)
+    deviation = np.abs(value - reference).max() / max(np.abs(reference).max(), np.finfo(np.float64).tiny)
+    ok = deviation <= tol
+    print("precision check (%s): float32 deviates %.2e from float64 (tolerance %s) %s"
+          % (label, deviation, tol, "ok" if ok else "EXCEEDED - rerun with precision,float64"))
+    return ok
+
+def feature_file(path):
+    # binary file kept next to the (optional) text dump of the same features
+    return "%s.npy" % os.path.splitext(path)[0]
+
+def sparse_file(path):
+    # CSR file of a thresholded correlation matrix (replaces the .npy of the same features)
+    return "%s.npz" % os.path.splitext(path)[0]
+
+def rewrite_manifest(folder, change):
+    # apply change (a function editing the manifest dict) to a feature folder's manifest; rewritten by rename
+    manifest_file = os.path.join(folder, MANIFEST)
+    with open("%s.lock" % manifest_file, "w") as lock:
+        # worker processes filling the same folder must not drop each other's entries
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        manifest = {}
+        if os.path.exists(manifest_file):
+            with open(manifest_file, "r") as f:
+                manifest = json.load(f)
+        change(manifest)
+        tmp = "%s.tmp%s" % (manifest_file, os.getpid())
+        with open(tmp, "w") as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        os.replace(tmp, manifest_file)
+
+def update_manifest(folder, name, array, drop=None):
+    # shape and dtype of every matrix in a feature folder (and nnz/density of sparse
+    # ones); drop removes the entry of a file the new one replaces
+    def change(manifest):
+        manifest[name] = {"shape": list(array.shape), "dtype": str(array.dtype)}
+        if sparse.issparse(array):
+            manifest[name]["nnz"] = int(array.nnz)
+            manifest[name]["density"] = array.nnz / float(max(1, array.shape[0]*array.shape[1]))
+        if drop is not None:
+            manifest.pop(drop, None)
+    rewrite_manifest(folder, change)
+
+def save_features(path, values, text=False, dtype=None):
+    """store one feature matrix
+    Arguments:
+        path {str} -- [feature file as the analyzers name it, e.g.
+                       ./features/featureFLUX_sub_ref/feature_1abc_sub_ref_0.txt]
+        values {DataFrame or ndarray} -- [sites x features]
+        text {bool} -- [also write the human readable text dump to path] (default: {False})
+        dtype {str} -- [float64 or float32; None uses the precision setting] (default: {None})
+    """
+    array = np.asarray(values).astype(dtype or precision, copy=False)
+    npy = feature_file(path)
+    folder = os.path.dirname(npy)
+    if (folder != "" and not os.path.exists(folder)):
+        os.makedirs(folder)
+    tmp = "%s.tmp%s.npy" % (os.path.splitext(npy)[0], os.getpid())
+    np.save(tmp, np.ascontiguousarray(array))
+    os.replace(tmp, npy)
+    npz = sparse_file(path)
+    if os.path.exists(npz):
+        os.remove(npz)  # load_sparse_features would otherwise still return the old sparse copy
+    update_manifest(folder, os.path.basename(npy), array, os.path.basename(npz))
+    if text:
+        with open(path, "w") as f:
+            f.write(pd.DataFrame(array).to_string(header=False, index=True))
+
+def save_sparse_features(path, matrix, text=False, dtype=None):
+    """store one thresholded correlation matrix in CSR form
+    Arguments:
+        path {str} -- [feature file as the analyzers name it, see save_features]
+        matrix {spmatrix} -- [sites x features, weak correlations already zeroed]
+        text {bool} -- [also write the (dense) text dump to path] (default: {False})
+        dtype {str} -- [float64 or float32; None uses the precision setting] (default: {None})
+    Returns:
+        [float] -- [density (fraction of non-zero entries)]
+    """
+    matrix = sparse.csr_matrix(matrix, dtype=dtype or precision)
+    npz = sparse_file(path)
+    folder = os.path.dirname(npz)
+    if (folder != "" and not os.path.exists(folder)):
+        os.makedirs(folder)
+    tmp = "%s.tmp%s.npz" % (os.path.splitext(npz)[0], os.getpid())
+    sparse.save_npz(tmp, matrix)
+    os.replace(tmp, npz)
+    npy = feature_file(path)
+    if os.path.exists(npy):
+        os.remove(npy)  # load_features prefers the .npy, so a stale dense copy must go
+    update_manifest(folder, os.path.basename(npz), matrix, os.path.basename(npy))
+    if text:
+        with open(path, "w") as f:
+            f.write(pd.DataFrame(matrix.toarray()).to_string(header=False, index=True))
+    return matrix.nnz / float(max(1, matrix.shape[0]*matrix.shape[1]))
+
+def load_sparse_features(path):
+    # CSR matrix written by save_sparse_features, or None when path was stored dense
+    npz = sparse_file(path)
+    if os.path.exists(npz):
+        return sparse.load_npz(npz).tocsr()
+    return None
+
+def load_features(path, mmap=False):
+    """read one feature matrix written by save_features (or an old text dump)
+    Arguments:
+        path {str} -- [feature file name as given to save_features]
+        mmap {bool} -- [memory-map the .npy instead of reading it] (default: {False})
+    Returns:
+        [ndarray] -- [sites x features]
+    """
+    npy = feature_file(path)
+    if os.path.exists(npy):
+        return np.load(npy, mmap_mode="r" if mmap else None)
+    if os.path.exists(sparse_file(path)):
+        return load_sparse_features(path).toarray()
+    df = pd.read_csv(path, sep="\s+", header=None)  # feature folders from before the binary store
+    return df.values[:, 1:].astype(np.float64)
+
+def feature_shape(path):
+    # (sites, features) from the manifest, without reading the matrix
+    npy = feature_file(path)
+    manifest_file = os.path.join(os.path.dirname(npy), MANIFEST)
+    if os.path.exists(manifest_file):
+        with open(manifest_file, "r") as f:
+            manifest = json.load(f)
+        for name in (os.path.basename(npy), os.path.basename(sparse_file(path))):
+            if manifest.get(name) is not None:
+                return tuple(manifest[name]["shape"])
+    if os.path.exists(sparse_file(path)):
+        return load_sparse_features(path).shape
+    return load_features(path, mmap=True).shape
+
+def stored_mtime(path):
+    # modification time of a feature matrix in whichever form it was stored; None when missing
+    for stored in (feature_file(path), sparse_file(path), path):
+        if os.path.exists(stored):
+            return os.path.getmtime(stored)
+    return None
+
+def recorded_settings(pattern):
+    # settings recorded (record_settings) in the folder of a feature file pattern; {} when none
+    manifest_file = os.path.join(os.path.dirname(pattern), MANIFEST)
+    if not os.path.exists(manifest_file):
+        return {}
+    with open(manifest_file, "r") as f:
+        return json.load(f).get(SETTINGS, {})
+
+def record_settings(pattern, settings):
+    # note the settings the features in the folder of pattern were built with (merged into earlier ones)
+    folder = os.path.dirname(pattern)
+    if (folder != "" and not os.path.exists(folder)):
+        os.makedirs(folder)
+    rewrite_manifest(folder, lambda manifest: manifest.setdefault(SETTINGS, {}).update(settings))
+
+def settings_changed(pattern, settings):
+    # True when any of settings differs from (or is missing in) what the folder's features were built with
+    recorded = recorded_settings(pattern)
+    return any(recorded.get(name) != value for (name, value) in settings.items())
+
+def stale_indices(pattern, source_pattern, n_samples, settings=None):
+    """subsample indices whose feature matrix is missing or older than its source
+    An extended run rebuilds only these and leaves the features of the kept subsamples alone.
+    When settings differ from those recorded with the features (record_settings), every
+    subsample is stale, so features of different settings are never mixed.
+    Arguments:
+        pattern {str} -- [feature file name with %s for the subsample index]
+        source_pattern {str} -- [file the feature matrix is built from, with %s for the subsample index]
+        n_samples {int} -- [number of subsamples]
+        settings {dict} -- [settings the features are built with, e.g. corr_threshold] (default: {None})
+    Returns:
+        [list] -- [subsample indices to build, in order]
+    """
+    if (settings is not None and settings_changed(pattern, settings)):
+        print("%s: features were built with other settings (%s now), rebuilding all %s subsamples" % (os.path.dirname(pattern), settings, n_samples))
+        return list(range(n_samples))
+    stale = []
+    for j in range(n_samples):
+        built = stored_mtime(pattern % j)
+        source = stored_mtime(source_pattern % j)
+        if (built is None or source is None or built < source):
+            stale.append(j)
+    return stale
+
+def site_rows(path):
+    """feature rows in the order the per-site analyses index them
+    The text dumps were read back with their first row taken as a header, so site i
+    of the MMD, coordinated and conserved dynamics loops has always been row i+1.
+    Returns:
+        [ndarray] -- [(sites-1) x features]
+    """
+    return load_features(path)[1:]
+
+def tensor_file(pattern):
+    # site-major tensor of a feature set, next to its per-subsample matrices
+    return feature_file(pattern % "sites")
+
+def site_tensor(pattern, n_samples):
+    """one state's feature set as a (sites x subsamples x features) memory-mapped array
+    Built once (again only when a subsample matrix is newer than the tensor), so the
+    per-site loops take one slice per site instead of parsing every file per site.
+    Arguments:
+        pattern {str} -- [feature file name with %s for the subsample index, e.g.
+                          ./features/featureFLUX_sub_ref/feature_1abc_sub_ref_%s.txt]
+        n_samples {int} -- [number of subsamples]
+    Returns:
+        [memmap] -- [rows aligned with site_rows: [i] holds site i of every subsample]
+    """
+    out_file = tensor_file(pattern)
+    sources = []
+    for j in range(n_samples):
+        npy = feature_file(pattern % j)
+        sources.append(npy if os.path.exists(npy) else pattern % j)
+    newest = max(os.path.getmtime(source) for source in sources)
+    if (not os.path.exists(out_file) or os.path.getmtime(out_file) < newest
+            or np.load(out_file, mmap_mode="r").shape[1] != n_samples):
+        first = load_features(pattern % 0, mmap=True)
+        tmp = "%s.tmp%s.npy" % (os.path.splitext(out_file)[0], os.getpid())
+        tensor = np.lib.format.open_memmap(tmp, mode="w+", dtype=first.dtype,
+                                           shape=(first.shape[0], n_samples, first.shape[1]))
+        for j in range(n_samples):
+            tensor[:, j, :] = load_features(pattern % j, mmap=True)
+        tensor.flush()
+        del tensor
+        os.replace(tmp, out_file)
+        update_manifest(os.path.dirname(out_file), os.path.basename(out_file), np.load(out_file, mmap_mode="r"))
+    return np.load(out_file, mmap_mode="r")[1:]
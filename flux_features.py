@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+#############################################################################
+######   This script builds the DROIDS fluctuation feature vectors
+######   (featureFLUX_*: each site's normalized atom fluctuation with that
+######   of its sequence neighbors) and the combined flux + reduced
+######   correlation vectors (featureCOMBINE_*) for all subsamples of a
+######   state at once
+######   It is part of the DROIDS v6.0 ChimeraX plug-in suite for
+######   machine-learning assisted comparative protein dynamics
+######   produced by Dr. Gregory A. Babbitt and students at the
+######   Rochester Instituteof Technology in 2022.   License under GPL v3.0
+#############################################################################
+
+import os
+import numpy as np
+import pandas as pd
+import feature_store
+
+FLUX_WINDOW = 5  # sites per fluctuation feature vector (j-2 .. j+2)
+N_CORR = 5  # reduced correlation features appended in featureCOMBINE (option take first 5 columns)
+
+flux_tables = {}  # (file, mtime) -> normalized table, so every builder shares one parse per file
+
+def flux_table(path):
+    """all subsample columns of a wide atomflux table, min-max normalized per column
+    Parsed once per file (again only when the file changes) and shared by the
+    correlation, fluctuation and combined feature builders.
+    Arguments:
+        path {str} -- [fluct_*_sub_*.txt, residue label plus one column per subsample window]
+    Returns:
+        [ndarray] -- [subsample windows x residues]
+    """
+    key = (os.path.abspath(path), os.path.getmtime(path))
+    if key not in flux_tables:
+        df = pd.read_csv(path, sep="\s+")
+        values = df.values[:, 1:].astype(np.float64).T
+        lo = np.nanmin(values, axis=1, keepdims=True)
+        hi = np.nanmax(values, axis=1, keepdims=True)
+        for old in [k for k in flux_tables if k[0] == key[0]]:
+            del flux_tables[old]
+        flux_tables[key] = (values - lo) / (hi - lo)
+    return flux_tables[key]
+
+def normalized_flux(path, n_samples, length_prot):
+    # the first n_samples windows of an atomflux table, cut to length_prot sites
+    return flux_table(path)[:n_samples, :length_prot]
+
+def window_features(flux, width=FLUX_WINDOW):
+    """neighbor windows of every site, for all subsamples in one gather
+    A neighbor beyond either end of the chain takes the value of the site itself.
+    Arguments:
+        flux {ndarray} -- [subsamples x sites]
+        width {int} -- [odd window width] (default: {FLUX_WINDOW})
+    Returns:
+        [ndarray] -- [subsamples x sites x width]
+    """
+    if (width < 1 or width % 2 == 0):
+        raise ValueError("flux window width must be a positive odd number, not %s" % width)
+    half = width // 2
+    sites = np.arange(flux.shape[-1])[:, None]
+    neighbors = sites + np.arange(-half, half+1)[None, :]
+    inside = (neighbors >= 0) & (neighbors < flux.shape[-1])
+    return flux[..., np.where(inside, neighbors, sites)]
+
+def combine_features(windows, reduced, n_corr=N_CORR):
+    """append the first n_corr reduced correlation features to the fluctuation windows
+    Rows are matched by site and cut to the shorter of the two (inner join).
+    Arguments:
+        windows {ndarray} -- [subsamples x sites x width]
+        reduced {ndarray} -- [subsamples x sites x setSize]
+    Returns:
+        [ndarray] -- [subsamples x sites x (width + n_corr)]
+    """
+    n_sites = min(windows.shape[1], reduced.shape[1])
+    return np.concatenate([windows[:, :n_sites], reduced[:, :n_sites, :n_corr]], axis=2)
+
+def state_features(flux_file, reduced_pattern, n_samples, length_prot, width=FLUX_WINDOW):
+    """featureFLUX and featureCOMBINE arrays of every subsample of a state
+    Arguments:
+        flux_file {str} -- [fluct_*_sub_*.txt of the state]
+        reduced_pattern {str} -- [feature_sub_*_reduced file name with %s for the subsample index]
+        n_samples {int} -- [number of subsamples]
+        length_prot {int} -- [sites]
+        width {int} -- [window width] (default: {FLUX_WINDOW})
+    Returns:
+        [ndarray] -- [featureFLUX, subsamples x sites x width]
+        [ndarray] -- [featureCOMBINE, subsamples x sites x (width + N_CORR)]
+    """
+    windows = window_features(normalized_flux(flux_file, n_samples, length_prot), width)
+    reduced = np.stack([feature_store.load_features(reduced_pattern % i, mmap=True) for i in range(n_samples)])
+    return windows, combine_features(windows, reduced)
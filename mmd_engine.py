@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+#############################################################################
+######   This script computes the site-wise maximum mean discrepancy
+######   (MMD) between the learned features of two states for all sites
+######   at once, in batched kernel passes over chunks of sites (optionally
+######   spread over a process pool sharing the feature tensors), with the
+######   quadratic-time estimator, a linear-time block estimator or a
+######   random Fourier feature approximation
+######   It is part of the DROIDS v6.0 ChimeraX plug-in suite for
+######   machine-learning assisted comparative protein dynamics
+######   produced by Dr. Gregory A. Babbitt and students at the
+######   Rochester Instituteof Technology in 2022.   License under GPL v3.0
+#############################################################################
+
+import numpy as np
+from scipy.stats import norm, kstest
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import rff_features
+
+MEMORY_BUDGET = 256*2**20  # bytes of kernel matrices held at once (sites are processed in chunks)
+ESTIMATORS = {"quadratic": 0, "linear": 2, "block": None, "rff": 0}  # estimator -> block size (0 = all pairs, None = mmd_block)
+
+def sq_distances(X, Y, same=False):
+    """squared euclidean distances of every pair of rows, per site
+    Arguments:
+        X {ndarray} -- [sites x n_samples1 x features]
+        Y {ndarray} -- [sites x n_samples2 x features]
+        same {bool} -- [Y is X: the diagonal is exactly zero, as in sklearn] (default: {False})
+    Returns:
+        [ndarray] -- [sites x n_samples1 x n_samples2]
+    """
+    XX = np.einsum("lnd,lnd->ln", X, X)
+    YY = XX if same else np.einsum("lmd,lmd->lm", Y, Y)
+    D = XX[:, :, None] + YY[:, None, :] - 2*np.matmul(X, Y.transpose(0, 2, 1))
+    np.maximum(D, 0, out=D)  # rounding can leave tiny negative distances
+    if same:
+        D[:, np.arange(D.shape[1]), np.arange(D.shape[1])] = 0
+    return D
+
+def rbf_mean(X, Y, gamma, same=False):
+    # mean of the rbf kernel matrix k(x,y) = exp(-gamma * ||x-y||^2), per site
+    D = sq_distances(X, Y, same)
+    np.multiply(D, -gamma, out=D)
+    np.exp(D, out=D)
+    return D.mean(axis=(1, 2))
+
+def chunk_sites(n_x, n_y, itemsize, budget=MEMORY_BUDGET, n_groups=1):
+    # sites per batched pass so that the three kernel matrices (of every group) of a chunk fit the budget
+    per_site = n_groups*(n_x*n_x + n_y*n_y + n_x*n_y)*itemsize
+    return max(1, int(budget // max(1, per_site)))
+
+def site_mmd(site_X, site_Y, gamma, budget=MEMORY_BUDGET):
+    """MMD^2 of every site with the rbf (gaussian) kernel, as mmd_rbf_* for one site at a time
+    Arguments:
+        site_X {ndarray} -- [sites x n_samples1 x features, e.g. a feature_store.site_tensor]
+        site_Y {ndarray} -- [sites x n_samples2 x features]
+        gamma {float} -- [kernel parameter]
+        budget {int} -- [bytes of kernel matrices per batched pass] (default: {MEMORY_BUDGET})
+    Returns:
+        [ndarray] -- [MMD^2 per site]
+    """
+    if (site_X.shape[0] != site_Y.shape[0] or site_X.shape[2] != site_Y.shape[2]):
+        raise ValueError("feature tensors differ in sites or features: %s vs %s" % (site_X.shape, site_Y.shape))
+    dtype = np.result_type(site_X.dtype, site_Y.dtype, np.float32)
+    step = chunk_sites(site_X.shape[1], site_Y.shape[1], np.dtype(dtype).itemsize, budget)
+    out = np.empty(site_X.shape[0], dtype=np.float64)
+    for first in range(0, site_X.shape[0], step):
+        X = np.asarray(site_X[first:first+step], dtype=dtype)
+        Y = np.asarray(site_Y[first:first+step], dtype=dtype)
+        out[first:first+step] = rbf_mean(X, X, gamma, True) + rbf_mean(Y, Y, gamma, True) - 2*rbf_mean(X, Y, gamma)
+    return out
+
+def bootstrap_pairs(n_sites, n_bootstrap, n_x, n_y, rng):
+    """random subsample pairs of every null replicate, as the per-site bootstrap loops draw them
+    Arguments:
+        n_sites {int} -- [sites]
+        n_bootstrap {int} -- [replicates per site]
+        n_x {int} -- [subsamples of the first state]
+        n_y {int} -- [subsamples of the second state]
+        rng {numpy.random.Generator} -- [random number generator]
+    Returns:
+        [ndarray] -- [subsample index into the first state, sites x n_bootstrap]
+        [ndarray] -- [subsample index into the second state, sites x n_bootstrap]
+    """
+    return rng.integers(0, n_x, size=(n_sites, n_bootstrap)), rng.integers(0, n_y, size=(n_sites, n_bootstrap))
+
+def null_mmd(site_X, site_Y, gamma, index_X, index_Y, budget=MEMORY_BUDGET):
+    """signed neutral MMD^2 of single-subsample pairs, looked up in one cross kernel per site
+    The MMD^2 of two single vectors x and y is 2 - 2*k(x,y); it is negated when the mean of y
+    is above the mean of x, as the bootstrap loops always have.
+    Arguments:
+        site_X {ndarray} -- [sites x n_samples1 x features]
+        site_Y {ndarray} -- [sites x n_samples2 x features]
+        gamma {float} -- [kernel parameter]
+        index_X {ndarray} -- [subsample of site_X in each replicate, sites x n_bootstrap]
+        index_Y {ndarray} -- [subsample of site_Y in each replicate, sites x n_bootstrap]
+        budget {int} -- [bytes of kernel matrices per batched pass] (default: {MEMORY_BUDGET})
+    Returns:
+        [ndarray] -- [neutral MMD^2, sites x n_bootstrap]
+    """
+    dtype = np.result_type(site_X.dtype, site_Y.dtype, np.float32)
+    step = chunk_sites(site_X.shape[1], site_Y.shape[1], np.dtype(dtype).itemsize, budget)
+    out = np.empty(index_X.shape, dtype=np.float64)
+    for first in range(0, site_X.shape[0], step):
+        X = np.asarray(site_X[first:first+step], dtype=dtype)
+        Y = np.asarray(site_Y[first:first+step], dtype=dtype)
+        K = sq_distances(X, Y)
+        np.multiply(K, -gamma, out=K)
+        np.exp(K, out=K)
+        sites = np.arange(len(X))[:, None]
+        ix = index_X[first:first+step]
+        iy = index_Y[first:first+step]
+        null = 2 - 2*K[sites, ix, iy].astype(np.float64)
+        below = X.mean(axis=2)[sites, ix] < Y.mean(axis=2)[sites, iy]
+        out[first:first+step] = np.where(below, -null, null)
+    return out
+
+def block_orders(n_x, n_y, n_z, block, rng):
+    """random subsample orders cut into blocks by block_mmd
+    Arguments:
+        n_x {int} -- [subsamples of the first state]
+        n_y {int} -- [subsamples of the second state]
+        n_z {int} -- [subsamples of the third (control) state]
+        block {int} -- [subsamples per block]
+        rng {numpy.random.Generator} -- [random number generator]
+    Returns:
+        [tuple] -- [three index arrays of equal length, a multiple of block]
+    """
+    n_used = (min(n_x, n_y, n_z) // block) * block
+    if (block < 2 or n_used < 2*block):
+        raise ValueError("block MMD needs a block size >= 2 and at least two blocks, not block %s of %s subsamples" % (block, min(n_x, n_y, n_z)))
+    return tuple(rng.permutation(n)[:n_used] for n in (n_x, n_y, n_z))
+
+def block_mmd(site_X, site_Y, gamma, block, order_X, order_Y, budget=MEMORY_BUDGET):
+    """block (incomplete U-statistic) MMD^2 of every site in O(subsamples x block) kernel evaluations
+    The subsamples are cut into disjoint blocks of paired X and Y vectors; each block gives the
+    unbiased MMD^2 of its vectors and the estimate is their mean. block 2 is the linear-time
+    estimator. Its variance shrinks as 1/(subsamples x block) instead of 1/subsamples^2 for
+    the quadratic estimator, so it needs more subsamples for the same power.
+    Arguments:
+        site_X {ndarray} -- [sites x n_samples1 x features]
+        site_Y {ndarray} -- [sites x n_samples2 x features]
+        gamma {float} -- [kernel parameter]
+        block {int} -- [subsamples per block]
+        order_X {ndarray} -- [subsamples of site_X in block order, see block_orders]
+        order_Y {ndarray} -- [subsamples of site_Y in block order]
+        budget {int} -- [bytes of kernel matrices per batched pass] (default: {MEMORY_BUDGET})
+    Returns:
+        [ndarray] -- [MMD^2 estimate per site]
+        [ndarray] -- [standard error of the estimate per site, from the spread of its blocks]
+    """
+    n_blocks = len(order_X) // block
+    dtype = np.result_type(site_X.dtype, site_Y.dtype, np.float32)
+    step = chunk_sites(block, block, np.dtype(dtype).itemsize, budget, n_groups=n_blocks)
+    estimate = np.empty(site_X.shape[0], dtype=np.float64)
+    error = np.empty(site_X.shape[0], dtype=np.float64)
+    pairs = block*(block-1)
+    for first in range(0, site_X.shape[0], step):
+        X = np.asarray(site_X[first:first+step], dtype=dtype)[:, order_X]
+        Y = np.asarray(site_Y[first:first+step], dtype=dtype)[:, order_Y]
+        n_sites = len(X)
+        X = X.reshape(n_sites*n_blocks, block, X.shape[2])
+        Y = Y.reshape(n_sites*n_blocks, block, Y.shape[2])
+        stats = 0
+        for (A, B, weight) in ((X, X, 1), (Y, Y, 1), (X, Y, -2)):
+            K = sq_distances(A, B)
+            np.multiply(K, -gamma, out=K)
+            np.exp(K, out=K)
+            # off-diagonal sums: i != j within the block (U-statistic)
+            stats = stats + weight*(K.sum(axis=(1, 2)) - np.trace(K, axis1=1, axis2=2))/pairs
+        stats = stats.reshape(n_sites, n_blocks)
+        estimate[first:first+step] = stats.mean(axis=1)
+        error[first:first+step] = stats.std(axis=1, ddof=1)/np.sqrt(n_blocks)
+    return estimate, error
+
+def block_p(observed, error, neutral, null_error):
+    """p value of a signed block MMD^2 against the signed neutral (reference vs reference control) one
+    Normal test of observed - neutral, whose spread combines the standard errors of both
+    estimates; p runs from 0 (far below the neutral MMD) to 1 (far above), as the bootstrap
+    counts of the quadratic estimator do.
+    Arguments:
+        observed {ndarray} -- [reference vs query MMD^2, signed by the query - reference mean]
+        error {ndarray} -- [its standard error]
+        neutral {ndarray} -- [reference vs reference control MMD^2, signed by the control - reference mean]
+        null_error {ndarray} -- [its standard error]
+    Returns:
+        [ndarray] -- [p value per site, 0.5 where both errors are 0]
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        p = norm.cdf((np.asarray(observed, dtype=np.float64) - neutral)/np.hypot(error, null_error))
+    return np.where(np.isnan(p), 0.5, p)
+
+def share(array):
+    # copy a tensor into a shared memory block once; workers attach to it by name
+    array = np.ascontiguousarray(array)
+    shm = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+def _compare(X, Y, Z, job, budget):
+    # observed X vs Y and neutral X vs Z results of a chunk of sites, as a tuple of per-site arrays
+    if (job[0] == "block"):
+        (kind, gamma, block, orders) = job
+        return block_mmd(X, Y, gamma, block, orders[0], orders[1], budget) + block_mmd(X, Z, gamma, block, orders[0], orders[2], budget)
+    if (job[0] == "rff"):
+        (kind, gamma, n_components, seed, index_X, index_Z) = job
+        sampler = rff_features.rff_sampler(X.shape[2], gamma, n_components, seed)
+        return rff_features.site_mmd(X, Y, sampler, budget), rff_features.null_mmd(X, Z, sampler, index_X, index_Z, budget)
+    (kind, gamma, index_X, index_Z) = job
+    return site_mmd(X, Y, gamma, budget), null_mmd(X, Z, gamma, index_X, index_Z, budget)
+
+def _compare_chunk(args):
+    # one worker's sites: attach to the shared tensors, compute, detach
+    (specs, first, last, job, budget) = args
+    blocks = [shared_memory.SharedMemory(name=name) for (name, shape, dtype) in specs]
+    try:
+        X, Y, Z = [np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)[first:last]
+                   for (shm, (name, shape, dtype)) in zip(blocks, specs)]
+        result = _compare(X, Y, Z, job, budget)
+        del X, Y, Z  # no views may outlive the blocks
+    finally:
+        for shm in blocks:
+            shm.close()
+    return result
+
+def _compare_all(site_X, site_Y, site_Z, job, budget, max_jobs):
+    """run _compare over all sites, split over a process pool when max_jobs > 1
+    Each tensor is copied once into shared memory and every worker attaches to the same blocks
+    (no per-worker copies); the results come back in site order.
+    """
+    n_sites = site_X.shape[0]
+    if (max_jobs <= 1 or n_sites < 2):
+        return _compare(site_X, site_Y, site_Z, job, budget)
+    # a few chunks per worker evens out the load
+    step = max(1, -(-n_sites // (4*max_jobs)))
+    blocks = [share(site) for site in (site_X, site_Y, site_Z)]
+    specs = [spec for (shm, spec) in blocks]
+    try:
+        jobs = []
+        for first in range(0, n_sites, step):
+            chunk_job = job
+            if (job[0] != "block"):  # replicate indices are per site
+                chunk_job = job[:-2] + (job[-2][first:first+step], job[-1][first:first+step])
+            jobs.append((specs, first, first+step, chunk_job, budget))
+        with ProcessPoolExecutor(max_workers=max_jobs) as pool:
+            parts = list(pool.map(_compare_chunk, jobs))
+    finally:
+        for (shm, spec) in blocks:
+            shm.close()
+            shm.unlink()
+    return tuple(np.concatenate([part[k] for part in parts]) for k in range(len(parts[0])))
+
+def compare_sites(site_X, site_Y, site_Z, gamma, index_X, index_Z, budget=MEMORY_BUDGET, max_jobs=1):
+    """observed MMD^2 of X vs Y and neutral MMD^2 of the X vs Z replicates, for every site
+    With max_jobs > 1 the sites are split over a process pool sharing the tensors.
+    Arguments:
+        site_X {ndarray} -- [sites x n_samples1 x features, e.g. reference]
+        site_Y {ndarray} -- [sites x n_samples2 x features, e.g. query]
+        site_Z {ndarray} -- [sites x n_samples3 x features, e.g. reference control]
+        gamma {float} -- [kernel parameter]
+        index_X {ndarray} -- [subsample of site_X in each null replicate, sites x n_bootstrap]
+        index_Z {ndarray} -- [subsample of site_Z in each null replicate, sites x n_bootstrap]
+        budget {int} -- [bytes of kernel matrices per batched pass and worker] (default: {MEMORY_BUDGET})
+        max_jobs {int} -- [worker processes; 1 runs in this process] (default: {1})
+    Returns:
+        [ndarray] -- [observed MMD^2 per site, see site_mmd]
+        [ndarray] -- [neutral MMD^2, sites x n_bootstrap, see null_mmd]
+    """
+    return _compare_all(site_X, site_Y, site_Z, ("bootstrap", gamma, index_X, index_Z), budget, max_jobs)
+
+def compare_sites_block(site_X, site_Y, site_Z, gamma, block, orders, budget=MEMORY_BUDGET, max_jobs=1):
+    """block MMD^2 of X vs Y and of the neutral X vs Z comparison, for every site
+    Arguments:
+        site_X {ndarray} -- [sites x n_samples1 x features, e.g. reference]
+        site_Y {ndarray} -- [sites x n_samples2 x features, e.g. query]
+        site_Z {ndarray} -- [sites x n_samples3 x features, e.g. reference control]
+        gamma {float} -- [kernel parameter]
+        block {int} -- [subsamples per block]
+        orders {tuple} -- [subsample orders of X, Y and Z, see block_orders]
+        budget {int} -- [bytes of kernel matrices per batched pass and worker] (default: {MEMORY_BUDGET})
+        max_jobs {int} -- [worker processes; 1 runs in this process] (default: {1})
+    Returns:
+        [tuple] -- [observed MMD^2, its standard error, neutral MMD^2, its standard error; per site]
+    """
+    return _compare_all(site_X, site_Y, site_Z, ("block", gamma, block, orders), budget, max_jobs)
+
+def compare_sites_rff(site_X, site_Y, site_Z, gamma, index_X, index_Z, n_components, seed, budget=MEMORY_BUDGET, max_jobs=1):
+    """compare_sites with the kernel approximated by random Fourier features (see rff_features)
+    The MMD^2 becomes the squared distance of mean embeddings, O(subsamples x n_components) per
+    site; the same seed gives the same embedding in every worker and run.
+    Arguments:
+        site_X, site_Y, site_Z, gamma, index_X, index_Z -- [as compare_sites]
+        n_components {int} -- [embedding dimension D]
+        seed {int} -- [seed of the random frequencies]
+        budget {int} -- [bytes of embedded features per pass and worker] (default: {MEMORY_BUDGET})
+        max_jobs {int} -- [worker processes; 1 runs in this process] (default: {1})
+    Returns:
+        [ndarray] -- [observed MMD^2 per site]
+        [ndarray] -- [neutral MMD^2, sites x n_bootstrap]
+    """
+    return _compare_all(site_X, site_Y, site_Z, ("rff", gamma, n_components, seed, index_X, index_Z), budget, max_jobs)
+
+def block_calibration(block, n_sites=1000, n_samples=60, n_features=5, cutoff=0.05, seed=0):
+    """null calibration of block_p: reference, query and reference control all drawn from one distribution
+    Arguments:
+        block {int} -- [subsamples per block]
+        n_sites, n_samples, n_features {int} -- [size of the simulated site tensors]
+        cutoff {float} -- [two-sided significance cutoff, as in chimerax_mmd] (default: {0.05})
+        seed {int} -- [random seed] (default: {0})
+    Returns:
+        [float] -- [fraction of sites called significant, about 2 x cutoff when calibrated]
+        [float] -- [Kolmogorov-Smirnov p value of the p values against the uniform distribution]
+    """
+    rng = np.random.default_rng(seed)
+    X, Y, Z = rng.normal(size=(3, n_sites, n_samples, n_features))
+    orders = block_orders(n_samples, n_samples, n_samples, block, rng)
+    observed, error, neutral, null_error = compare_sites_block(X, Y, Z, 1.0/n_features, block, orders)
+    observed = np.where(Y.mean(axis=(1, 2)) < X.mean(axis=(1, 2)), -observed, observed)
+    neutral = np.where(Z.mean(axis=(1, 2)) < X.mean(axis=(1, 2)), -neutral, neutral)
+    p = block_p(observed, error, neutral, null_error)
+    return float(np.mean((p < cutoff) | (p > 1-cutoff))), float(kstest(p, "uniform").pvalue)
+
+if __name__ == '__main__':
+    for estimator in ["linear", "block"]:
+        block = ESTIMATORS[estimator] or 10
+        (significant, uniform_p) = block_calibration(block)
+        print("%s estimator (block %s) under the null: %.3f of sites significant (expected 0.10), uniformity p %.3f" % (estimator, block, significant, uniform_p))
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+#############################################################################
+######   This script reports sampler progress from job completion events
+######   (windows done per state/metric stream) with throughput and ETA,
+######   replacing the directory polling progress bars
+######   It is part of the DROIDS v6.0 ChimeraX plug-in suite for
+######   machine-learning assisted comparative protein dynamics
+######   produced by Dr. Gregory A. Babbitt and students at the
+######   Rochester Instituteof Technology in 2022.   License under GPL v3.0
+#############################################################################
+
+import queue
+import threading
+import time
+from progress.bar import IncrementalBar
+
+class ProgressMonitor:
+    """one progress bar over every stream of subsample windows
+
+    Workers call done(stream) per finished window (or done(stream, n) per batch),
+    finish_stream(stream) when a stream ends normally and failed(stream, message)
+    when a job gives up. The bar thread only wakes on these events and stops on
+    completion, on the first failure or on close(), so it can never hang.
+    """
+    def __init__(self, streams, label="subsamples_completed"):
+        self.expected = dict(streams)
+        self.counts = dict((name, 0) for name in streams)
+        self.total = sum(self.expected.values())
+        self.completed = 0
+        self.failures = []
+        self._events = queue.Queue()
+        self._thread = threading.Thread(target=self._run, args=(label,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def done(self, stream, n=1):
+        self._events.put(("done", stream, n))
+
+    def finish_stream(self, stream):
+        # count whatever the stream did not report window by window
+        self._events.put(("finish", stream, None))
+
+    def failed(self, stream, message):
+        self._events.put(("failed", stream, message))
+
+    def close(self):
+        # stop the bar (if still running) and wait for it
+        self._events.put(("close", None, None))
+        self._thread.join()
+
+    def complete(self):
+        return (len(self.failures) == 0 and self.completed >= self.total)
+
+    def _run(self, label):
+        bar = IncrementalBar(label, max=max(1, self.total))
+        start = time.time()
+        while (self.completed < self.total):
+            (kind, stream, value) = self._events.get()
+            if (kind == "close"):
+                break
+            if (kind == "failed"):
+                self.failures.append((stream, value))
+                print("\nERROR: %s failed: %s" % (stream, value))
+                break
+            left = self.expected[stream] - self.counts[stream]
+            n = left if (kind == "finish") else min(value, left)
+            if (n <= 0):
+                continue
+            self.counts[stream] += n
+            self.completed += n
+            rate = self.completed / max(time.time()-start, 1e-6)
+            eta = (self.total-self.completed) / rate
+            streams = " ".join("%s %d/%d" % (name, self.counts[name], self.expected[name]) for name in self.expected)
+            bar.suffix = "%d/%d windows | %.2f windows/s | ETA %s | %s" % (self.completed, self.total, rate, time.strftime("%H:%M:%S", time.gmtime(eta)), streams)
+            bar.next(n)
+        bar.finish()
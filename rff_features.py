@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+#############################################################################
+######   This script maps site features into a fixed random Fourier
+######   feature space (k(x,y) = exp(-gamma * ||x-y||^2) approximated by
+######   an inner product), so that the MMD of two states is a difference
+######   of means and the coordinated dynamics classifier becomes linear
+######   It is part of the DROIDS v6.0 ChimeraX plug-in suite for
+######   machine-learning assisted comparative protein dynamics
+######   produced by Dr. Gregory A. Babbitt and students at the
+######   Rochester Instituteof Technology in 2022.   License under GPL v3.0
+#############################################################################
+
+import numpy as np
+from sklearn.kernel_approximation import RBFSampler
+from sklearn.linear_model import LogisticRegression
+from sklearn.pipeline import make_pipeline
+
+RFF_COMPONENTS = 500  # embedding dimension D; the kernel error shrinks as 1/sqrt(D)
+RFF_SEED = 0  # seed of the random frequencies, so every run (and worker) embeds alike
+
+def rff_sampler(n_features, gamma, n_components=RFF_COMPONENTS, seed=RFF_SEED):
+    # random frequencies and phases of the rbf kernel with this gamma (fixed by the seed)
+    return RBFSampler(gamma=gamma, n_components=n_components, random_state=seed).fit(np.zeros((1, n_features)))
+
+def embed(sampler, tensor):
+    """random Fourier features of every feature vector of a (sites x subsamples x features) tensor
+    Returns:
+        [ndarray] -- [sites x subsamples x n_components]
+    """
+    tensor = np.asarray(tensor)
+    flat = sampler.transform(tensor.reshape(-1, tensor.shape[-1]))
+    return flat.reshape(tensor.shape[:-1] + (flat.shape[-1],))
+
+def embed_chunk(site_X, site_Y, sampler, budget):
+    # sites per pass so that the embedded subsamples of a chunk fit the budget
+    # (itemsize of the embedding: input and frequency precision, float32 at the least, as in mmd_engine)
+    dtype = np.result_type(site_X.dtype, site_Y.dtype, sampler.random_weights_.dtype, np.float32)
+    itemsize = np.dtype(dtype).itemsize
+    per_site = (site_X.shape[1] + site_Y.shape[1])*sampler.n_components*itemsize
+    return max(1, int(budget // max(1, per_site)))
+
+def site_mmd(site_X, site_Y, sampler, budget):
+    """approximate MMD^2 of every site: squared distance of the mean embeddings
+    Approximates the quadratic estimator (mmd_engine.site_mmd) in O(subsamples x D) per site.
+    Arguments:
+        site_X {ndarray} -- [sites x n_samples1 x features]
+        site_Y {ndarray} -- [sites x n_samples2 x features]
+        sampler {RBFSampler} -- [see rff_sampler]
+        budget {int} -- [bytes of embedded features per pass]
+    Returns:
+        [ndarray] -- [MMD^2 per site]
+    """
+    step = embed_chunk(site_X, site_Y, sampler, budget)
+    out = np.empty(site_X.shape[0], dtype=np.float64)
+    for first in range(0, site_X.shape[0], step):
+        mean_X = embed(sampler, site_X[first:first+step]).mean(axis=1)
+        mean_Y = embed(sampler, site_Y[first:first+step]).mean(axis=1)
+        out[first:first+step] = np.sum((mean_X - mean_Y)**2, axis=1)
+    return out
+
+def null_mmd(site_X, site_Z, sampler, index_X, index_Z, budget):
+    """approximate signed neutral MMD^2 of single-subsample pairs, as mmd_engine.null_mmd
+    Arguments:
+        site_X {ndarray} -- [sites x n_samples1 x features]
+        site_Z {ndarray} -- [sites x n_samples2 x features]
+        sampler {RBFSampler} -- [see rff_sampler]
+        index_X {ndarray} -- [subsample of site_X in each replicate, sites x n_bootstrap]
+        index_Z {ndarray} -- [subsample of site_Z in each replicate, sites x n_bootstrap]
+        budget {int} -- [bytes of embedded features per pass]
+    Returns:
+        [ndarray] -- [neutral MMD^2, sites x n_bootstrap]
+    """
+    step = embed_chunk(site_X, site_Z, sampler, budget)
+    out = np.empty(index_X.shape, dtype=np.float64)
+    for first in range(0, site_X.shape[0], step):
+        X = np.asarray(site_X[first:first+step])
+        Z = np.asarray(site_Z[first:first+step])
+        sites = np.arange(len(X))[:, None]
+        ix = index_X[first:first+step]
+        iz = index_Z[first:first+step]
+        null = np.sum((embed(sampler, X)[sites, ix] - embed(sampler, Z)[sites, iz])**2, axis=2)
+        below = X.mean(axis=2)[sites, ix] < Z.mean(axis=2)[sites, iz]
+        out[first:first+step] = np.where(below, -null, null)
+    return out
+
+def linear_classifier(gamma, n_components=RFF_COMPONENTS, seed=RFF_SEED):
+    """linear stand-in for an rbf kernel classifier: random Fourier features + logistic regression
+    Fits in O(subsamples x D) instead of the O(subsamples^2) kernel matrix of the SVC;
+    fit, score, predict and predict_proba work as before.
+    """
+    return make_pipeline(RBFSampler(gamma=gamma, n_components=n_components, random_state=seed),
+                         LogisticRegression(max_iter=1000))
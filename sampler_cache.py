@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+#############################################################################
+######   This script is a content-addressed cache for DROIDS sampler
+######   outputs (per window fluctuation columns and correlation lists,
+######   whole-run products), with size-based least recently used eviction
+######   It is part of the DROIDS v6.0 ChimeraX plug-in suite for
+######   machine-learning assisted comparative protein dynamics
+######   produced by Dr. Gregory A. Babbitt and students at the
+######   Rochester Instituteof Technology in 2022.   License under GPL v3.0
+#############################################################################
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+
+CACHE_VERSION = 2  # bump when a cached product changes meaning
+FINGERPRINT_BLOCK = 1 << 20  # bytes hashed at the head, middle and tail of a file
+
+_fingerprints = {}
+_fingerprints_lock = threading.Lock()
+
+def file_fingerprint(path):
+    """sampled content fingerprint of a (possibly huge) input file
+    Only the size and three FINGERPRINT_BLOCK blocks are hashed (not the whole file), so two files
+    of equal size that differ only outside those blocks share a fingerprint.
+    Arguments:
+        path {str} -- [trajectory or topology]
+    Returns:
+        [str] -- [sha256 of the size plus the head, middle and tail blocks]
+    """
+    st = os.stat(path)
+    memo = (os.path.realpath(path), st.st_size, st.st_mtime_ns)
+    with _fingerprints_lock:
+        if memo in _fingerprints:
+            return _fingerprints[memo]
+    h = hashlib.sha256()
+    h.update(str(st.st_size).encode())
+    with open(path, "rb") as f:
+        for offset in sorted(set([0, max(0, st.st_size//2 - FINGERPRINT_BLOCK//2), max(0, st.st_size - FINGERPRINT_BLOCK)])):
+            f.seek(offset)
+            h.update(f.read(FINGERPRINT_BLOCK))
+    with _fingerprints_lock:
+        _fingerprints[memo] = h.hexdigest()
+    return _fingerprints[memo]
+
+def cache_key(kind, inputs, **params):
+    """key of one cached product
+    Arguments:
+        kind {str} -- [product type, e.g. atomicfluct or atomiccorr]
+        inputs {list} -- [input files (topology, trajectory) fingerprinted by content]
+        params -- [everything else the product depends on: mask, window bounds, recipe ...]
+    Returns:
+        [str] -- [hex sha256]
+    """
+    payload = json.dumps({"version": CACHE_VERSION, "kind": kind,
+                          "inputs": [file_fingerprint(path) for path in inputs],
+                          "params": params}, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+class SamplerCache:
+    """directory of cached files named by key, trimmed to max_bytes (least recently used first)"""
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def fetch(self, key, dest):
+        # copy a cached product to dest; False on a miss
+        entry = self.path(key)
+        if not os.path.exists(entry):
+            self.misses += 1
+            return False
+        shutil.copyfile(entry, dest)
+        os.utime(entry)  # mark as recently used
+        self.hits += 1
+        return True
+
+    def store(self, key, src):
+        # copy next to the entry and rename, so a concurrent reader never sees a partial file
+        entry = self.path(key)
+        folder = os.path.dirname(entry)
+        if not os.path.exists(folder):
+            os.makedirs(folder, exist_ok=True)
+        tmp = "%s.tmp%s_%s" % (entry, os.getpid(), threading.get_ident())
+        shutil.copyfile(src, tmp)
+        os.replace(tmp, entry)
+
+    def evict(self):
+        # drop least recently used entries until the cache fits in max_bytes
+        entries = []
+        total = 0
+        for folder, dirs, files in os.walk(self.cache_dir):
+            for name in files:
+                entry = os.path.join(folder, name)
+                st = os.stat(entry)
+                entries.append((st.st_mtime, st.st_size, entry))
+                total += st.st_size
+        entries.sort()
+        removed = 0
+        for (mtime, size, entry) in entries:
+            if (total <= self.max_bytes):
+                break
+            os.remove(entry)
+            total -= size
+            removed += 1
+        return removed